@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                 : RiverGIS
+Description          : HEC-RAS tools for QGIS
+Date                 : December, 2015
+copyright            : (C) 2015 by RiverGIS Group
+email                : rpasiok@gmail.com, damnback333@gmail.com
+***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .mesh2d import wkb_coords, wkb_rings, polygon_edges, scanline, locate_along
+from .rasElevations import sample_DTM
+from .raster_sampler import RasterSampler
+from qgis.core import QgsProject
+
+
+def cell_pixels(sampler, rings_list, col0, row0, ncols, nrows):
+    """
+    Raster cells of a window with centers located inside mesh cells.
+    Cell polygons are transformed into pixel coordinates, so raster cell centers are grid nodes of the scanline.
+
+    Args:
+        sampler (RasterSampler): Sampler of the raster.
+        rings_list (list): List of polygon rings of each mesh cell.
+        col0 (int): First column of the window.
+        row0 (int): First row of the window.
+        ncols (int): Number of window columns.
+        nrows (int): Number of window rows.
+
+    Returns:
+        tuple: Arrays of mesh cell indices, window column and row numbers.
+    """
+    edges = []
+    ids = []
+    for i, rings in enumerate(rings_list):
+        cell_edges = polygon_edges([np.column_stack(sampler.to_pixel(ring[:, 0], ring[:, 1])) for ring in rings])
+        edges.append(cell_edges)
+        ids.append(np.full(cell_edges.shape[0], i, dtype=np.int64))
+    if not edges:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    bands = list(scanline(np.vstack(edges), np.concatenate(ids), 0.5, 0.5, 1.0))
+    if not bands:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    idx, cols, rows = [np.concatenate(b) for b in zip(*bands)]
+    cols -= col0
+    rows -= row0
+    inside = (cols >= 0) & (cols < ncols) & (rows >= 0) & (rows < nrows)
+    return idx[inside], cols[inside], rows[inside]
+
+
+def zonal_volumes(idx, values, ncells, cell_area, levels=20):
+    """
+    Zonal statistics of raster values grouped by mesh cells: minimum and maximum elevation and
+    elevation-volume curves. Volume below a level is the sum of (level - elevation) * cell_area over
+    raster cells lower than the level.
+
+    Args:
+        idx (numpy.ndarray): Mesh cell indices of raster cells.
+        values (numpy.ndarray): Raster cells elevations.
+        ncells (int): Number of mesh cells.
+        cell_area (float): Area of a raster cell.
+        levels (int): Number of curve levels between minimum and maximum elevation of a mesh cell.
+
+    Returns:
+        tuple: Indices of mesh cells having values, their minimum and maximum elevations, and arrays of shape
+            (n, levels) with levels, volumes and wetted areas.
+    """
+    valid = ~np.isnan(values)
+    idx = idx[valid]
+    values = values[valid]
+    order = np.lexsort((values, idx))
+    idx = idx[order]
+    values = values[order]
+    counts = np.bincount(idx, minlength=ncells)
+    cells = np.flatnonzero(counts)
+    counts = counts[cells]
+    start = np.cumsum(counts) - counts
+    zmin = values[start] if values.size else np.empty(0)
+    zmax = values[start + counts - 1] if values.size else np.empty(0)
+    h = zmin[:, None] + (zmax - zmin)[:, None] * np.linspace(0, 1, levels)[None, :]
+    # values sorted by cell and elevation are searched at once with keys offset by cell number
+    span = (zmax - zmin).max() + 1 if cells.size else 1
+    local = np.repeat(np.arange(cells.size), counts)
+    keys = local * span + (values - np.repeat(zmin, counts))
+    query = np.arange(cells.size)[:, None] * span + (h - zmin[:, None])
+    below = np.searchsorted(keys, query.ravel(), 'right').reshape(h.shape) - start[:, None]
+    csum = np.r_[0, np.cumsum(values)]
+    zsum = csum[start[:, None] + below] - csum[start[:, None]]
+    volumes = cell_area * (below * h - zsum)
+    return cells, zmin, zmax, h, volumes, cell_area * below
+
+
+def cell_statistics(provider, mpids, rings_list, levels=20):
+    """
+    Computing statistics of mesh cells located within a single raster tile. Runs on a worker thread,
+    so it gets its own copy of the raster data provider.
+
+    Returns:
+        tuple: Lists of rows with cells minimum and maximum elevations and with elevation-volume curves.
+    """
+    sampler = RasterSampler(provider)
+    coords = np.vstack([ring for rings in rings_list for ring in rings])
+    xmin, ymin = coords.min(axis=0)
+    xmax, ymax = coords.max(axis=0)
+    col0, row0, ncols, nrows = sampler.window_for_bbox(xmin, ymin, xmax, ymax, pad=1)
+    if ncols == 0 or nrows == 0:
+        return [], []
+    window = sampler.read_window(col0, row0, ncols, nrows)
+    idx, cols, rows = cell_pixels(sampler, rings_list, col0, row0, ncols, nrows)
+    cells, zmin, zmax, h, volumes, areas = zonal_volumes(idx, window[rows, cols], len(rings_list), sampler.cell_area, levels)
+    stats = list(zip(mpids[cells].tolist(), zmin.round(2).tolist(), zmax.round(2).tolist()))
+    curves = []
+    for mpid, lo, hi, hs, vs, As in zip(mpids[cells].tolist(), zmin, zmax, h, volumes, areas):
+        # flat cells get a single point of the curve
+        n = levels if hi > lo else 1
+        curves.extend(zip([mpid] * n, hs[:n].round(2).tolist(), vs[:n].round(3).tolist(), As[:n].round(3).tolist()))
+    return stats, curves
+
+
+def compute_cell_properties(rgis, levels=20, workers=None):
+    """
+    Computing minimum and maximum elevations and elevation-volume curves of mesh cells from DTMs.
+    Cells are grouped by raster tiles and each tile is read once by a worker thread.
+
+    Args:
+        levels (int): Number of elevation-volume curve levels of a cell.
+        workers (int): Number of worker threads.
+
+    Returns:
+        int: Number of cells with computed properties.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    qry = 'SELECT * FROM "{0}"."DTMs";'.format(rgis.rdb.SCHEMA)
+    dtms = rgis.rdb.run_query(qry, fetch=True) or []
+    done = 0
+    for dtm in dtms:
+        qry = '''
+SELECT
+    "MPID",
+    ST_AsBinary(ST_Force2D(geom), 'NDR') AS wkb
+FROM
+    "{0}"."MeshCells2d"
+WHERE
+    "DtmID" = {1};
+'''
+        qry = qry.format(rgis.rdb.SCHEMA, dtm['DtmID'])
+        cells = rgis.rdb.run_query(qry, fetch=True)
+        if not cells:
+            continue
+        else:
+            pass
+        rlayer = QgsProject.instance().mapLayer(dtm['LayerID'])
+        sampler = RasterSampler.from_layer(rlayer)
+        mpids = np.array([cell['MPID'] for cell in cells], dtype=np.int64)
+        rings_list = [wkb_rings(cell['wkb']) for cell in cells]
+        centers = np.array([rings[0].mean(axis=0) for rings in rings_list])
+        tasks = []
+        for idx in sampler.split_by_tiles(centers[:, 0], centers[:, 1], mpids.size):
+            tasks.append((rlayer.dataProvider().clone(), mpids[idx], [rings_list[i] for i in idx], levels))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda task: cell_statistics(*task), tasks)
+            for stats, curves in results:
+                columns = [('"MinElev"', 'double precision'), ('"MaxElev"', 'double precision')]
+                rgis.rdb.update_from_rows('MeshCells2d', ('"MPID"', 'integer'), columns, stats)
+                rgis.rdb.copy_rows('CellVolumes2d', ['"MPID"', '"Elevation"', '"Volume"', '"Area"'], curves)
+                done += len(stats)
+    return done
+
+
+def face_stations(coords, step):
+    """
+    Stations of profile points along a face, spaced by step and ending at the face end.
+    """
+    length = np.hypot(*np.diff(coords, axis=0).T).sum()
+    return np.r_[np.arange(0, length, step), length]
+
+
+def compute_face_profiles(rgis, workers=None):
+    """
+    Sampling DTMs along cell faces. Points are spaced by the DTM cell size.
+
+    Args:
+        workers (int): Number of worker threads.
+
+    Returns:
+        int: Number of faces with computed profiles.
+    """
+    try:
+        bilinear = rgis.dtm_bilinear
+    except:
+        bilinear = False
+    if workers is None:
+        workers = os.cpu_count() or 1
+    qry = 'SELECT * FROM "{0}"."DTMs";'.format(rgis.rdb.SCHEMA)
+    dtms = rgis.rdb.run_query(qry, fetch=True) or []
+    done = 0
+    for dtm in dtms:
+        qry = '''
+SELECT
+    "FaceID",
+    ST_AsBinary(ST_Force2D(geom), 'NDR') AS wkb
+FROM
+    "{0}"."CellFaces2d"
+WHERE
+    "DtmID" = {1}
+ORDER BY
+    "FaceID";
+'''
+        qry = qry.format(rgis.rdb.SCHEMA, dtm['DtmID'])
+        faces = rgis.rdb.run_query(qry, fetch=True)
+        if not faces:
+            continue
+        else:
+            pass
+        rlayer = QgsProject.instance().mapLayer(dtm['LayerID'])
+        sampler = RasterSampler.from_layer(rlayer)
+        step = min(sampler.dx, sampler.dy)
+        face_ids = []
+        stations = []
+        points = []
+        for face in faces:
+            coords = wkb_coords(face['wkb'])
+            st = face_stations(coords, step)
+            face_ids.append(np.full(st.size, face['FaceID'], dtype=np.int64))
+            stations.append(st)
+            points.append(locate_along(coords, st, [0.])[:, 0, :])
+        face_ids = np.concatenate(face_ids)
+        stations = np.concatenate(stations)
+        points = np.vstack(points)
+        elevs = np.full(stations.size, np.nan)
+        pt_ids = np.arange(stations.size)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for idx in sampler.split_by_tiles(points[:, 0], points[:, 1], workers):
+                provider = rlayer.dataProvider().clone()
+                futures.append(executor.submit(sample_DTM, provider, pt_ids[idx], points[idx, 0], points[idx, 1], bilinear))
+            for future in futures:
+                ids, values = future.result()
+                elevs[ids] = values
+        valid = ~np.isnan(elevs)
+        rows = zip(face_ids[valid].tolist(), stations[valid].round(2).tolist(), elevs[valid].tolist())
+        rgis.rdb.copy_rows('FaceProfiles2d', ['"FaceID"', '"Station"', '"Elevation"'], rows)
+        # minimum elevation of each face
+        bounds = np.flatnonzero(np.diff(face_ids)) + 1
+        mins = np.fmin.reduceat(elevs, np.r_[0, bounds])
+        ids = face_ids[np.r_[0, bounds]]
+        has = ~np.isnan(mins)
+        rows = zip(ids[has].tolist(), mins[has].tolist())
+        rgis.rdb.update_from_rows('CellFaces2d', ('"FaceID"', 'integer'), [('"MinElev"', 'double precision')], rows)
+        done += int(has.sum())
+    return done
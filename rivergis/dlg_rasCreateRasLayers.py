@@ -54,6 +54,7 @@ class DlgCreateRasLayers(QDialog):
             (self.ui.inlineStructChbox, heco.InlineStructures),
             (self.ui.streamChbox, heco.StreamCenterlines),
             (self.ui.landuseChbox, heco.LanduseAreas),
+            (self.ui.landuseChbox, heco.LandcoverClasses),
             (self.ui.lateralStructChbox, heco.LateralStructures),
             (self.ui.leveeChbox, heco.LeveeAlignment),
             (self.ui.leveeChbox, heco.LeveePoints),
@@ -73,6 +73,19 @@ class DlgSettings(QDialog):
         self.ui.rgisAlwaysOnTopChbox.setChecked(self.rgis.always_on_top)
         # DB
         self.ui.db_loadAllChbox.setChecked(self.rgis.rdb.LOAD_ALL)
+        try:
+            self.ui.db_topology_tolerance.setValue(self.rgis.topology_tolerance)
+        except AttributeError:
+            pass
+        try:
+            self.ui.db_mesh_points_budget.setValue(self.rgis.mesh_points_budget)
+        except AttributeError:
+            pass
+        # DTMs
+        try:
+            self.ui.dtm_bilinearChbox.setChecked(self.rgis.dtm_bilinear)
+        except AttributeError:
+            pass
 
     def acceptDialog(self):
         QApplication.setOverrideCursor(Qt.WaitCursor)
@@ -86,6 +99,8 @@ class DlgSettings(QDialog):
         # River DB
         self.rgis.rdb.OVERWRITE = True
         self.rgis.rdb.LOAD_ALL = self.ui.db_loadAllChbox.isChecked()
+        self.rgis.topology_tolerance = self.ui.db_topology_tolerance.value()
+        self.rgis.mesh_points_budget = self.ui.db_mesh_points_budget.value()
 
         # DTMs
         self.rgis.dtms = []
@@ -96,6 +111,7 @@ class DlgSettings(QDialog):
                 self.rgis.dtms.append(item.data()[1]) # append layerId
 
         self.rgis.dtm_chunksize = self.ui.dtm_chunksize.value()
+        self.rgis.dtm_bilinear = self.ui.dtm_bilinearChbox.isChecked()
 
         # write settings to json
         self.rgis.writeSettings()
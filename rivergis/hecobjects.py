@@ -58,6 +58,38 @@ class HecRasObject(object):
             pass
         return qry
 
+    def nearest_feature(self, table, geom, columns, alias='nn'):
+        """
+        LATERAL join of the feature of a table nearest to a geometry. Features are ordered with the KNN
+        distance operator (<->), so the GiST index of the table is used and only the nearest feature is read.
+
+        Args:
+            table (str): Name of the searched table.
+            geom (str): SQL expression of the geometry for which the nearest feature is searched.
+            columns (list): Columns of the searched table to be selected.
+            alias (str): Alias of the joined subquery.
+
+        Returns:
+            str: JOIN LATERAL clause.
+        """
+        qry = '''JOIN LATERAL
+        (SELECT
+            {3}
+        FROM
+            "{0}"."{1}" AS n
+        ORDER BY
+            n.geom <-> {2}
+        LIMIT 1) AS {4} ON TRUE'''
+        cols = ',\n            '.join('n.{0}'.format(col) for col in columns)
+        return qry.format(self.schema, table, geom, cols, alias)
+
+    @staticmethod
+    def area_filter(area_ids, column='"AreaID"'):
+        if area_ids is None:
+            return 'TRUE'
+        else:
+            return '{0} IN ({1})'.format(column, ', '.join('{0:d}'.format(i) for i in area_ids) or 'NULL')
+
 
 class StreamCenterlines(HecRasObject):
     def __init__(self):
@@ -75,151 +107,169 @@ class StreamCenterlines(HecRasObject):
             ('"ToSta"', 'double precision'),
             ('"Notes"', 'text')]
 
-    def pg_topology(self):
+    def pg_topology(self, tolerance=0):
+        if tolerance > 0:
+            # snap reach ends to the nodes they were clustered into
+            snap = ',\n    geom = ST_SetPoint(ST_SetPoint(sc.geom, 0, f.node_geom), ST_NPoints(sc.geom) - 1, t.node_geom)'
+        else:
+            snap = ''
         qry = '''
-CREATE OR REPLACE FUNCTION "{0}".from_to_node ()
-    RETURNS VOID AS
-$BODY$
-DECLARE
-    c cursor FOR SELECT * FROM "{0}"."StreamCenterlines";
-    r "{0}"."StreamCenterlines"%ROWTYPE;
-    start_geom geometry;
-    end_geom geometry;
-    start_node integer := 0;
-    end_node integer := 0;
-    nr integer := 0;
-BEGIN
-FOR r IN c LOOP
-    start_geom := ST_StartPoint(r.geom);
-    end_geom := ST_EndPoint(r.geom);
-    IF (SELECT exists (SELECT 1 FROM "{0}"."NodesTable" WHERE geom = start_geom LIMIT 1)) THEN
-        start_node := (SELECT "NodeID" FROM "{0}"."NodesTable" WHERE geom = start_geom LIMIT 1);
-    ELSE
-        nr := nr + 1;
-        start_node := nr;
-        INSERT INTO "{0}"."NodesTable" VALUES (start_geom, nr, ST_X(start_geom), ST_Y(start_geom));
-    END IF;
-    IF (SELECT exists (SELECT 1 FROM "{0}"."NodesTable" WHERE geom = end_geom LIMIT 1)) THEN
-        end_node := (SELECT "NodeID" FROM "{0}"."NodesTable" WHERE geom = end_geom LIMIT 1);
-    ELSE
-        nr := nr + 1;
-        end_node := nr;
-        INSERT INTO "{0}"."NodesTable" VALUES (end_geom, nr, ST_X(end_geom), ST_Y(end_geom));
-    END IF;
-    UPDATE
+WITH ends AS
+    (SELECT
+        "ReachID",
+        'from' AS end_type,
+        2 * "ReachID" AS ord,
+        ST_StartPoint(geom) AS geom
+    FROM
         "{0}"."StreamCenterlines"
-    SET
-        "FromNode" = start_node,
-        "ToNode" = end_node
-    WHERE CURRENT OF c;
-END LOOP;
-END;
-$BODY$
-    LANGUAGE plpgsql;
-------------------------------------------------------------------------------------------------------------------------
-SELECT "{0}".from_to_node ();
-DROP FUNCTION IF EXISTS "{0}".from_to_node ();
+    UNION ALL
+    SELECT
+        "ReachID",
+        'to' AS end_type,
+        2 * "ReachID" + 1 AS ord,
+        ST_EndPoint(geom) AS geom
+    FROM
+        "{0}"."StreamCenterlines"),
+clusters AS
+    (SELECT
+        *,
+        ST_ClusterDBSCAN(geom, eps := {1}, minpoints := 1) OVER () AS cid
+    FROM
+        ends),
+nodes AS
+    (SELECT
+        cid,
+        row_number() OVER (ORDER BY min(ord)) AS "NodeID",
+        ST_Centroid(ST_Collect(geom)) AS geom
+    FROM
+        clusters
+    GROUP BY
+        cid),
+ends_nodes AS
+    (SELECT
+        c."ReachID",
+        c.end_type,
+        n."NodeID",
+        n.geom AS node_geom
+    FROM
+        clusters AS c
+        JOIN nodes AS n USING (cid)),
+new_nodes AS
+    (INSERT INTO "{0}"."NodesTable" (geom, "NodeID", "X", "Y")
+    SELECT
+        geom,
+        "NodeID",
+        ST_X(geom),
+        ST_Y(geom)
+    FROM
+        nodes)
+UPDATE
+    "{0}"."StreamCenterlines" AS sc
+SET
+    "FromNode" = f."NodeID",
+    "ToNode" = t."NodeID"{2}
+FROM
+    ends_nodes AS f,
+    ends_nodes AS t
+WHERE
+    f."ReachID" = sc."ReachID" AND f.end_type = 'from' AND
+    t."ReachID" = sc."ReachID" AND t.end_type = 'to';
+SELECT setval(pg_get_serial_sequence('"{0}"."NodesTable"', 'NodeID'), (SELECT coalesce(max("NodeID"), 0) + 1 FROM "{0}"."NodesTable"), false);
 '''
-        qry = qry.format(self.schema)
+        qry = qry.format(self.schema, tolerance, snap)
         return qry
 
     def pg_lengths_stations(self):
         qry = '''
-WITH all_nodes AS
+WITH river_nodes AS
     (SELECT
         "RiverCode",
-        "ReachCode",
-        ST_StartPoint(geom) AS geom,
-        'start' AS point_type
+        "FromNode" AS "NodeID"
     FROM
         "{0}"."StreamCenterlines"
     UNION ALL
     SELECT
         "RiverCode",
-        "ReachCode",
-        ST_EndPoint(geom) AS geom,
-        'end' AS point_type
+        "ToNode" AS "NodeID"
     FROM
         "{0}"."StreamCenterlines"),
     single_nodes AS
     (SELECT
         "RiverCode",
-        geom
+        "NodeID"
     FROM
-        all_nodes
+        river_nodes
     GROUP BY
         "RiverCode",
-        geom
+        "NodeID"
     HAVING
-        COUNT(geom) = 1)
+        COUNT(*) = 1)
 
     INSERT INTO "{0}"."Endpoints"(geom, "RiverCode", "ReachCode", "NodeID")
     SELECT
-        all_nodes.geom,
-        all_nodes."RiverCode",
-        all_nodes."ReachCode",
-        "NodesTable"."NodeID"
+        ST_EndPoint(sc.geom),
+        sc."RiverCode",
+        sc."ReachCode",
+        sc."ToNode"
     FROM
-        all_nodes,
-        single_nodes,
-        "{0}"."NodesTable"
+        "{0}"."StreamCenterlines" AS sc,
+        single_nodes
     WHERE
-        all_nodes."RiverCode" = single_nodes."RiverCode" AND
-        all_nodes.geom = single_nodes.geom AND
-        all_nodes.point_type = 'end' AND
-        all_nodes.geom = "NodesTable".geom;
+        sc."RiverCode" = single_nodes."RiverCode" AND
+        sc."ToNode" = single_nodes."NodeID";
 
 ------------------------------------------------------------------------------------------------------------------------
-CREATE OR REPLACE FUNCTION "{0}".from_to_stations ()
-    RETURNS VOID AS
-$BODY$
-DECLARE
-    c cursor FOR SELECT * FROM "{0}"."Endpoints";
-    r "{0}"."Endpoints"%ROWTYPE;
-    river text;
-    tonode_id integer;
-    fromnode_id integer;
-    fromsta double precision;
-    tosta double precision;
-    len double precision;
-    counter integer;
-BEGIN
-FOR r IN c LOOP
-    river := r."RiverCode";
-    tonode_id := r."NodeID";
-    fromsta := 0;
-    tosta := 0;
-    counter := (SELECT COUNT(*) FROM "{0}"."StreamCenterlines" WHERE "RiverCode" = river);
-    FOR i IN 1..counter LOOP
-        SELECT
-            "FromNode", ST_Length(geom)
-        INTO
-            fromnode_id, len
-        FROM
-            "{0}"."StreamCenterlines"
-        WHERE
-            "RiverCode" = river AND
-            "ToNode" = tonode_id;
-        tosta := fromsta + len;
-        UPDATE
-            "{0}"."StreamCenterlines"
-        SET
-            "ReachLen" = len,
-            "FromSta" = fromsta,
-            "ToSta" = tosta
-        WHERE
-            "RiverCode" = river AND
-            "ToNode" = tonode_id;
-        tonode_id := fromnode_id;
-        fromsta := tosta;
-    END LOOP;
-END LOOP;
-END;
-$BODY$
-    LANGUAGE plpgsql;
-------------------------------------------------------------------------------------------------------------------------
-SELECT "{0}".from_to_stations ();
-DROP FUNCTION IF EXISTS "{0}".from_to_stations ();
+WITH RECURSIVE reaches AS
+    (SELECT
+        "ReachID",
+        "RiverCode",
+        "FromNode",
+        "ToNode",
+        ST_Length(geom) AS len
+    FROM
+        "{0}"."StreamCenterlines"),
+    stations AS
+    (SELECT
+        r."ReachID",
+        r."RiverCode",
+        r."FromNode",
+        r.len,
+        0::double precision AS fromsta,
+        r.len AS tosta,
+        ARRAY[r."ReachID"] AS path
+    FROM
+        "{0}"."Endpoints" AS e,
+        reaches AS r
+    WHERE
+        r."RiverCode" = e."RiverCode" AND
+        r."ToNode" = e."NodeID"
+    UNION ALL
+    SELECT
+        r."ReachID",
+        r."RiverCode",
+        r."FromNode",
+        r.len,
+        s.tosta,
+        s.tosta + r.len,
+        s.path || r."ReachID"
+    FROM
+        stations AS s,
+        reaches AS r
+    WHERE
+        r."RiverCode" = s."RiverCode" AND
+        r."ToNode" = s."FromNode" AND
+        NOT r."ReachID" = ANY(s.path))
+
+UPDATE
+    "{0}"."StreamCenterlines" AS sc
+SET
+    "ReachLen" = s.len,
+    "FromSta" = s.fromsta,
+    "ToSta" = s.tosta
+FROM
+    stations AS s
+WHERE
+    sc."ReachID" = s."ReachID";
 '''
         qry = qry.format(self.schema)
         return qry
@@ -345,69 +395,64 @@ WHERE
         qry = qry.format(self.schema)
         return qry
 
-    def pg_downstream_reach_lengths(self, line_type='Channel', sort=True):
-        index = ''
-        if sort is True:
-            index = '''
-DROP INDEX IF EXISTS "{0}"."{0}_XSCutLines_order_idx";
-CREATE INDEX "{0}_XSCutLines_order_idx" ON "{0}"."XSCutLines" ("RiverCode", "Station");
-CLUSTER "{0}"."XSCutLines" USING "{0}_XSCutLines_order_idx";
-'''
-            index = index.format(self.schema)
-        else:
-            pass
-        if line_type == 'Left':
-            column = 'LLength'
-        elif line_type == 'Channel':
-            column = 'ChLength'
-        elif line_type == 'Right':
-            column = 'RLength'
-        else:
-            raise ValueError('Invalid line type!')
+    def pg_downstream_reach_lengths(self):
         qry = '''
-CREATE OR REPLACE FUNCTION "{0}".downstream_reach_lengths ()
-    RETURNS VOID AS
-$BODY$
-DECLARE
-    c cursor FOR SELECT * FROM "{0}"."XSCutLines";
-    r "{0}"."XSCutLines"%ROWTYPE;
-    river_code text := '';
-    distance double precision := 0;
-    station double precision := 0;
-    prev_station double precision := 0;
-BEGIN
-FOR r IN c LOOP
-    SELECT
-        (1 - ST_LineLocatePoint(path.geom, ST_Intersection(r.geom, path.geom))) * ST_Length(path.geom)
-    INTO
-        station
+WITH line_types (line_type, short) AS
+    (VALUES
+        ('left', 'l'),
+        ('channel', 'c'),
+        ('right', 'r')),
+    path_stations AS
+    (SELECT
+        xs."XsecID",
+        xs."RiverCode",
+        xs."Station",
+        lt.line_type,
+        st.station
     FROM
-        "{0}"."Flowpaths" AS path
-    WHERE
-        path."LineType" = '{1}' AND
-        ST_Intersects(r.geom, path.geom);
-    distance := station - prev_station;
-    IF river_code <> r."RiverCode" OR distance <= 0 THEN
-        UPDATE "{0}"."XSCutLines" SET
-        "{2}" = 0
-        WHERE CURRENT OF c;
-    ELSE
-        UPDATE "{0}"."XSCutLines" SET
-        "{2}" = distance
-        WHERE CURRENT OF c;
-    END IF;
-    prev_station := station;
-    river_code := r."RiverCode";
-END LOOP;
-END;
-$BODY$
-    LANGUAGE plpgsql;
-------------------------------------------------------------------------------------------------------------------------
-{3}
-SELECT "{0}".downstream_reach_lengths ();
-DROP FUNCTION IF EXISTS "{0}".downstream_reach_lengths ();
+        "{0}"."XSCutLines" AS xs
+        CROSS JOIN line_types AS lt
+        LEFT JOIN LATERAL
+        (SELECT
+            (1 - ST_LineLocatePoint(path.geom, ST_Intersection(xs.geom, path.geom))) * ST_Length(path.geom) AS station
+        FROM
+            "{0}"."Flowpaths" AS path
+        WHERE
+            lower(path."LineType") IN (lt.line_type, lt.short) AND
+            ST_Intersects(xs.geom, path.geom)
+        LIMIT 1) AS st ON TRUE),
+    distances AS
+    (SELECT
+        "XsecID",
+        line_type,
+        CASE
+            WHEN row_number() OVER w = 1 THEN 0
+            WHEN station - lag(station) OVER w <= 0 THEN 0
+            ELSE station - lag(station) OVER w
+        END AS distance
+    FROM
+        path_stations
+    WINDOW w AS (PARTITION BY line_type, "RiverCode" ORDER BY "Station", "XsecID"))
+
+UPDATE "{0}"."XSCutLines" AS xs
+SET
+    "LLength" = d.l_len,
+    "ChLength" = d.ch_len,
+    "RLength" = d.r_len
+FROM
+    (SELECT
+        "XsecID",
+        max(distance) FILTER (WHERE line_type = 'left') AS l_len,
+        max(distance) FILTER (WHERE line_type = 'channel') AS ch_len,
+        max(distance) FILTER (WHERE line_type = 'right') AS r_len
+    FROM
+        distances
+    GROUP BY
+        "XsecID") AS d
+WHERE
+    xs."XsecID" = d."XsecID";
 '''
-        qry = qry.format(self.schema, line_type, column, index)
+        qry = qry.format(self.schema)
         return qry
 
     def pg_surface_points(self):
@@ -800,31 +845,20 @@ WHERE
     def pg_extract_manning(self):
         qry = '''
 ------------------------------------------------------------------------------------------------------------------------
--- Intersect of land use layer with cross section layer  --
-------------------------------------------------------------------------------------------------------------------------
-SELECT
-    "LUID",
-    "LUCode",
-    "N_Value",
-    (ST_Dump(geom)).geom::geometry(POLYGON, {1}) AS geom
-INTO
-    "{0}".ludump
-FROM
-    "{0}"."LanduseAreas";
-
-CREATE INDEX idx_ludump ON "{0}".ludump USING gist(geom);
+-- Intersect of land use tiles with cross section layer  --
 ------------------------------------------------------------------------------------------------------------------------
 WITH inter_xs_dump AS
     (SELECT
         xs."XsecID",
-        lud."N_Value",
-        lud."LUCode",
-        (ST_Dump(ST_Intersection(lud.geom, xs.geom))).geom::geometry(LINESTRING, {1}) AS geom
+        lut."LUID",
+        lut."N_Value",
+        lut."LUCode",
+        (ST_Dump(ST_Intersection(lut.geom, xs.geom))).geom AS geom
     FROM
-        "{0}".ludump AS lud,
+        "{0}"."LanduseTiles" AS lut,
         "{0}"."XSCutLines" AS xs
     WHERE
-        ST_Intersects(lud.geom, xs.geom)),
+        ST_Intersects(lut.geom, xs.geom)),
     single_line AS
     (SELECT
         "XsecID",
@@ -834,14 +868,18 @@ WITH inter_xs_dump AS
     shiftpoints AS
     (SELECT
         "XsecID",
+        "LUID",
         "N_Value",
         "LUCode",
         ST_Line_Interpolate_Point(inter_xs_dump.geom, 0.00005)::geometry(POINT, {1}) AS geom
     FROM
-        inter_xs_dump),
+        inter_xs_dump
+    WHERE
+        ST_GeometryType(inter_xs_dump.geom) = 'ST_LineString'),
     tmpman AS
     (SELECT
          sp."XsecID",
+         sp."LUID",
          sp."N_Value",
          sp."LUCode",
          ST_LineLocatePoint(sl.geom, sp.geom) AS "Fraction"
@@ -849,7 +887,14 @@ WITH inter_xs_dump AS
         single_line AS sl,
         shiftpoints AS sp
     WHERE
-        sl."XsecID" = sp."XsecID")
+        sl."XsecID" = sp."XsecID"),
+    -- consecutive segments from tiles of the same land use polygon give a single change point --
+    changes AS
+    (SELECT
+        *,
+        lag("LUID") OVER (PARTITION BY "XsecID" ORDER BY "Fraction") AS prev_luid
+    FROM
+        tmpman)
 ------------------------------------------------------------------------------------------------------------------------
 -- Creation of table with Manning's coefficients  --
 ------------------------------------------------------------------------------------------------------------------------
@@ -864,18 +909,74 @@ SELECT
     "N_Value",
     "LUCode"
 FROM
-    tmpman
+    changes
+WHERE
+    prev_luid IS DISTINCT FROM "LUID"
 ORDER BY
     "XsecID",
     "Fraction";
-------------------------------------------------------------------------------------------------------------------------
-DROP TABLE "{0}".ludump;
-------------------------------------------------------------------------------------------------------------------------
 '''
         qry = qry.format(self.schema, self.srid)
         return qry
 
 
+class LanduseTiles(HecRasObject):
+    def __init__(self):
+        super(LanduseTiles, self).__init__()
+        self.order = 29
+        self.main = False
+        self.visible = False
+        self.geom_type = 'POLYGON'
+        self.attrs = [
+            ('"TileID"', 'serial primary key'),
+            ('"LUID"', 'integer'),
+            ('"LUCode"', 'text'),
+            ('"N_Value"', 'double precision')]
+
+    def source_hash(self):
+        qry = '''
+    (SELECT
+        md5(COALESCE(string_agg(md5(ST_AsEWKB(geom)::text || ROW("LUID", "LUCode", "N_Value")::text), '' ORDER BY "LUID"), ''))
+    FROM
+        "{0}"."LanduseAreas")'''
+        return qry.format(self.schema)
+
+    def pg_is_current(self):
+        qry = '''
+SELECT
+    COALESCE(obj_description(to_regclass('"{0}"."LanduseTiles"'), 'pg_class') = {1}, FALSE) AS current;
+'''
+        qry = qry.format(self.schema, self.source_hash())
+        return qry
+
+    def pg_subdivide(self, max_vertices=256):
+        qry = '''
+TRUNCATE "{0}"."LanduseTiles";
+
+INSERT INTO "{0}"."LanduseTiles" (geom, "LUID", "LUCode", "N_Value")
+SELECT
+    d.geom,
+    lu."LUID",
+    lu."LUCode",
+    lu."N_Value"
+FROM
+    "{0}"."LanduseAreas" AS lu,
+    ST_Subdivide(lu.geom, {1}) AS t(geom),
+    ST_Dump(t.geom) AS d
+WHERE
+    ST_GeometryType(d.geom) = 'ST_Polygon';
+
+-- tiles are tagged with a hash of land use areas, so they are rebuilt only after the areas change --
+DO $$
+BEGIN
+    EXECUTE format('COMMENT ON TABLE "{0}"."LanduseTiles" IS %L', {2});
+END
+$$;
+'''
+        qry = qry.format(self.schema, max_vertices, self.source_hash())
+        return qry
+
+
 class Manning(HecRasObject):
     def __init__(self):
         super(Manning, self).__init__()
@@ -889,6 +990,18 @@ class Manning(HecRasObject):
             ('"LUCode"', 'text')]
 
 
+class LandcoverClasses(HecRasObject):
+    def __init__(self):
+        super(LandcoverClasses, self).__init__()
+        self.order = 30
+        self.visible = False
+        self.spatial_index = False
+        self.attrs = [
+            ('"ClassValue"', 'integer primary key'),
+            ('"LUCode"', 'text'),
+            ('"N_Value"', 'double precision')]
+
+
 class LeveeAlignment(HecRasObject):
     def __init__(self):
         super(LeveeAlignment, self).__init__()
@@ -1173,75 +1286,33 @@ class LateralStructures(HecRasObject):
 
     def pg_river_reach_names(self):
         qry = '''
-WITH cpnt AS
-    (SELECT
-        geom,
-        "LateralSID",
-        "RiverCode",
-        "ReachCode"
-    FROM
-        (SELECT
-            ST_ClosestPoint(sc.geom, ST_StartPoint(ls.geom))::geometry(POINT, {1}) AS geom,
-            ls."LateralSID",
-            sc."RiverCode",
-            sc."ReachCode",
-            RANK() OVER (PARTITION BY ls."LateralSID" ORDER BY ST_Distance(sc.geom, ST_StartPoint(ls.geom))) AS rnk
-        FROM
-            "{0}"."StreamCenterlines" AS sc,
-            "{0}"."LateralStructures" AS ls
-        ORDER BY
-            ls."LateralSID") AS pnt
-    WHERE
-        rnk = 1)
-
 UPDATE "{0}"."LateralStructures" AS ls
 SET
-   "RiverCode" = cpnt."RiverCode",
-   "ReachCode" = cpnt."ReachCode"
+   "RiverCode" = nn."RiverCode",
+   "ReachCode" = nn."ReachCode"
 FROM
-    cpnt
+    "{0}"."LateralStructures" AS l
+    {1}
 WHERE
-   ls."LateralSID" = cpnt."LateralSID";
+   ls."LateralSID" = l."LateralSID";
 '''
-        qry = qry.format(self.schema, self.srid)
+        nearest = self.nearest_feature('StreamCenterlines', 'ST_StartPoint(l.geom)', ['"RiverCode"', '"ReachCode"'])
+        qry = qry.format(self.schema, nearest)
         return qry
 
     def pg_stationing(self):
         qry = '''
-WITH cpnt AS
-    (SELECT
-        geom,
-        "LateralSID",
-        "ReachCode",
-         ("ToSta"-"FromSta") AS "Length",
-         "FromSta"
-    FROM
-        (SELECT
-            ST_ClosestPoint(sc.geom, ST_StartPoint(ls.geom))::geometry(POINT, {1}) AS geom,
-            ls."LateralSID",
-            sc."ReachCode",
-            sc."FromSta",
-            sc."ToSta",
-            RANK() OVER (PARTITION BY ls."LateralSID" ORDER BY ST_Distance(sc.geom, ST_StartPoint(ls.geom))) AS rnk
-        FROM
-            "{0}"."StreamCenterlines" AS sc,
-            "{0}"."LateralStructures" AS ls
-        ORDER BY
-            ls."LateralSID") AS pnt
-    WHERE
-        rnk = 1)
-
 UPDATE "{0}"."LateralStructures" AS ls
 SET
-   "Station" = cpnt."Length"*(1-ST_Line_Locate_Point(sc.geom, cpnt.geom)) + cpnt."FromSta"
+   "Station" = (nn."ToSta" - nn."FromSta") * (1 - ST_Line_Locate_Point(nn.geom, ST_ClosestPoint(nn.geom, ST_StartPoint(l.geom)))) + nn."FromSta"
 FROM
-    cpnt,
-    "{0}"."StreamCenterlines" AS sc
+    "{0}"."LateralStructures" AS l
+    {1}
 WHERE
-    ls."LateralSID" = cpnt."LateralSID" AND
-    sc."ReachCode" = cpnt."ReachCode";
+    ls."LateralSID" = l."LateralSID";
 '''
-        qry = qry.format(self.schema, self.srid)
+        nearest = self.nearest_feature('StreamCenterlines', 'ST_StartPoint(l.geom)', ['geom', '"FromSta"', '"ToSta"'])
+        qry = qry.format(self.schema, nearest)
         return qry
 
     def pg_surface_points(self):
@@ -1315,137 +1386,6 @@ class StorageAreas(HecRasObject):
             ('"UserElev"', 'double precision'),
             ('"DtmID"', 'integer')]
 
-    def pg_surface_points(self):
-        qry = '''
-CREATE OR REPLACE FUNCTION "{0}".point_grid ()
-    RETURNS VOID AS
-$BODY$
-DECLARE
-    c cursor FOR SELECT * FROM "{0}"."StorageAreas";
-    r "{0}"."StorageAreas"%ROWTYPE;
-    x double precision;
-    y double precision;
-    pnt geometry;
-    inside boolean;
-    sa_id integer;
-    row_nr integer;
-    col_nr integer;
-    cellsize double precision;
-    min_x double precision;
-    max_x double precision;
-    min_y double precision;
-    max_y double precision;
-BEGIN
-    FOR r IN c LOOP
-        SELECT dtm."CellSize" INTO cellsize FROM "{0}"."DTMs" AS dtm WHERE dtm."DtmID" = r."DtmID";
-        min_x := ST_Xmin(ST_Extent(r.geom));
-        max_x := ST_Xmax(ST_Extent(r.geom));
-        min_y := ST_Ymin(ST_Extent(r.geom));
-        max_y := ST_Ymax(ST_Extent(r.geom));
-        row_nr := ceiling((max_x - min_x) / cellsize);
-        col_nr := ceiling((max_y - min_y) / cellsize);
-        x := min_x;
-        FOR i IN 1..row_nr LOOP
-            y := min_y;
-            FOR j IN 1..col_nr LOOP
-                pnt := (ST_SetSRID(ST_Point(x, y), {1}));
-                SELECT ST_Within(pnt, r.geom), r."StorageID" INTO inside, sa_id WHERE ST_Within(pnt, r.geom) IS True;
-                IF inside IS True THEN
-                    INSERT INTO "{0}"."SASurface"(geom, "StorageID")
-                    VALUES (pnt, sa_id);
-                END IF;
-                y := y + cellsize;
-            END LOOP;
-            x := x + cellsize;
-        END LOOP;
-    END LOOP;
-END;
-$BODY$
-    LANGUAGE plpgsql;
-
-
-SELECT "{0}".point_grid ();
-ALTER TABLE "{0}"."SASurface" ADD COLUMN "PtID" bigserial primary key;
-'''
-        qry = qry.format(self.schema, self.srid)
-        return qry
-
-    def pg_maxmin(self):
-        qry = '''
-WITH data AS
-    (SELECT
-        "StorageID",
-        MAX("Elevation"),
-        MIN("Elevation")
-    FROM
-        "{0}"."SASurface"
-    GROUP BY
-        "StorageID")
-UPDATE "{0}"."StorageAreas" AS sa
-SET
-    "MaxElev" = data.max,
-    "MinElev" = data.min
-FROM
-    data
-WHERE
-    sa."StorageID" = data."StorageID";
-'''
-        qry = qry.format(self.schema)
-        return qry
-
-    def pg_storage_calculator(self, slices=10):
-        qry = '''
-CREATE OR REPLACE FUNCTION "{0}".storage_calculator (slices integer)
-    RETURNS VOID AS
-$BODY$
-DECLARE
-    c cursor FOR SELECT * FROM "{0}"."StorageAreas";
-    r "{0}"."StorageAreas"%ROWTYPE;
-    area double precision;
-    emin double precision;
-    emax double precision;
-    h double precision;
-    lev double precision;
-    vol double precision;
-BEGIN
-    FOR r IN c LOOP
-        area := (SELECT dtm."CellSize" FROM "{0}"."DTMs" AS dtm WHERE dtm."DtmID" = r."DtmID")^2;
-        emin := (SELECT MIN("Elevation") FROM "{0}"."SASurface" WHERE "StorageID" = r."StorageID");
-        emax := (SELECT CASE WHEN r."UserElev" IS NULL THEN MAX("Elevation") ELSE r."UserElev" END FROM "{0}"."SASurface" WHERE "StorageID" = r."StorageID");
-        h := (emax-emin)/slices;
-        lev := emin+h;
-        vol := 0;
-        INSERT INTO "{0}"."SAVolume" VALUES (r."StorageID", emin, vol);
-        FOR i IN 1..slices LOOP
-            vol := vol + (SELECT COUNT("Elevation")*area*h FROM "{0}"."SASurface" WHERE "StorageID" = r."StorageID" AND "Elevation" <= lev+h);
-            INSERT INTO "{0}"."SAVolume" ("StorageID", "level", "volume")
-            SELECT r."StorageID", lev, vol;
-            lev := lev+h;
-        END LOOP;
-    END LOOP;
-END;
-$BODY$
-    LANGUAGE plpgsql;
-
-
-SELECT "{0}".storage_calculator ({1});
-'''
-        qry = qry.format(self.schema, slices)
-        return qry
-
-
-class SASurface(HecRasObject):
-    def __init__(self):
-        super(SASurface, self).__init__()
-        self.order = 25
-        self.main = False
-        self.visible = False
-        self.spatial_index = False
-        self.geom_type = 'POINT'
-        self.attrs = [
-            ('"StorageID"', 'integer'),
-            ('"Elevation"', 'double precision')]
-
 
 class SAVolume(HecRasObject):
     def __init__(self):
@@ -1474,20 +1414,20 @@ class SAConnections(HecRasObject):
 
     def pg_assign_nearest_sa(self):
         qry = '''
-WITH distances AS
-    (SELECT
-        "StorageID",
-        ST_Distance(sa.geom, ST_StartPoint(sac.geom)) AS usdist,
-        ST_Distance(sa.geom, ST_EndPoint(sac.geom)) AS dsdist
-    FROM
-        "{0}"."StorageAreas" AS sa,
-        "{0}"."SAConnections" AS sac)
-UPDATE "{0}"."SAConnections"
+UPDATE "{0}"."SAConnections" AS sac
 SET
-    "USSA" = (SELECT "StorageID" FROM distances ORDER BY usdist LIMIT 1),
-    "DSSA" = (SELECT "StorageID" FROM distances ORDER BY dsdist LIMIT 1)
+    "USSA" = us."StorageID",
+    "DSSA" = ds."StorageID"
+FROM
+    "{0}"."SAConnections" AS c
+    {1}
+    {2}
+WHERE
+    sac."SAConnID" = c."SAConnID";
 '''
-        qry = qry.format(self.schema)
+        us = self.nearest_feature('StorageAreas', 'ST_StartPoint(c.geom)', ['"StorageID"'], 'us')
+        ds = self.nearest_feature('StorageAreas', 'ST_EndPoint(c.geom)', ['"StorageID"'], 'ds')
+        qry = qry.format(self.schema, us, ds)
         return qry
 
     def pg_surface_points(self):
@@ -1611,7 +1551,7 @@ FROM
         qry = qry.format(self.schema)
         return qry
 
-    def pg_breaklines_m(self):
+    def pg_breaklines_m(self, area_ids=None):
         qry = '''
 DROP TABLE IF EXISTS "{0}"."BreakLines2d_m";
 
@@ -1636,26 +1576,11 @@ SELECT
     "RowsAligned",
     (ST_Dump(ST_AddMeasure(geom, 0, ST_Length(geom)))).geom
 FROM
-    "{0}"."BreakLines2d";
-'''
-        qry = qry.format(self.schema, self.srid)
-        return qry
-
-    def pg_drop_by_buffer(self):
-        qry = '''
-WITH brbuf AS
-    (SELECT
-        ST_Buffer(geom, "RowsAligned" * "CellSizeAcross" + "CellSizeAlong" * 0.2, \'endcap=flat join=round\') AS geom
-    FROM
-        "{0}"."BreakLines2d_m")
-DELETE FROM
-    "{0}"."MeshPoints2d" AS p
-USING
-    brbuf
+    "{0}"."BreakLines2d"
 WHERE
-    ST_Intersects(brbuf.geom, p.geom);
+    {2};
 '''
-        qry = qry.format(self.schema)
+        qry = qry.format(self.schema, self.srid, self.area_filter(area_ids))
         return qry
 
 
@@ -1672,6 +1597,11 @@ class BreakPoints2d(HecRasObject):
 
     def pg_bpoints_along_blines(self, tolerance=None, func_name=None):
         qry = '''
+UPDATE
+    "{0}"."BreakPoints2d"
+SET
+    "BLmID" = NULL;
+
 WITH ids AS
     (SELECT
         b."BLmID",
@@ -1719,108 +1649,214 @@ class MeshPoints2d(HecRasObject):
             ('"BLID"', 'integer'),
             ('"CellSize"', 'double precision')]
 
-    def pg_create_mesh(self):
+
+class FeatureHashes(HecRasObject):
+    def __init__(self):
+        super(FeatureHashes, self).__init__()
+        self.order = -7
+        self.main = False
+        self.visible = False
+        self.spatial_index = False
+        self.attrs = [
+            ('"Source"', 'text'),
+            ('"FeatureID"', 'integer'),
+            ('"AreaID"', 'integer'),
+            ('"Hash"', 'text')]
+
+    def current_hashes(self, breaklines=False, breakpoints=False):
         qry = '''
-CREATE OR REPLACE FUNCTION "{0}".makegrid(geometry, float, integer)
-    RETURNS geometry AS
-$BODY$
     SELECT
-        ST_Collect(ST_SetSRID(ST_POINT(x/1000000::float, y/1000000::float), $3))
+        'FlowAreas2d' AS "Source",
+        "AreaID" AS "FeatureID",
+        "AreaID",
+        md5(ST_AsEWKB(geom)::text || ROW("CellSize")::text) AS "Hash"
     FROM
-        generate_series(floor(st_xmin($1)*1000000)::bigint, ceiling(st_xmax($1)*1000000)::bigint, ($2*1000000)::bigint) AS x,
-        generate_series(floor(st_ymin($1)*1000000)::bigint, ceiling(st_ymax($1)*1000000)::bigint, ($2*1000000)::bigint) AS y
-    WHERE
-        ST_Intersects($1, ST_SetSRID(ST_POINT(x/1000000::float, y/1000000::float), $3))
-$BODY$
-    LANGUAGE sql;
-
-------------------------------------------------------------------------------------------------------------------------
-INSERT INTO
-    "{0}"."MeshPoints2d" ("AreaID", "BLID", geom)
-SELECT
-    "AreaID",
-    -1,
-    (ST_Dump("{0}".makegrid(geom, "CellSize", {1}))).geom AS geom
-FROM
-    "{0}"."FlowAreas2d";
+        "{0}"."FlowAreas2d"'''
+        if breaklines is True:
+            qry += '''
+    UNION ALL
+    SELECT
+        'BreakLines2d',
+        "BLID",
+        "AreaID",
+        md5(ST_AsEWKB(geom)::text || ROW("CellSizeAlong", "CellSizeAcross", "RowsAligned")::text)
+    FROM
+        "{0}"."BreakLines2d"'''
+        else:
+            pass
+        if breakpoints is True:
+            qry += '''
+    UNION ALL
+    SELECT
+        'BreakPoints2d',
+        p."BPID",
+        a."AreaID",
+        md5(ST_AsEWKB(p.geom)::text)
+    FROM
+        "{0}"."BreakPoints2d" AS p
+        LEFT JOIN "{0}"."FlowAreas2d" AS a ON ST_DWithin(a.geom, p.geom, 10)'''
+        else:
+            pass
+        return qry.format(self.schema)
 
-WITH areas2dshrinked AS
+    def pg_changed_areas(self, breaklines=False, breakpoints=False):
+        qry = '''
+WITH cur AS
+    ({1}),
+    old AS
     (SELECT
+        "Source",
+        "FeatureID",
         "AreaID",
-        ST_Buffer(a2d.geom, -0.3 * a2d."CellSize") AS geom
+        "Hash"
     FROM
-        "{0}"."FlowAreas2d" AS a2d)
-DELETE FROM
-    "{0}"."MeshPoints2d" AS pts_a
+        "{0}"."FeatureHashes"),
+    changed AS
+    ((SELECT * FROM cur EXCEPT SELECT * FROM old)
+    UNION ALL
+    (SELECT * FROM old EXCEPT SELECT * FROM cur))
+SELECT DISTINCT
+    "AreaID"
+FROM
+    changed
 WHERE
-    pts_a."MPID" NOT IN
-        (SELECT
-            pts."MPID"
-        FROM
-            "{0}"."MeshPoints2d" AS pts,
-            areas2dshrinked
-        WHERE
-            ST_Intersects(pts.geom, areas2dshrinked.geom));
+    "AreaID" IS NOT NULL
+ORDER BY
+    "AreaID";
+'''
+        qry = qry.format(self.schema, self.current_hashes(breaklines, breakpoints))
+        return qry
 
-DROP FUNCTION IF EXISTS "{0}".makegrid(geometry, float, integer);
+    def pg_store_hashes(self, breaklines=False, breakpoints=False):
+        qry = '''
+INSERT INTO "{0}"."FeatureHashes" ("Source", "FeatureID", "AreaID", "Hash")
+{1};
 '''
-        qry = qry.format(self.schema, self.srid)
+        qry = qry.format(self.schema, self.current_hashes(breaklines, breakpoints))
         return qry
 
-    def pg_aligned_mesh(self, cellsize=None, measure=None, offset=None, blid=None):
+
+class MeshCells2d(HecRasObject):
+    def __init__(self):
+        super(MeshCells2d, self).__init__()
+        self.order = -8
+        self.main = False
+        self.geom_type = 'MULTIPOLYGON'
+        self.attrs = [
+            ('"MPID"', 'integer primary key'),
+            ('"AreaID"', 'integer'),
+            ('"DtmID"', 'integer'),
+            ('"MinElev"', 'double precision'),
+            ('"MaxElev"', 'double precision')]
+
+    def pg_voronoi_cells(self):
         qry = '''
-INSERT INTO
-    "{0}"."MeshPoints2d" ("BLID", "AreaID", "CellSize", geom)
-SELECT
-    "BLmID",
-    "AreaID",
-    {1},
-    ST_Centroid(ST_LocateAlong(geom, {2}, {3}))
+WITH dump AS
+    (SELECT
+        "AreaID",
+        ST_Dump(ST_VoronoiPolygons(ST_Collect(geom))) AS d
+    FROM
+        "{0}"."MeshPoints2d"
+    GROUP BY
+        "AreaID"),
+    cells AS
+    (SELECT
+        "AreaID",
+        (d).path[1] AS cell,
+        (d).geom AS geom
+    FROM
+        dump)
+-- coincident points share one Voronoi cell, only the lowest MPID keeps it --
+INSERT INTO "{0}"."MeshCells2d" ("MPID", "AreaID", geom)
+SELECT DISTINCT ON (c."AreaID", c.cell)
+    p."MPID",
+    a."AreaID",
+    ST_Multi(ST_CollectionExtract(ST_Intersection(c.geom, a.geom), 3))
 FROM
-    "{0}"."BreakLines2d_m"
-WHERE
-    "BLmID" = {4};
+    cells AS c
+    JOIN "{0}"."FlowAreas2d" AS a ON a."AreaID" = c."AreaID"
+    JOIN "{0}"."MeshPoints2d" AS p ON p."AreaID" = c."AreaID" AND ST_Contains(c.geom, p.geom)
+ORDER BY
+    c."AreaID",
+    c.cell,
+    p."MPID";
+'''
+        qry = qry.format(self.schema)
+        return qry
 
-INSERT INTO
-    "{0}"."MeshPoints2d" ("BLID", "AreaID", "CellSize", geom)
+
+class CellVolumes2d(HecRasObject):
+    def __init__(self):
+        super(CellVolumes2d, self).__init__()
+        self.order = -9
+        self.main = False
+        self.visible = False
+        self.spatial_index = False
+        self.attrs = [
+            ('"MPID"', 'integer'),
+            ('"Elevation"', 'double precision'),
+            ('"Volume"', 'double precision'),
+            ('"Area"', 'double precision')]
+
+
+class CellFaces2d(HecRasObject):
+    def __init__(self):
+        super(CellFaces2d, self).__init__()
+        self.order = -10
+        self.main = False
+        self.geom_type = 'LINESTRING'
+        self.attrs = [
+            ('"FaceID"', 'serial primary key'),
+            ('"AreaID"', 'integer'),
+            ('"CellA"', 'integer'),
+            ('"CellB"', 'integer'),
+            ('"DtmID"', 'integer'),
+            ('"MinElev"', 'double precision')]
+
+    def pg_cell_faces(self):
+        qry = '''
+WITH faces AS
+    (SELECT
+        a."AreaID",
+        a."MPID" AS cell_a,
+        b."MPID" AS cell_b,
+        (ST_Dump(ST_LineMerge(ST_CollectionExtract(ST_Intersection(a.geom, b.geom), 2)))).geom AS geom
+    FROM
+        "{0}"."MeshCells2d" AS a,
+        "{0}"."MeshCells2d" AS b
+    WHERE
+        a."AreaID" = b."AreaID" AND
+        a."MPID" < b."MPID" AND
+        ST_Intersects(a.geom, b.geom))
+INSERT INTO "{0}"."CellFaces2d" ("AreaID", "CellA", "CellB", geom)
 SELECT
-    "BLmID",
     "AreaID",
-    {1},
-    ST_Centroid(ST_LocateAlong(geom, {2}, -{3}))
+    cell_a,
+    cell_b,
+    geom
 FROM
-    "{0}"."BreakLines2d_m"
+    faces
 WHERE
-    "BLmID" = {4};
+    ST_Length(geom) > 0
+ORDER BY
+    cell_a,
+    cell_b;
 '''
-        qry = qry.format(self.schema, cellsize, measure, offset, blid)
+        qry = qry.format(self.schema)
         return qry
 
-    def pg_clean_points(self):
-        qry = '''
-DELETE FROM
-    "{0}"."MeshPoints2d" AS p1
-USING
-    "{0}"."MeshPoints2d" AS p2
-WHERE
-    p1."BLID" <> -1 AND
-    p2."BLID" <> -1 AND
-    p1."BLID" <> p2."BLID" AND
-    p1."MPID" > p2."MPID" AND
-    ST_DWithin(p1.geom, p2.geom, 0.75 * LEAST(p1."CellSize", p2."CellSize"));
-
-DELETE FROM
-    "{0}"."MeshPoints2d" AS p
-USING
-    "{0}"."FlowAreas2d" AS a
-WHERE
-    a."AreaID" = p."AreaID" AND
-    NOT ST_Contains(ST_Buffer(a.geom, -0.3*a."CellSize"), p.geom);
 
-DROP TABLE IF EXISTS "{0}"."BreakLines2d_m";
-'''
-        qry = qry.format(self.schema)
-        return qry
+class FaceProfiles2d(HecRasObject):
+    def __init__(self):
+        super(FaceProfiles2d, self).__init__()
+        self.order = -11
+        self.main = False
+        self.visible = False
+        self.spatial_index = False
+        self.attrs = [
+            ('"FaceID"', 'integer'),
+            ('"Station"', 'double precision'),
+            ('"Elevation"', 'double precision')]
 
 
 class Bathymetry(HecRasObject):
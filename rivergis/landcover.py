@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                 : RiverGIS
+Description          : HEC-RAS tools for QGIS
+Date                 : December, 2015
+copyright            : (C) 2015 by RiverGIS Group
+email                : rpasiok@gmail.com, damnback333@gmail.com
+***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .cell_properties import face_stations
+from .mesh2d import wkb_coords, locate_along
+from .rasElevations import sample_DTM
+from .raster_sampler import RasterSampler
+
+
+def change_points(line_ids, stations, lengths, classes):
+    """
+    Manning's n change points along lines sampled at stations. A change point is created at the start of each line
+    and halfway between two consecutive samples of different classes. Samples without a class are skipped.
+
+    Args:
+        line_ids (numpy.ndarray): Line ids of samples ordered by line and station.
+        stations (numpy.ndarray): Stations of samples.
+        lengths (numpy.ndarray): Lengths of lines of samples.
+        classes (numpy.ndarray): Land cover classes of samples (NaN if missing).
+
+    Returns:
+        tuple: Arrays of line ids, fractions and classes of change points.
+    """
+    valid = ~np.isnan(classes)
+    line_ids = line_ids[valid]
+    stations = stations[valid]
+    lengths = lengths[valid]
+    classes = classes[valid]
+    first = np.r_[True, line_ids[1:] != line_ids[:-1]]
+    change = first | np.r_[True, classes[1:] != classes[:-1]]
+    prev = np.r_[0, stations[:-1]]
+    fractions = np.where(first, 0, (prev + stations) / 2 / lengths)
+    return line_ids[change], fractions[change], classes[change]
+
+
+def landcover_classes(rgis):
+    """
+    Land cover classes lookup (ClassValue, LUCode, N_Value) ordered by class values.
+
+    Returns:
+        list: Rows of the LandcoverClasses table.
+    """
+    qry = 'SELECT "ClassValue", "LUCode", "N_Value" FROM "{0}"."LandcoverClasses" ORDER BY "ClassValue";'
+    return rgis.rdb.run_query(qry.format(rgis.rdb.SCHEMA), fetch=True) or []
+
+
+def landcover_manning(rgis, rlayer, lookup, workers=None):
+    """
+    Extracting Manning's n values for cross-sections from a classified land cover raster. Cross-sections are sampled
+    at raster cell size spacing, samples are read in raster tiles by worker threads and classes are mapped to
+    n values through the LandcoverClasses table. Change points are written into the Manning table.
+
+    Args:
+        rlayer (QgsRasterLayer): Land cover raster layer.
+        lookup (list): Land cover classes returned by landcover_classes.
+        workers (int): Number of worker threads.
+
+    Returns:
+        int/None: Number of written change points or None if writing failed.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    class_values = np.array([row['ClassValue'] for row in lookup], dtype=np.float64)
+
+    qry = '''
+SELECT
+    "XsecID",
+    ST_AsBinary(ST_Force2D(ST_GeometryN(geom, 1)), 'NDR') AS wkb
+FROM
+    "{0}"."XSCutLines"
+ORDER BY
+    "XsecID";
+'''
+    lines = rgis.rdb.run_query(qry.format(rgis.rdb.SCHEMA), fetch=True) or []
+    sampler = RasterSampler.from_layer(rlayer)
+    step = min(sampler.dx, sampler.dy)
+    line_ids = []
+    stations = []
+    lengths = []
+    points = []
+    for line in lines:
+        coords = wkb_coords(line['wkb'])
+        st = face_stations(coords, step)
+        line_ids.append(np.full(st.size, line['XsecID'], dtype=np.int64))
+        stations.append(st)
+        lengths.append(np.full(st.size, st[-1]))
+        points.append(locate_along(coords, st, [0.])[:, 0, :])
+    if not points:
+        return 0
+    line_ids = np.concatenate(line_ids)
+    stations = np.concatenate(stations)
+    lengths = np.concatenate(lengths)
+    points = np.vstack(points)
+
+    values = np.full(stations.size, np.nan)
+    pt_ids = np.arange(stations.size)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for idx in sampler.split_by_tiles(points[:, 0], points[:, 1], workers):
+            provider = rlayer.dataProvider().clone()
+            futures.append(executor.submit(sample_DTM, provider, pt_ids[idx], points[idx, 0], points[idx, 1]))
+        for future in futures:
+            ids, vals = future.result()
+            values[ids] = vals
+
+    # classes missing in the lookup table are treated as no data
+    pos = np.clip(np.searchsorted(class_values, values), 0, class_values.size - 1)
+    classes = np.where(class_values[pos] == values, pos, np.nan)
+    ids, fractions, classes = change_points(line_ids, stations, lengths, classes)
+    rows = []
+    for xsec_id, fraction, cls in zip(ids.tolist(), fractions.tolist(), classes.astype(np.int64).tolist()):
+        rows.append((xsec_id, fraction, lookup[cls]['N_Value'], lookup[cls]['LUCode']))
+    return rgis.rdb.copy_rows('Manning', ['"XsecID"', '"Fraction"', '"N_Value"', '"LUCode"'], rows)
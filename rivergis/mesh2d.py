@@ -0,0 +1,620 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                 : RiverGIS
+Description          : HEC-RAS tools for QGIS
+Date                 : December, 2015
+copyright            : (C) 2015 by RiverGIS Group
+email                : rpasiok@gmail.com, damnback333@gmail.com
+***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .hecobjects import HecRasObject
+
+
+def wkb_coords(wkb):
+    """
+    Coordinates of a 2D LINESTRING given as little-endian (NDR) WKB.
+
+    Args:
+        wkb (bytes/memoryview): Geometry WKB.
+
+    Returns:
+        numpy.ndarray: Array of shape (n, 2) with vertex coordinates.
+    """
+    return np.frombuffer(bytes(wkb), dtype='<f8', offset=9).reshape(-1, 2)
+
+
+def wkb_rings(wkb):
+    """
+    Rings of a POLYGON or MULTIPOLYGON given as little-endian (NDR) 2D WKB.
+
+    Args:
+        wkb (bytes/memoryview): Geometry WKB.
+
+    Returns:
+        list: List of arrays of shape (n, 2) with ring vertices.
+    """
+    data = bytes(wkb)
+    rings = []
+
+    def polygon(offset):
+        nrings = struct.unpack_from('<I', data, offset + 5)[0]
+        offset += 9
+        for i in range(nrings):
+            npts = struct.unpack_from('<I', data, offset)[0]
+            offset += 4
+            rings.append(np.frombuffer(data, dtype='<f8', count=npts * 2, offset=offset).reshape(-1, 2))
+            offset += 16 * npts
+        return offset
+
+    if struct.unpack_from('<I', data, 1)[0] == 6:
+        npolys = struct.unpack_from('<I', data, 5)[0]
+        offset = 9
+        for i in range(npolys):
+            offset = polygon(offset)
+    else:
+        polygon(0)
+    return rings
+
+
+def ewkt_point(srid, x, y):
+    return 'SRID={0};POINT({1:.17g} {2:.17g})'.format(srid, x, y)
+
+
+def get_breaklines_m(rgis):
+    """
+    Reading measured breaklines.
+
+    Returns:
+        dict: BLmID as key and tuple (AreaID, vertex coordinates array) as value.
+    """
+    qry = '''
+SELECT
+    "BLmID",
+    "AreaID",
+    ST_AsBinary(ST_Force2D(geom), 'NDR') AS wkb
+FROM
+    "{0}"."BreakLines2d_m";
+'''
+    qry = qry.format(rgis.rdb.SCHEMA)
+    lines = {}
+    for row in rgis.rdb.run_query(qry, fetch=True) or []:
+        lines[row['BLmID']] = (row['AreaID'], wkb_coords(row['wkb']))
+    return lines
+
+
+def locate_along(coords, measures, offsets):
+    """
+    Points located along a line at given measures (distances from the line start) and offset perpendicularly
+    to the left (positive offsets) or to the right (negative offsets) of the line.
+    It is equivalent of ST_Centroid(ST_LocateAlong(geom, measure, offset)) for a line measured with its length,
+    so points at vertices are averaged over both neighbouring segments.
+
+    Args:
+        coords (numpy.ndarray): Line vertices of shape (n, 2).
+        measures (numpy.ndarray): Measures along the line.
+        offsets (numpy.ndarray): Perpendicular offsets.
+
+    Returns:
+        numpy.ndarray: Array of shape (len(measures), len(offsets), 2) with points coordinates.
+    """
+    measures = np.asarray(measures, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.float64)
+    d = np.diff(coords, axis=0)
+    seglen = np.hypot(d[:, 0], d[:, 1])
+    valid = seglen > 0
+    starts = coords[:-1][valid]
+    d = d[valid]
+    seglen = seglen[valid]
+    nseg = seglen.size
+    if nseg == 0:
+        return np.empty((0, offsets.size, 2))
+    cum = np.r_[0, np.cumsum(seglen)]
+    normals = np.column_stack((-d[:, 1], d[:, 0])) / seglen[:, None]
+
+    def along(seg):
+        frac = (measures - cum[seg]) / seglen[seg]
+        base = starts[seg] + frac[:, None] * d[seg]
+        return base[:, None, :] + offsets[None, :, None] * normals[seg][:, None, :]
+
+    seg_before = np.clip(np.searchsorted(cum, measures, 'left') - 1, 0, nseg - 1)
+    seg_after = np.clip(np.searchsorted(cum, measures, 'right') - 1, 0, nseg - 1)
+    return (along(seg_before) + along(seg_after)) / 2
+
+
+def aligned_offsets(width, rows):
+    """
+    Perpendicular offsets of aligned mesh rows, alternately on the left and on the right side of a breakline.
+    """
+    offs = np.arange(rows) * width + width / 2
+    return np.column_stack((offs, -offs)).ravel()
+
+
+def polygon_edges(rings):
+    """
+    Non-horizontal edges of polygon rings.
+
+    Returns:
+        numpy.ndarray: Array of shape (n, 4) with edge start and end coordinates.
+    """
+    if not rings:
+        return np.empty((0, 4))
+    edges = np.vstack([np.hstack((ring[:-1], ring[1:])) for ring in rings])
+    return edges[edges[:, 1] != edges[:, 3]]
+
+
+def scanline(edges, ids, x0, y0, cellsize, band=256):
+    """
+    Generator of regular grid cells (nodes) located inside polygons. Grid rows are intersected with polygon edges
+    (scanline, even-odd rule), so no point-in-polygon test is run for single points.
+    Edges of many polygons can be processed at once, each polygon having its own id.
+
+    Args:
+        edges (numpy.ndarray): Polygon edges returned by polygon_edges.
+        ids (numpy.ndarray): Polygon ids of edges.
+        x0 (float): X coordinate of the grid origin.
+        y0 (float): Y coordinate of the grid origin.
+        cellsize (float): Grid spacing.
+        band (int): Number of grid rows processed at once.
+
+    Yields:
+        tuple: Arrays of polygon ids, column and row numbers of grid nodes inside polygons for a band of grid rows.
+    """
+    if edges.size == 0:
+        return
+    ex0, ey0, ex1, ey1 = edges.T
+    ylo = np.minimum(ey0, ey1)
+    yhi = np.maximum(ey0, ey1)
+    # rows crossed by edges, widened by one row and filtered by the exact half-open rule below
+    jlo = np.floor((ylo - y0) / cellsize).astype(np.int64)
+    jhi = np.ceil((yhi - y0) / cellsize).astype(np.int64) + 1
+    for start in range(int(jlo.min()), int(jhi.max()), band):
+        lo = np.maximum(jlo, start)
+        cnt = np.clip(np.minimum(jhi, start + band) - lo, 0, None)
+        total = int(cnt.sum())
+        if total == 0:
+            continue
+        e = np.repeat(np.arange(cnt.size), cnt)
+        rows = lo[e] + np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        y = y0 + rows * cellsize
+        hit = (ylo[e] <= y) & (y < yhi[e])
+        e = e[hit]
+        rows = rows[hit]
+        y = y[hit]
+        x = ex0[e] + (y - ey0[e]) * (ex1[e] - ex0[e]) / (ey1[e] - ey0[e])
+        order = np.lexsort((x, rows, ids[e]))
+        x = x[order]
+        rows = rows[order]
+        pids = ids[e][order]
+        # consecutive crossings in a row of a polygon bound the inside intervals
+        kmin = np.ceil((x[0::2] - x0) / cellsize).astype(np.int64)
+        kmax = np.floor((x[1::2] - x0) / cellsize).astype(np.int64)
+        cnt = np.clip(kmax - kmin + 1, 0, None)
+        total = int(cnt.sum())
+        if total == 0:
+            continue
+        cols = np.repeat(kmin, cnt) + np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        yield np.repeat(pids[0::2], cnt), cols, np.repeat(rows[0::2], cnt)
+
+
+def grid_cells(rings, x0, y0, cellsize, band=256):
+    """
+    Generator of regular grid cells (nodes) located inside a polygon.
+
+    Yields:
+        tuple: Arrays of column and row numbers of grid nodes inside the polygon for a band of grid rows.
+    """
+    edges = polygon_edges(rings)
+    for ids, cols, rows in scanline(edges, np.zeros(edges.shape[0], dtype=np.int64), x0, y0, cellsize, band):
+        yield cols, rows
+
+
+def grid_in_polygon(rings, x0, y0, cellsize):
+    """
+    Column and row numbers of all regular grid nodes located inside a polygon.
+
+    Returns:
+        tuple: Arrays of column and row numbers.
+    """
+    bands = list(grid_cells(rings, x0, y0, cellsize))
+    if not bands:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate([b[0] for b in bands]), np.concatenate([b[1] for b in bands])
+
+
+def get_flow_areas(rgis, area_ids=None, breaklines=False):
+    """
+    Reading 2D flow areas for mesh generation. Areas are shrunk by 0.3 of their cell size,
+    so points too close to the area boundary are never created.
+
+    Args:
+        area_ids (list): Ids of areas to be read. All areas are read if None.
+        breaklines (bool): Flag for reading union of buffers of breaklines (BreakLines2d_m) close to each area.
+
+    Returns:
+        list: List of rows with area id, cell size, grid origin, shrunk polygon WKB and breaklines buffer WKB.
+    """
+    qry = '''
+SELECT
+    a."AreaID",
+    a."CellSize",
+    floor(ST_XMin(a.geom) * 1000000) / 1000000 AS x0,
+    floor(ST_YMin(a.geom) * 1000000) / 1000000 AS y0,
+    ST_AsBinary(ST_Force2D(ST_Multi(ST_Buffer(a.geom, -0.3 * a."CellSize"))), 'NDR') AS wkb,
+    {2} AS buffer_wkb
+FROM
+    "{0}"."FlowAreas2d" AS a
+WHERE
+    a."CellSize" > 0 AND
+    {1}
+ORDER BY
+    a."AreaID";
+'''
+    if breaklines is True:
+        buffers = '''(SELECT
+        ST_AsBinary(ST_Force2D(ST_Multi(ST_Union(
+            ST_Buffer(b.geom, b."RowsAligned" * b."CellSizeAcross" + b."CellSizeAlong" * 0.2, 'endcap=flat join=round')))), 'NDR')
+    FROM
+        "{0}"."BreakLines2d_m" AS b
+    WHERE
+        ST_DWithin(b.geom, a.geom, b."RowsAligned" * b."CellSizeAcross" + b."CellSizeAlong" * 0.2))'''
+        buffers = buffers.format(rgis.rdb.SCHEMA)
+    else:
+        buffers = 'NULL::bytea'
+    qry = qry.format(rgis.rdb.SCHEMA, HecRasObject.area_filter(area_ids, 'a."AreaID"'), buffers)
+    return rgis.rdb.run_query(qry, fetch=True) or []
+
+
+def close_points(ids, blids, cellsizes, xs, ys, factor=0.75, chunk=100000):
+    """
+    Finding breakline mesh points located closer than factor * (smaller cell size) to a point of another breakline
+    with a lower id. Candidate pairs are searched with grid hashing of point coordinates.
+
+    Args:
+        ids (numpy.ndarray): Points ids (MPID).
+        blids (numpy.ndarray): Breakline ids of points.
+        cellsizes (numpy.ndarray): Cell sizes of points.
+        xs (numpy.ndarray): X coordinates of points.
+        ys (numpy.ndarray): Y coordinates of points.
+        factor (float): Fraction of the cell size defining the minimal distance.
+        chunk (int): Number of points searched for neighbours at once.
+
+    Returns:
+        numpy.ndarray: Ids of points too close to other points.
+    """
+    n = ids.size
+    if n == 0:
+        return ids
+    cell = factor * cellsizes.max()
+    cx = np.floor((xs - xs.min()) / cell).astype(np.int64) + 1
+    cy = np.floor((ys - ys.min()) / cell).astype(np.int64) + 1
+    width = cy.max() + 2
+    keys = cx * width + cy
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    close = np.zeros(n, dtype=bool)
+    for start in range(0, n, chunk):
+        pts = np.arange(start, min(start + chunk, n))
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                nkeys = (cx[pts] + dx) * width + cy[pts] + dy
+                lo = np.searchsorted(sorted_keys, nkeys, 'left')
+                cnt = np.searchsorted(sorted_keys, nkeys, 'right') - lo
+                total = int(cnt.sum())
+                if total == 0:
+                    continue
+                i = np.repeat(pts, cnt)
+                j = order[np.repeat(lo, cnt) + np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)]
+                mindist = factor * np.minimum(cellsizes[i], cellsizes[j])
+                hit = (blids[i] != blids[j]) & (ids[i] > ids[j]) & \
+                      ((xs[i] - xs[j]) ** 2 + (ys[i] - ys[j]) ** 2 <= mindist ** 2)
+                close[i[hit]] = True
+    return ids[close]
+
+
+def mesh_area(area, lines):
+    """
+    Creating mesh points of a single 2D flow area. Regular grid points are seeded inside the shrunk area,
+    points within breakline buffers are dropped, points aligned to breaklines are added and aligned points
+    too close to points of other breaklines are removed. No database connection is used, so areas can be
+    meshed in parallel.
+
+    Args:
+        area (dict): Area row returned by get_flow_areas.
+        lines (list): List of tuples (BLmID, cell size, vertex coordinates, measures array, offsets array)
+            for breaklines of the area.
+
+    Returns:
+        dict: Arrays of regular points coordinates ('regular'), aligned points breakline ids ('blids'),
+            cell sizes ('cellsizes') and coordinates ('aligned') and number of removed close points ('close').
+    """
+    x0 = float(area['x0'])
+    y0 = float(area['y0'])
+    cellsize = float(area['CellSize'])
+    cols, rows = grid_in_polygon(wkb_rings(area['wkb']), x0, y0, cellsize)
+    if area['buffer_wkb'] is not None and cols.size > 0:
+        # buffers are rasterized on the same grid, so dropped nodes are found by their numbers
+        bcols, brows = grid_in_polygon(wkb_rings(area['buffer_wkb']), x0, y0, cellsize)
+        if bcols.size > 0:
+            cmin = min(cols.min(), bcols.min())
+            width = max(cols.max(), bcols.max()) - cmin + 1
+            keep = ~np.isin(rows * width + cols - cmin, brows * width + bcols - cmin)
+            cols = cols[keep]
+            rows = rows[keep]
+        else:
+            pass
+    else:
+        pass
+    regular = np.column_stack((x0 + cols * cellsize, y0 + rows * cellsize))
+
+    pts = [locate_along(coords, measures, offsets).reshape(-1, 2) for blid, cs, coords, measures, offsets in lines]
+    counts = [p.shape[0] for p in pts]
+    blids = np.repeat(np.array([line[0] for line in lines], dtype=np.int64), counts)
+    cellsizes = np.repeat(np.array([line[1] for line in lines], dtype=np.float64), counts)
+    aligned = np.vstack(pts) if pts else np.empty((0, 2))
+    ids = np.arange(blids.size)
+    close = close_points(ids, blids, cellsizes, aligned[:, 0], aligned[:, 1])
+    keep = np.ones(ids.size, dtype=bool)
+    keep[close] = False
+    return {
+        'regular': regular,
+        'blids': blids[keep],
+        'cellsizes': cellsizes[keep],
+        'aligned': aligned[keep],
+        'close': int(close.size)}
+
+
+def create_mesh(rgis, aligned, area_ids=None, breaklines=False, workers=None):
+    """
+    Creating mesh points for 2D flow areas. Every area is meshed by a separate job in a thread pool
+    and points of all areas are merged into MeshPoints2d table with a single COPY.
+
+    Args:
+        aligned (list): List of tuples (BLmID, cell size, measures array, offsets array) for each breakline.
+        area_ids (list): Ids of areas to be meshed. All areas are meshed if None.
+        breaklines (bool): Flag for using measured breaklines (BreakLines2d_m).
+        workers (int): Number of worker threads.
+
+    Returns:
+        tuple/None: Numbers of inserted points and of aligned points removed as too close, or None if insert failed.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    areas = get_flow_areas(rgis, area_ids, breaklines)
+    lines = get_breaklines_m(rgis) if breaklines is True else {}
+    area_lines = dict((area['AreaID'], []) for area in areas)
+    for blid, cellsize, measures, offsets in aligned:
+        area_id, coords = lines[blid]
+        if area_id in area_lines:
+            area_lines[area_id].append((blid, cellsize, coords, measures, offsets))
+        else:
+            pass
+    srid = rgis.rdb.SRID
+    removed = []
+
+    def job(area):
+        return mesh_area(area, area_lines[area['AreaID']])
+
+    def rows(executor):
+        for area, pts in zip(areas, executor.map(job, areas)):
+            area_id = area['AreaID']
+            removed.append(pts['close'])
+            for x, y in pts['regular']:
+                yield area_id, -1, None, ewkt_point(srid, x, y)
+            for blid, cellsize, (x, y) in zip(pts['blids'], pts['cellsizes'], pts['aligned']):
+                yield area_id, int(blid), float(cellsize), ewkt_point(srid, x, y)
+
+    columns = ['"AreaID"', '"BLID"', '"CellSize"', 'geom']
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        inserted = rgis.rdb.copy_rows('MeshPoints2d', columns, rows(executor))
+    if inserted is None:
+        return None
+    return inserted, sum(removed)
+
+
+def drop_outside_areas(rgis, area_ids=None):
+    """
+    Deleting mesh points located outside the 2D areas shrunk by 0.3 of their cell size.
+
+    Args:
+        area_ids (list): Ids of areas to be cleaned. All areas are cleaned if None.
+
+    Returns:
+        int/None: Number of deleted points or None if cleaning failed.
+    """
+    # shrunk areas are computed once, so the same polygon is tested against all its points
+    qry = '''
+CREATE TEMP TABLE rgis_areas_shrunk ON COMMIT DROP AS
+SELECT
+    "AreaID",
+    ST_Buffer(geom, -0.3 * "CellSize") AS geom
+FROM
+    "{0}"."FlowAreas2d"
+WHERE
+    {1};
+
+WITH deleted AS
+    (DELETE FROM
+        "{0}"."MeshPoints2d" AS p
+    USING
+        rgis_areas_shrunk AS a
+    WHERE
+        a."AreaID" = p."AreaID" AND
+        NOT ST_Contains(a.geom, p.geom)
+    RETURNING
+        p."MPID")
+SELECT
+    count(*)
+FROM
+    deleted;
+'''
+    qry = qry.format(rgis.rdb.SCHEMA, HecRasObject.area_filter(area_ids))
+    outside = rgis.rdb.run_query(qry, fetch=True)
+    rgis.rdb.run_query('DROP TABLE IF EXISTS rgis_areas_shrunk;\nDROP TABLE IF EXISTS "{0}"."BreakLines2d_m";'.format(rgis.rdb.SCHEMA))
+    if outside is None:
+        return None
+    return int(outside[0][0])
+
+
+def estimate_mesh_points(rgis, area_ids=None, breaklines=False):
+    """
+    Estimating numbers of mesh points without creating them. Regular points are estimated from the area
+    of a shrunk 2D flow area and its cell size, aligned points from the length of a breakline within the area,
+    CellSizeAlong and RowsAligned. Regular points replaced by breakline buffers are subtracted.
+    Additional points created around breakpoints are not included.
+
+    Args:
+        area_ids (list): Ids of areas to be estimated. All areas are estimated if None.
+        breaklines (bool): Flag for including BreakLines2d.
+
+    Returns:
+        list: List of dicts with AreaID, Name, CellSize, estimated 'regular' and 'aligned' points numbers
+            and 'breaklines' list of tuples (BLID, estimated aligned points number).
+    """
+    qry = '''
+SELECT
+    "AreaID",
+    "Name",
+    "CellSize",
+    greatest(ST_Area(ST_Buffer(geom, -0.3 * "CellSize")), 0) / ("CellSize" * "CellSize") AS regular
+FROM
+    "{0}"."FlowAreas2d"
+WHERE
+    "CellSize" > 0 AND
+    {1}
+ORDER BY
+    "AreaID";
+'''
+    qry = qry.format(rgis.rdb.SCHEMA, HecRasObject.area_filter(area_ids))
+    areas = []
+    index = {}
+    for row in rgis.rdb.run_query(qry, fetch=True) or []:
+        index[row['AreaID']] = len(areas)
+        areas.append({
+            'AreaID': row['AreaID'],
+            'Name': row['Name'],
+            'CellSize': row['CellSize'],
+            'regular': float(row['regular']),
+            'aligned': 0,
+            'breaklines': []})
+    if breaklines is True and areas:
+        qry = '''
+SELECT
+    l."BLID",
+    l."AreaID",
+    (floor(l.len / l."CellSizeAlong") + 1) * 2 * l."RowsAligned" AS aligned,
+    l.len * 2 * (l."RowsAligned" * l."CellSizeAcross" + 0.2 * l."CellSizeAlong") AS buffer_area
+FROM
+    (SELECT
+        b."BLID",
+        a."AreaID",
+        b."CellSizeAlong",
+        b."CellSizeAcross",
+        b."RowsAligned",
+        ST_Length(ST_Intersection(b.geom, a.geom)) AS len
+    FROM
+        "{0}"."BreakLines2d" AS b,
+        "{0}"."FlowAreas2d" AS a
+    WHERE
+        ST_Intersects(b.geom, a.geom) AND
+        a."CellSize" > 0 AND
+        b."CellSizeAlong" > 0 AND
+        b."CellSizeAcross" > 0 AND
+        b."RowsAligned" > 0 AND
+        {1}) AS l
+ORDER BY
+    l."BLID";
+'''
+        qry = qry.format(rgis.rdb.SCHEMA, HecRasObject.area_filter(area_ids, 'a."AreaID"'))
+        for row in rgis.rdb.run_query(qry, fetch=True) or []:
+            area = areas[index[row['AreaID']]]
+            aligned = int(row['aligned'])
+            area['aligned'] += aligned
+            area['regular'] -= float(row['buffer_area']) / (area['CellSize'] ** 2)
+            area['breaklines'].append((row['BLID'], aligned))
+    else:
+        pass
+    for area in areas:
+        area['regular'] = max(int(area['regular']), 0)
+    return areas
+
+
+def breakline_measures(lines, fractions, sm_param=4):
+    """
+    Measures of aligned mesh points for all breaklines. Breaklines without breakpoints get points spaced
+    by CellSizeAlong. On breaklines with breakpoints, two points are created on both sides of each breakpoint
+    at a distance of (minimal distance between breakpoints) / sm_param, but not more than half of CellSizeAlong,
+    and gaps longer than 3 times that distance are filled with evenly spaced points.
+    Fractions of all breaklines are processed together with array operations.
+
+    Args:
+        lines (list): Rows with BLmID, CellSizeAlong (csx), CellSizeAcross (csy), length (len) and RowsAligned (rows)
+            of breaklines.
+        fractions (list): Rows of distinct (BLmID, Fraction) of breakpoints ordered by BLmID and Fraction.
+        sm_param (int): Breakpoints spacing divisor.
+
+    Returns:
+        list: List of tuples (BLmID, cell size, measures array, offsets array) for each breakline.
+    """
+    blids = [line['BLmID'] for line in lines]
+    index = dict((blid, i) for i, blid in enumerate(blids))
+    dist_x = np.array([float(line['csx']) for line in lines])
+    leng = np.array([float(line['len']) for line in lines])
+    rows = [(index[blid], float(m)) for blid, m in fractions if blid in index]
+    li = np.array([r[0] for r in rows], dtype=np.int64)
+    f = np.array([r[1] for r in rows], dtype=np.float64)
+
+    # minimal distance between breakpoints of each breakline
+    db_min = np.full(len(lines), 10.**9)
+    np.minimum.at(db_min, li[1:], np.where(li[1:] == li[:-1], np.diff(f), 10.**9))
+    with np.errstate(divide='ignore'):
+        dist_min = np.minimum(db_min / sm_param, 0.5 * dist_x / leng)
+
+    # two mesh points on both sides of each breakpoint
+    mp = np.column_stack((np.maximum(0.0001, f - dist_min[li]), np.minimum(f + dist_min[li], 0.9999))).ravel()
+    ml = np.repeat(li, 2)
+
+    # gaps between points along a breakline longer than 3 * dist_min are filled with points
+    g = np.diff(mp)
+    gap = (ml[1:] == ml[:-1]) & (g > 3 * dist_min[ml[1:]])
+    gm = mp[1:][gap]
+    gd = g[gap]
+    gl = ml[1:][gap]
+    k = np.floor(gd / (2 * dist_min[gl])).astype(np.int64)
+    cnt = np.maximum(k - 1, 0)
+    j = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt) + 1
+    fm = np.repeat(gm, cnt) - j * np.repeat(gd / k.clip(1), cnt)
+    fl = np.repeat(gl, cnt)
+
+    measures = np.concatenate((mp, fm))
+    mlines = np.concatenate((ml, fl))
+    order = np.lexsort((measures, mlines))
+    measures = measures[order] * leng[mlines[order]]
+    counts = np.bincount(mlines, minlength=len(lines))
+    per_line = np.split(measures, np.cumsum(counts)[:-1])
+
+    aligned = []
+    for i, line in enumerate(lines):
+        offsets = aligned_offsets(float(line['csy']), int(line['rows']))
+        if counts[i] == 0:
+            imax = int(leng[i] / dist_x[i])
+            aligned.append((blids[i], dist_x[i], np.arange(imax + 1) * dist_x[i], offsets))
+        else:
+            aligned.append((blids[i], dist_min[i] * leng[i], per_line[i], offsets))
+    return aligned
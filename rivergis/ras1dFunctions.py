@@ -22,11 +22,14 @@ from __future__ import absolute_import
 import os
 
 from . import hecobjects as heco
+from qgis.core import QgsProject, QgsMapLayer
 from qgis.PyQt.QtCore import Qt, QSettings
 from qgis.PyQt.QtWidgets import QApplication, QInputDialog, QFileDialog
 
 from .ras_gis_import import RasGisImport
 from .rasElevations import prepare_DTMs, update_DtmID, probe_DTMs
+from .landcover import landcover_classes, landcover_manning
+from .storage_volumes import storage_histograms, storage_levels, histogram_volumes, level_schedule
 from .dlg_rasXSUpdate import DlgXSUpdateInsertMeasuredPts
 
 
@@ -38,9 +41,13 @@ def ras1dStreamCenterlineTopology(rgis):
         rgis.addInfo('<br>StreamCenterlines are not registered in the river database. Import or create stream centerlines. <br>Cancelling...')
         return
 
+    try:
+        tolerance = rgis.topology_tolerance
+    except:
+        tolerance = 0
     rgis.addInfo('<br><b>Building stream centerlines topology...</b>')
     rgis.rdb.process_hecobject(heco.NodesTable, 'pg_create_table')
-    if rgis.rdb.process_hecobject(heco.StreamCenterlines, 'pg_topology'):
+    if rgis.rdb.process_hecobject(heco.StreamCenterlines, 'pg_topology', tolerance=tolerance):
         rgis.rdb.add_to_view(heco.NodesTable())
         rgis.addInfo('Done.')
 
@@ -61,8 +68,9 @@ def ras1dStreamCenterlineLengthsStations(rgis):
 
 def ras1dStreamCenterlineAll(rgis):
     """Runs all analyses for rivers' centerlines, i.e. topology + Lengths/stations"""
-    ras1dStreamCenterlineTopology(rgis)
-    ras1dStreamCenterlineLengthsStations(rgis)
+    with rgis.rdb.transaction():
+        ras1dStreamCenterlineTopology(rgis)
+        ras1dStreamCenterlineLengthsStations(rgis)
 
 
 def ras1dXSRiverReachNames(rgis):
@@ -107,12 +115,8 @@ def ras1dXSDownstreamLengths(rgis):
             rgis.addInfo('Check the Flowpaths LineType attribute values - it should be one of: Channel, Right, Left, C, L, or r')
             return
 
-    if rgis.rdb.process_hecobject(heco.XSCutLines, 'pg_downstream_reach_lengths', line_type='Channel'):
-        rgis.addInfo('Channel flowpaths done.')
-    if rgis.rdb.process_hecobject(heco.XSCutLines, 'pg_downstream_reach_lengths', line_type='Left'):
-        rgis.addInfo('Left flowpaths done.')
-    if rgis.rdb.process_hecobject(heco.XSCutLines, 'pg_downstream_reach_lengths', line_type='Right'):
-        rgis.addInfo('Right flowpaths done.')
+    if rgis.rdb.process_hecobject(heco.XSCutLines, 'pg_downstream_reach_lengths'):
+        rgis.addInfo('Channel, left and right flowpaths done.')
 
 
 def ras1dStreamCenterlines2Flowpaths(rgis):
@@ -153,11 +157,12 @@ def ras1dXSElevations(rgis):
 
 def ras1dXSAll(rgis):
     """Runs all the XS analyses"""
-    ras1dXSRiverReachNames(rgis)
-    ras1dXSStationing(rgis)
-    ras1dXSBankStations(rgis)
-    ras1dXSDownstreamLengths(rgis)
-    ras1dXSElevations(rgis)
+    with rgis.rdb.transaction():
+        ras1dXSRiverReachNames(rgis)
+        ras1dXSStationing(rgis)
+        ras1dXSBankStations(rgis)
+        ras1dXSDownstreamLengths(rgis)
+        ras1dXSElevations(rgis)
 
 
 def ras1dHealLanduseGeoms(rgis):
@@ -169,11 +174,54 @@ def ras1dHealLanduseGeoms(rgis):
 def ras1dXSExtractMannings(rgis):
     rgis.addInfo('<br><b>Extracting Manning\'s n values for cross-sections</b>')
     rgis.rdb.process_hecobject(heco.Manning, 'pg_create_table')
+    # land use polygons are intersected as small indexed tiles, reused until LanduseAreas change
+    rgis.rdb.setup_hydro_object(heco.LanduseTiles)
+    current = rgis.rdb.run_query(heco.LanduseTiles().pg_is_current(), fetch=True)
+    if current and current[0]['current'] is True:
+        rgis.addInfo('Using existing land use tiles.')
+    else:
+        rgis.addInfo('Subdividing land use areas into tiles...')
+        rgis.rdb.process_hecobject(heco.LanduseTiles, 'pg_create_table')
+        rgis.rdb.process_hecobject(heco.LanduseTiles, 'pg_subdivide')
     if rgis.rdb.process_hecobject(heco.LanduseAreas, 'pg_extract_manning'):
         rgis.rdb.add_to_view(heco.Manning())
         rgis.addInfo('Done.')
 
 
+def ras1dXSExtractManningsRaster(rgis):
+    """Extract Manning's n values for cross-sections from a classified land cover raster"""
+    layers = [layer for layer in QgsProject.instance().mapLayers().values() if layer.type() == QgsMapLayer.RasterLayer]
+    if not layers:
+        rgis.addInfo('<br>No raster layer in the project. Load a land cover raster first.')
+        return
+    # items are labelled with layer ids too, so layers sharing a name can be told apart
+    items = ['{0} [{1}]'.format(layer.name(), layer.id()) for layer in layers]
+    item, ok = QInputDialog.getItem(rgis, 'Land cover raster', 'Classified land cover raster:', items, 0, False)
+    if not ok:
+        return
+    rlayer = layers[items.index(item)]
+    rgis.addInfo('<br><b>Extracting Manning\'s n values for cross-sections from land cover raster {0}</b>'.format(rlayer.name()))
+    if 'LandcoverClasses' not in rgis.rdb.list_tables():
+        rgis.addInfo('LandcoverClasses table is missing. Create it and fill n values of land cover classes.<br>Cancelling...')
+        return
+    lookup = landcover_classes(rgis)
+    if not lookup:
+        rgis.addInfo('LandcoverClasses table is empty. Fill n values of land cover classes first.<br>Cancelling...')
+        return
+    QApplication.setOverrideCursor(Qt.WaitCursor)
+    try:
+        rgis.rdb.process_hecobject(heco.Manning, 'pg_create_table')
+        written = landcover_manning(rgis, rlayer, lookup)
+        if written is None:
+            rgis.addInfo('Manning table could not be written.<br>Cancelling...')
+            return
+        rgis.rdb.add_to_view(heco.Manning())
+        rgis.addInfo('  {0} change points written.'.format(written))
+        rgis.addInfo('Done.')
+    finally:
+        QApplication.restoreOverrideCursor()
+
+
 def ras1dLevees(rgis):
     rgis.addInfo('<br><b>Calculating levees stations for cross-sections...</b>')
     rgis.rdb.process_hecobject(heco.LeveePoints, 'pg_create_table')
@@ -245,9 +293,10 @@ def ras1dBRElevations(rgis):
 
 
 def ras1dRASBRAll(rgis):
-    ras1dBRRiverReachNames(rgis)
-    ras1dBRStationing(rgis)
-    ras1dBRElevations(rgis)
+    with rgis.rdb.transaction():
+        ras1dBRRiverReachNames(rgis)
+        ras1dBRStationing(rgis)
+        ras1dBRElevations(rgis)
 
 
 def ras1dISRiverReachNames(rgis):
@@ -299,9 +348,10 @@ def ras1dISElevations(rgis):
 
 
 def ras1dISAll(rgis):
-    ras1dISRiverReachNames(rgis)
-    ras1dISStationing(rgis)
-    ras1dISElevations(rgis)
+    with rgis.rdb.transaction():
+        ras1dISRiverReachNames(rgis)
+        ras1dISStationing(rgis)
+        ras1dISElevations(rgis)
 
 
 def ras1dLatRiverReachNames(rgis):
@@ -353,59 +403,98 @@ def ras1dLatElevations(rgis):
 
 
 def ras1dLatAll(rgis):
-    ras1dLatRiverReachNames(rgis)
-    ras1dLatStationing(rgis)
-    ras1dLatElevations(rgis)
+    with rgis.rdb.transaction():
+        ras1dLatRiverReachNames(rgis)
+        ras1dLatStationing(rgis)
+        ras1dLatElevations(rgis)
 
 
 def ras1dSAElevations(rgis):
-    """Probe a DTM to later find storage area volume"""
+    """
+    Read a DTM under storage areas to find their minimum and maximum elevations.
+    Returns elevation histograms of storage areas for reuse by volume calculation or None if aborted.
+    """
     # Prepare DTMs
     prepare_DTMs(rgis)
     if not rgis.dtms:
         rgis.addInfo('<br>No DTM for elevation sampling. Probing aborted!')
-        return False
-    surface_obj = heco.SASurface()
+        return None
     parent_obj = heco.StorageAreas()
     update_DtmID(rgis, parent_obj)
-    try:
-        chunk = rgis.dtm_chunksize
-    except:
-        chunk = 0
 
-    # probe a DTM at each point
+    # elevations are read from the DTM window under each storage area, no points are created
     QApplication.setOverrideCursor(Qt.WaitCursor)
     try:
         rgis.addInfo('<br><b>Calculating Storage Areas elevation values...</b>')
-        rgis.rdb.process_hecobject(heco.SASurface, 'pg_create_table')
-        rgis.addInfo('Creating point grid inside Storage Areas...')
-        rgis.rdb.process_hecobject(heco.StorageAreas, 'pg_surface_points')
         rgis.addInfo('Extracting values from raster...')
-        probe_DTMs(rgis, surface_obj, parent_obj, chunksize=chunk)
+        hists = storage_histograms(rgis)
+        rows = []
+        for area, hist in hists:
+            if hist is None:
+                rgis.addInfo('  No DTM values for storage area StorageID={0}'.format(area['StorageID']))
+            else:
+                rows.append((area['StorageID'], round(hist['max'], 2), round(hist['min'], 2)))
         rgis.addInfo('Updating maximum and minimum elevation values in Storage Areas...')
-        rgis.rdb.process_hecobject(heco.StorageAreas, 'pg_maxmin')
+        columns = [('"MaxElev"', 'double precision'), ('"MinElev"', 'double precision')]
+        rgis.rdb.update_from_rows('StorageAreas', ('"StorageID"', 'integer'), columns, rows)
         rgis.addInfo('Done')
     finally:
         QApplication.restoreOverrideCursor()
-    return True
+    return hists
 
 
-def ras1dSAVolumeData(rgis):
-    nr_slices, ok = QInputDialog.getInt(rgis, 'Number of slices', 'Number of slices for volume calculation:', 10, 3, 30, 1)
+def ras1dSAVolumeData(rgis, hists=None):
+    """
+    Calculate elevation-volume curves of storage areas. Histograms already computed by
+    ras1dSAElevations can be passed in to avoid reading the DTM again.
+    """
+    text, ok = QInputDialog.getText(rgis, 'Levels schedule', 'Number of slices or comma separated fractions of depth (0-1) for volume calculation:', text='10')
     if not ok:
-        rgis.addInfo('  Incorrect number of slices. Cancelling...')
+        return
+    try:
+        fractions = level_schedule(text)
+    except ValueError:
+        rgis.addInfo('  Incorrect levels schedule. Cancelling...')
         return
 
     rgis.addInfo('<br><b>Calculating elevation-volume data for Storage Areas...</b>')
-    rgis.rdb.process_hecobject(heco.SAVolume, 'pg_create_table')
-    rgis.rdb.process_hecobject(heco.StorageAreas, 'pg_storage_calculator', slices=nr_slices)
-    rgis.rdb.add_to_view(heco.SAVolume())
-    rgis.addInfo('Done')
+    if hists is None:
+        prepare_DTMs(rgis)
+        if not rgis.dtms:
+            rgis.addInfo('<br>No DTM for elevation sampling. Calculation aborted!')
+            return
+        update_DtmID(rgis, heco.StorageAreas())
+    else:
+        pass
+    QApplication.setOverrideCursor(Qt.WaitCursor)
+    try:
+        if hists is None:
+            hists = storage_histograms(rgis)
+        else:
+            pass
+        rgis.rdb.process_hecobject(heco.SAVolume, 'pg_create_table')
+        if hists:
+            # curves are computed from DTM elevations histograms of storage areas
+            rows = []
+            for area, hist in hists:
+                if hist is None:
+                    continue
+                levels = storage_levels(hist, area['UserElev'], fractions)
+                volumes, areas = histogram_volumes(hist, levels)
+                rows.extend((area['StorageID'], round(lev, 2), round(vol, 2)) for lev, vol in zip(levels.tolist(), volumes.tolist()))
+            rgis.rdb.copy_rows('SAVolume', ['"StorageID"', '"level"', '"volume"'], rows)
+        else:
+            rgis.addInfo('No DTM assigned to storage areas.')
+        rgis.rdb.add_to_view(heco.SAVolume())
+        rgis.addInfo('Done')
+    finally:
+        QApplication.restoreOverrideCursor()
 
 
 def ras1dSAAll(rgis):
-    if ras1dSAElevations(rgis) is True:
-        ras1dSAVolumeData(rgis)
+    hists = ras1dSAElevations(rgis)
+    if hists is not None:
+        ras1dSAVolumeData(rgis, hists)
 
 
 def ras1dSACAssignNearestSA(rgis):
@@ -443,8 +532,9 @@ def ras1dSACElevations(rgis):
 
 
 def ras1dSACAll(rgis):
-    ras1dSACAssignNearestSA(rgis)
-    ras1dSACElevations(rgis)
+    with rgis.rdb.transaction():
+        ras1dSACAssignNearestSA(rgis)
+        ras1dSACElevations(rgis)
 
 
 def ras1dXSUpdateInsertMeasuredPts(rgis):
@@ -473,9 +563,9 @@ def ras1dCreateRasGisImportFile(rgis):
     rgis.rdb.register_existing(heco)
     rgi = RasGisImport(rgis)
     rgi.check_components()
-    sdf = rgi.gis_import_file()
-    if rgis.DEBUG:
-        rgis.addInfo(sdf)
     with open(import_fname, 'w') as import_file:
-        import_file.write(sdf)
+        rgi.write_gis_import_file(import_file)
+    if rgis.DEBUG:
+        with open(import_fname, 'r') as import_file:
+            rgis.addInfo(import_file.read())
     rgis.addInfo('Done.')
@@ -21,207 +21,221 @@ email                : rpasiok@gmail.com, damnback333@gmail.com
 from __future__ import absolute_import
 from builtins import range
 import os
+import shutil
+import tempfile
+from collections import OrderedDict
 
 from . import hecobjects as heco
-from qgis.core import QgsDataSourceUri, QgsVectorLayer, QgsProject, QgsFeature, QgsGeometry
+from .mesh2d import breakline_measures, create_mesh, drop_outside_areas, estimate_mesh_points, wkb_rings
+from .cell_properties import compute_cell_properties, compute_face_profiles
+from .rasElevations import prepare_DTMs, update_DtmID
+from qgis.core import QgsDataSourceUri, QgsVectorLayer, QgsProject, QgsFeature, QgsFeatureRequest, QgsGeometry
 from qgis.PyQt.QtCore import QSettings, Qt
 from qgis.PyQt.QtWidgets import QApplication, QFileDialog
-from math import floor
-from psycopg2 import ProgrammingError
+import numpy as np
 
 
-def ras2dCreate2dPoints(rgis):
+def ras2dCreate2dPoints(rgis, full=False):
     """
     Create 2D computational points for each 2D flow area.
     Points are regularly spaced (based on CellSize attribute of the FlowArea2D table) except for breaklines, where they are aligned to form a cell face exactly at a breakline.
     Points spacing along and across a breakline is read from CellSizeAlong and CellSizeAcross attributes of BreakLines2D table, respectively. A number of cells rows to align with a beakline can be given.
     Create breakpoints at locations where a cell face is needed (on a breakline).
+    Only areas whose geometry or attributes changed since the last run (including their breaklines and breakpoints) are meshed again, unless full is True.
     """
-    rgis.addInfo('<br><b>Creating computational points for 2D flow areas<b>')
-
-    # and create breaklines with a linear measure
-    qry = 'SELECT * FROM "{0}"."FlowAreas2d"'.format(rgis.rdb.SCHEMA)
-    chk2dAreas = rgis.rdb.run_query(qry, fetch=True)
-    if not chk2dAreas:
-        rgis.addInfo('No 2d flow area in the database.<br>  Import or create it before generating 2d computational points.<br>  Cancelling...')
-        return
+    with rgis.rdb.transaction():
+        rgis.addInfo('<br><b>Creating computational points for 2D flow areas<b>')
+
+        # and create breaklines with a linear measure
+        qry = 'SELECT * FROM "{0}"."FlowAreas2d"'.format(rgis.rdb.SCHEMA)
+        chk2dAreas = rgis.rdb.run_query(qry, fetch=True)
+        if not chk2dAreas:
+            rgis.addInfo('No 2d flow area in the database.<br>  Import or create it before generating 2d computational points.<br>  Cancelling...')
+            return
 
-    QApplication.setOverrideCursor(Qt.WaitCursor)
-    rgis.addInfo('Creating regular mesh points...')
-
-    # create regular mesh points
-    # and delete points located too close to the 2D area boundary
-    rgis.rdb.process_hecobject(heco.MeshPoints2d, 'pg_create_table')
-    rgis.rdb.process_hecobject(heco.MeshPoints2d, 'pg_create_mesh')
-
-    # find which breakline line belongs to which 2d flow area
-    # and create breaklines with a linear measure
-    rgis.rdb.process_hecobject(heco.BreakLines2d, 'pg_flow_to_breakline')
-    rgis.rdb.process_hecobject(heco.BreakLines2d, 'pg_breaklines_m')
-    rgis.rdb.process_hecobject(heco.BreakLines2d, 'pg_drop_by_buffer')
-
-    rgis.addInfo('Creating mesh points along structures...')
-
-    # check if breaklines and breakpoints exist in the database
-    bls_exist = False
-    bps_exist = False
-    for t in rgis.rdb.list_tables():
-        if t == 'BreakLines2d':
-            bls_exist = True
-        if t == 'BreakPoints2d':
-            bps_exist = True
-
-    if bls_exist:
-        # find measures of breakpoints along breaklines
-        # there was a change in the alg name between PostGIS 2.0 and 2.1
-        # ST_Line_Locate_Point -> ST_LineLocatePoint
-        qry = 'SELECT PostGIS_Full_Version() AS ver;'
-        postgisVersion = rgis.rdb.run_query(qry, True)[0]['ver'].split('\"')[1][:5]
-        pgMajV = int(postgisVersion[:1])
-        pgMinV = int(postgisVersion[2:3])
-        if pgMajV < 2:
-            locate = 'ST_Line_Locate_Point'
-        elif pgMajV >= 2 and pgMinV == 0:
-            locate = 'ST_Line_Locate_Point'
-        else:
-            locate = 'ST_LineLocatePoint'
-
-        # find breakline that a breakpoint is located on ( tolerance = 10 [map units] )
-        if bps_exist:
-            breakPtsLocTol = 10
-            rgis.rdb.process_hecobject(heco.BreakPoints2d, 'pg_bpoints_along_blines', tolerance=breakPtsLocTol, func_name=locate)
-        # find breaklines with measures
-        qry = '''
-        SELECT
-            "BLmID",
-            "AreaID",
-            "CellSizeAlong" AS csx,
-            "CellSizeAcross" AS csy,
-            ST_Length(geom) AS len,
-            "RowsAligned" AS rows
-        FROM
-            "{0}"."BreakLines2d_m";
-        '''
-        qry = qry.format(rgis.rdb.SCHEMA)
-        bls = rgis.rdb.run_query(qry, True)
-
-        for line in bls:
-            if not line['csx'] or not line['csy'] or not line['rows']:
-                rgis.addInfo('<br><b>  Empty BreakLines2d attribute! Cancelling...<b><br>')
+        # check if breaklines, breakpoints, mesh points and feature hashes exist in the database
+        tables = rgis.rdb.list_tables()
+        bls_exist = 'BreakLines2d' in tables
+        bps_exist = 'BreakPoints2d' in tables
+        incremental = full is False and 'MeshPoints2d' in tables and 'FeatureHashes' in tables
+
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+
+        if bls_exist:
+            # find which breakline line belongs to which 2d flow area
+            rgis.rdb.process_hecobject(heco.BreakLines2d, 'pg_flow_to_breakline')
+
+        # find areas changed since the last run
+        if incremental:
+            rgis.rdb.setup_hydro_object(heco.FeatureHashes)
+            qry = heco.FeatureHashes().pg_changed_areas(breaklines=bls_exist, breakpoints=bps_exist)
+            area_ids = [row[0] for row in rgis.rdb.run_query(qry, fetch=True) or []]
+            if not area_ids:
+                rgis.addInfo('2D flow areas, breaklines and breakpoints did not change. Mesh points are up to date.')
                 QApplication.restoreOverrideCursor()
                 return
-            dist_x = float(line['csx'])
-            width = float(line['csy'])
-            id = line['BLmID']
-            leng = float(line['len'])
-            rows = int(line['rows'])
-            imax = int(leng/(dist_x))
-
-            # check if breakpoints exist on the breakline
+        else:
+            area_ids = None
+
+        # refuse runs that would create more points than allowed
+        if not checkMeshPointsBudget(rgis, area_ids, bls_exist):
+            QApplication.restoreOverrideCursor()
+            return
+
+        if incremental:
+            rgis.addInfo('Regenerating mesh points for 2D flow areas: {0}'.format(', '.join(str(i) for i in area_ids)))
+            qry = 'DELETE FROM "{0}"."MeshPoints2d" WHERE {1};'
+            qry = qry.format(rgis.rdb.SCHEMA, heco.HecRasObject.area_filter(area_ids))
+            rgis.rdb.run_query(qry)
+        else:
+            rgis.rdb.process_hecobject(heco.MeshPoints2d, 'pg_create_table')
+
+        # aligned mesh points are collected for all breaklines and created with regular points of their areas
+        aligned = []
+
+        if bls_exist:
+            # create breaklines with a linear measure
+            rgis.rdb.process_hecobject(heco.BreakLines2d, 'pg_breaklines_m', area_ids=area_ids)
+
+            rgis.addInfo('Finding mesh points locations along structures...')
+
+            # find measures of breakpoints along breaklines
+            # there was a change in the alg name between PostGIS 2.0 and 2.1
+            # ST_Line_Locate_Point -> ST_LineLocatePoint
+            qry = 'SELECT PostGIS_Full_Version() AS ver;'
+            postgisVersion = rgis.rdb.run_query(qry, True)[0]['ver'].split('\"')[1][:5]
+            pgMajV = int(postgisVersion[:1])
+            pgMinV = int(postgisVersion[2:3])
+            if pgMajV < 2:
+                locate = 'ST_Line_Locate_Point'
+            elif pgMajV >= 2 and pgMinV == 0:
+                locate = 'ST_Line_Locate_Point'
+            else:
+                locate = 'ST_LineLocatePoint'
+
+            # find breakline that a breakpoint is located on ( tolerance = 10 [map units] )
+            if bps_exist:
+                breakPtsLocTol = 10
+                rgis.rdb.process_hecobject(heco.BreakPoints2d, 'pg_bpoints_along_blines', tolerance=breakPtsLocTol, func_name=locate)
+            # find breaklines with measures
             qry = '''
             SELECT
-                bp."BPID"
+                "BLmID",
+                "AreaID",
+                "CellSizeAlong" AS csx,
+                "CellSizeAcross" AS csy,
+                ST_Length(geom) AS len,
+                "RowsAligned" AS rows
             FROM
-                "{0}"."BreakLines2d_m" AS bl,
-                "{0}"."BreakPoints2d" AS bp
-            WHERE
-                bl."BLmID" = {1} AND
-                bp."BLmID" = bl."BLmID";
+                "{0}"."BreakLines2d_m"
+            ORDER BY
+                "BLmID";
             '''
-            try:
-                qry = qry.format(rgis.rdb.SCHEMA, id)
-                bp_on_bl = rgis.rdb.run_query(qry, True)
-                if rgis.DEBUG:
-                    rgis.addInfo('Breakline BLmID={0}, {1}'.format(id, bp_on_bl))
-            except ProgrammingError:
-                bp_on_bl = None
-
-            if not bp_on_bl:
-                # no BreakPoints2d: create aligned mesh at regular interval = CellSizeAlong
-                if rgis.DEBUG:
-                    rgis.addInfo('Creating regular points for breakline BLmID={0} (no breakpoints)'.format(id))
-                for i in range(0, imax+1):
-                    dist = i * dist_x
-                    for j in range(0, rows):
-                        rgis.rdb.process_hecobject(heco.MeshPoints2d, 'pg_aligned_mesh', cellsize=dist_x, measure=dist, offset=j*width+width/2, blid=id)
-
-            # create cell faces at breakline's breakpoints
-            else:
+            qry = qry.format(rgis.rdb.SCHEMA)
+            bls = rgis.rdb.run_query(qry, True)
+            for line in bls:
+                if not line['csx'] or not line['csy'] or not line['rows']:
+                    rgis.addInfo('<br><b>  Empty BreakLines2d attribute! Cancelling...<b><br>')
+                    rgis.rdb.rollback()
+                    QApplication.restoreOverrideCursor()
+                    return
+
+            # fractions of breakpoints along all breaklines are read at once
+            if bps_exist:
                 qry = '''
                 SELECT DISTINCT
-                    p."Fraction"
+                    "BLmID",
+                    "Fraction"
                 FROM
-                    "{0}"."BreakPoints2d" AS p
+                    "{0}"."BreakPoints2d"
                 WHERE
-                    p."BLmID" = {1};
+                    "BLmID" IS NOT NULL
+                ORDER BY
+                    "BLmID",
+                    "Fraction";
                 '''
-                qry = qry.format(rgis.rdb.SCHEMA, id)
-                ms = rgis.rdb.run_query(qry, True)
-
-                if rgis.DEBUG:
-                    rgis.addInfo('Creating breakpoints for structure id={0} (with breakpoints)'.format(id))
-                sm_param = 4
-                db_min = 10.**9
-                # breakpoints m list (linear locations on current structure)
-                bm = []
-                # linear measures of mesh points to be created
-                mpts = []
-
-                for m in ms:
-                    bm.append(float(m['Fraction']))
-                    if rgis.DEBUG:
-                        rgis.addInfo('BreakPoint2d fraction: {0}'.format(float(m['Fraction'])))
-
-                # sort the list
-                bm.sort()
-
-                for i, m in enumerate(bm):
-                    # calculate minimal distance between breakpoints
-                    if i > 0:
-                        db_min = min(bm[i] - bm[i-1], db_min)
-                if rgis.DEBUG:
-                    rgis.addInfo('Min dist between breakpoints db_min={0}'.format(db_min))
-                # create 2 mesh points on both sides of a breakpoint at a distance db_min / sm_param
-                dist_min = min(db_min / sm_param, 0.5 * dist_x / leng)
-                cs_min = dist_min * leng
-                if rgis.DEBUG:
-                    rgis.addInfo('dist_min={0}, cs_min={1}'.format(dist_min, cs_min))
-                for m in bm:
-                    mpts.append(max(0.0001, m - dist_min))
-                    mpts.append(min(m + dist_min, 0.9999))
-
-                # find gaps between points along a breakline longer than 3 * dist_min
-                gaps = []
-                for i, m in enumerate(mpts):
-                    if rgis.DEBUG:
-                        rgis.addInfo('m={0}'.format(m))
-                    if i > 0:
-                        dist = m - mpts[i-1]
-                        if dist > 3 * dist_min:
-                            gaps.append([m, dist])
-
-                # create mesh points filling the gaps
-                for g in gaps:
-                    m, dist = g
-                    # how many points to insert?
-                    k = int(floor(dist / (2*dist_min)))
-                    # distance between new points
-                    cs = dist / k
-                    for j in range(1, k):
-                        mpts.append(m - j * cs)
-                        if rgis.DEBUG:
-                            rgis.addInfo('gap: dist={0}, m={1}'.format(cs, m - j * cs))
-
-                # insert aligned mesh points into table
-                for m in sorted(mpts):
-                    for j in range(0, rows):
-                        rgis.rdb.process_hecobject(heco.MeshPoints2d, 'pg_aligned_mesh', cellsize=cs_min, measure=m*leng, offset=j*width+width/2, blid=id)
-
-    rgis.addInfo('Deleting mesh points located too close to each other or outside the 2D area...')
-    rgis.rdb.process_hecobject(heco.MeshPoints2d, 'pg_clean_points')
-    rgis.addInfo('Done')
-
-    QApplication.restoreOverrideCursor()
+                qry = qry.format(rgis.rdb.SCHEMA)
+                fractions = [(row['BLmID'], row['Fraction']) for row in rgis.rdb.run_query(qry, True) or []]
+            else:
+                fractions = []
+            aligned = breakline_measures(bls, fractions)
+            if rgis.DEBUG:
+                for blid, cellsize, measures, offsets in aligned:
+                    rgis.addInfo('Breakline BLmID={0}: {1} measures, cell size {2}'.format(blid, len(measures), cellsize))
+
+        # create regular mesh points inside 2D areas shrunk by 0.3 of the cell size and points aligned to breaklines,
+        # each 2D area in a separate job
+        rgis.addInfo('Creating mesh points...')
+        created = create_mesh(rgis, aligned, area_ids, breaklines=bls_exist)
+        if created is None:
+            QApplication.restoreOverrideCursor()
+            return
+        rgis.addInfo('  {0} points created, {1} points too close to other breakline points skipped.'.format(*created))
+
+        rgis.addInfo('Deleting mesh points located outside the 2D area...')
+        outside = drop_outside_areas(rgis, area_ids)
+        if outside is not None:
+            rgis.addInfo('  {0} points outside the 2D areas deleted.'.format(outside))
+
+        # store hashes of meshed features for the next incremental run
+        rgis.rdb.process_hecobject(heco.FeatureHashes, 'pg_create_table')
+        rgis.rdb.process_hecobject(heco.FeatureHashes, 'pg_store_hashes', breaklines=bls_exist, breakpoints=bps_exist)
+        rgis.addInfo('Done')
+
+        QApplication.restoreOverrideCursor()
+
+
+def meshPointsBudget(rgis):
+    """Maximum number of mesh points created in a single run (0 for no limit)"""
+    try:
+        return int(rgis.mesh_points_budget)
+    except (AttributeError, TypeError, ValueError):
+        return 5000000
+
+
+def checkMeshPointsBudget(rgis, area_ids=None, breaklines=False):
+    """
+    Check if the estimated number of mesh points of 2D flow areas fits in the mesh points budget.
+
+    Returns:
+        bool: True if the mesh can be created.
+    """
+    budget = meshPointsBudget(rgis)
+    if budget <= 0:
+        return True
+    areas = estimate_mesh_points(rgis, area_ids, breaklines)
+    total = sum(area['regular'] + area['aligned'] for area in areas)
+    if total <= budget:
+        return True
+    rgis.addInfo('<br><b>About {0} mesh points would be created, which exceeds the budget of {1} points.</b>'.format(total, budget))
+    for area in areas:
+        rgis.addInfo('  {0} (AreaID={1}): {2} regular, {3} aligned points'.format(area['Name'], area['AreaID'], area['regular'], area['aligned']))
+    rgis.addInfo('Increase CellSize of the 2D flow areas or CellSizeAlong of the breaklines, or raise the budget in Options.<br>  Cancelling...')
+    return False
+
+
+def ras2dEstimateMeshPoints(rgis):
+    """
+    Estimate numbers of regular and aligned mesh points for each 2D flow area and breakline without creating them.
+    """
+    rgis.addInfo('<br><b>Estimating numbers of 2D computational points<b>')
+    tables = rgis.rdb.list_tables()
+    if 'FlowAreas2d' not in tables:
+        rgis.addInfo('No 2d flow area in the database.<br>  Cancelling...')
+        return
+    areas = estimate_mesh_points(rgis, breaklines='BreakLines2d' in tables)
+    for area in areas:
+        rgis.addInfo('{0} (AreaID={1}, CellSize={2}): {3} regular, {4} aligned points'.format(
+            area['Name'], area['AreaID'], area['CellSize'], area['regular'], area['aligned']))
+        for blid, aligned in area['breaklines']:
+            rgis.addInfo('  breakline BLID={0}: {1} aligned points'.format(blid, aligned))
+    total = sum(area['regular'] + area['aligned'] for area in areas)
+    budget = meshPointsBudget(rgis)
+    rgis.addInfo('Total: about {0} points'.format(total))
+    if 0 < budget < total:
+        rgis.addInfo('<b>The estimate exceeds the budget of {0} points. Creating the points will be refused.</b>'.format(budget))
+    else:
+        pass
 
 
 def ras2dPreviewMesh(rgis):
@@ -235,25 +249,36 @@ def ras2dPreviewMesh(rgis):
     u2.setDataSource(rgis.schema, 'FlowAreas2d', 'geom')
     areas = QgsVectorLayer(u2.uri(), 'FlowAreas2d', 'postgres')
 
-    pts_list = []
-    for pt in mesh_pts.getFeatures():
-        pts_list.append(pt.geometry())
-    multipts = QgsGeometry().unaryUnion(pts_list)
-
-    voronoi = multipts.voronoiDiagram()
     voronoi_lyr = QgsVectorLayer('Polygon?crs=proj4:{}'.format(rgis.crs.toProj4()), 'Mesh preview', 'memory')
     voronoi_dp = voronoi_lyr.dataProvider()
 
+    # Voronoi diagram is built for each 2D area from its own points only
+    # cells are clipped only if they are not contained within the area
+    batch = 10000
     new_feats = []
     for area in areas.getFeatures():
-        for item in voronoi.asGeometryCollection():
-            poly = QgsGeometry.fromPolygonXY(item.asPolygon())
-            poly_cut = poly.intersection(area.geometry())
+        area_geom = area.geometry()
+        request = QgsFeatureRequest().setFilterExpression('"AreaID" = {0}'.format(area['AreaID']))
+        pts_list = [pt.geometry().asPoint() for pt in mesh_pts.getFeatures(request)]
+        if not pts_list:
+            continue
+        multipts = QgsGeometry.fromMultiPointXY(pts_list)
+        voronoi = multipts.voronoiDiagram(area_geom)
+        engine = QgsGeometry.createGeometryEngine(area_geom.constGet())
+        engine.prepareGeometry()
+        for poly in voronoi.asGeometryCollection():
+            if not engine.contains(poly.constGet()):
+                poly = poly.intersection(area_geom)
             fet = QgsFeature()
-            fet.setGeometry(poly_cut)
+            fet.setGeometry(poly)
             new_feats.append(fet)
+            if len(new_feats) >= batch:
+                voronoi_dp.addFeatures(new_feats)
+                new_feats = []
+                QApplication.processEvents()
 
     _ = voronoi_dp.addFeatures(new_feats)
+    voronoi_lyr.updateExtents()
 
     QgsProject.instance().addMapLayer(voronoi_lyr)
 
@@ -266,8 +291,46 @@ def ras2dPreviewMesh(rgis):
             item.layer().loadNamedStyle(style_path)
 
 
+def ras2dCellProperties(rgis):
+    """
+    Compute hydraulic properties of 2D mesh cells from DTMs.
+    Cells are Voronoi polygons of mesh points clipped to their 2D flow areas and faces are boundaries shared by neighbouring cells.
+    For each cell the minimum and maximum elevation and an elevation-volume curve are computed, and each face gets an elevation profile.
+    """
+    if 'MeshPoints2d' not in rgis.rdb.list_tables():
+        rgis.addInfo('No mesh points in the database.<br>  Create 2D computational points first.<br>  Cancelling...')
+        return
+    prepare_DTMs(rgis)
+    if not rgis.dtms:
+        rgis.addInfo('<br>No DTM for elevation sampling. Cancelling...')
+        return
+    QApplication.setOverrideCursor(Qt.WaitCursor)
+    try:
+        with rgis.rdb.transaction():
+            rgis.addInfo('<br><b>Computing 2D cells properties...</b>')
+            rgis.addInfo('Creating mesh cells and faces...')
+            for hecobject in (heco.MeshCells2d, heco.CellVolumes2d, heco.CellFaces2d, heco.FaceProfiles2d):
+                rgis.rdb.process_hecobject(hecobject, 'pg_create_table')
+            rgis.rdb.process_hecobject(heco.MeshCells2d, 'pg_voronoi_cells')
+            rgis.rdb.process_hecobject(heco.CellFaces2d, 'pg_cell_faces')
+            update_DtmID(rgis, heco.MeshCells2d())
+            update_DtmID(rgis, heco.CellFaces2d())
+            rgis.addInfo('Computing cells elevation-volume curves...')
+            cells = compute_cell_properties(rgis)
+            rgis.addInfo('  {0} cells done.'.format(cells))
+            rgis.addInfo('Computing faces profiles...')
+            faces = compute_face_profiles(rgis)
+            rgis.addInfo('  {0} faces done.'.format(faces))
+            rgis.addInfo('Done')
+    finally:
+        QApplication.restoreOverrideCursor()
+
+
 def ras2dSaveMeshPtsToGeometry(rgis, geoFileName=None):
-    """Saves mesh points from current schema and table 'mesh_pts' to HEC-RAS geometry file"""
+    """
+    Saves mesh points from current schema and table 'MeshPoints2d' to HEC-RAS geometry file.
+    2D areas already present in the geometry file are replaced in place, new ones are inserted before 'Chan Stop Cuts'.
+    """
     if not geoFileName:
         s = QSettings()
         lastGeoFileDir = s.value('rivergis/lastGeoDir', '')
@@ -281,12 +344,15 @@ def ras2dSaveMeshPtsToGeometry(rgis, geoFileName=None):
     # get mesh points extent
     qry = '''
     SELECT
-        ST_XMin(ST_Collect(geom)) AS xmin,
-        ST_XMax(ST_collect(geom)) AS xmax,
-        ST_YMin(ST_collect(geom)) AS ymin,
-        ST_YMax(ST_collect(geom)) AS ymax
+        ST_XMin(ext) AS xmin,
+        ST_XMax(ext) AS xmax,
+        ST_YMin(ext) AS ymin,
+        ST_YMax(ext) AS ymax
     FROM
-        "{0}"."MeshPoints2d";
+        (SELECT
+            ST_Extent(geom) AS ext
+        FROM
+            "{0}"."MeshPoints2d") AS e;
     '''
     qry = qry.format(rgis.rdb.SCHEMA)
     pExt = rgis.rdb.run_query(qry, True)[0]
@@ -294,39 +360,132 @@ def ras2dSaveMeshPtsToGeometry(rgis, geoFileName=None):
     buf = max(0.2*(xmax-xmin), 0.2*(ymax-ymin))
     pExtStr = '{:.2f}, {:.2f}, {:.2f}, {:.2f}'.format(xmin-buf, xmax+buf, ymax+buf, ymin-buf)
 
-    # get list of mesh areas
+    # get list of mesh areas with their number of mesh points
     qry = '''
     SELECT
-        "AreaID",
-        "Name",
-        ST_X(ST_Centroid(geom)) AS x,
-        ST_Y(ST_Centroid(geom)) AS y,
-        ST_NPoints(geom) AS ptsnr
+        a."AreaID",
+        a."Name",
+        ST_X(ST_Centroid(a.geom)) AS x,
+        ST_Y(ST_Centroid(a.geom)) AS y,
+        ST_NPoints(a.geom) AS ptsnr,
+        ST_AsBinary(ST_Force2D(a.geom), 'NDR') AS wkb,
+        COUNT(p."MPID") AS meshnr
     FROM
-        "{0}"."FlowAreas2d";
+        "{0}"."FlowAreas2d" AS a
+        LEFT JOIN "{0}"."MeshPoints2d" AS p ON p."AreaID" = a."AreaID"
+    GROUP BY
+        a."AreaID"
+    ORDER BY
+        a."AreaID";
     '''
     qry = qry.format(rgis.rdb.SCHEMA)
-    t = ''
+    areas = rgis.rdb.run_query(qry, True)
+    if areas is None:
+        return
+    areasByName = OrderedDict(('{0}'.format(area['Name']).strip(), area) for area in areas)
+
+    # mesh points of all areas are fetched with a single streamed query and formatted into a spool file per area
+    spools = dict((area['AreaID'], tempfile.TemporaryFile('w+')) for area in areas)
+    try:
+        spoolMeshPoints(rgis, spools)
+
+        if not os.path.isfile(geoFileName):
+            createNewGeometry(geoFileName, pExtStr)
+
+        # find 2D areas already present in the geometry file
+        existing = set()
+        with open(geoFileName, 'r') as geoFile:
+            for line in geoFile:
+                if line.startswith('Storage Area='):
+                    existing.add(line[13:].split(',')[0].strip())
+        new = [name for name in areasByName if name not in existing]
+
+        # rewrite the geometry file line by line, replacing existing 2D areas in place
+        tmpFileName = geoFileName + '.tmp'
+        with open(geoFileName, 'r') as geoFile, open(tmpFileName, 'w') as outFile:
+            skipping = False
+            for line in geoFile:
+                if skipping:
+                    if isAreaBlockLine(line):
+                        continue
+                    skipping = False
+                if line.startswith('Storage Area='):
+                    name = line[13:].split(',')[0].strip()
+                    if name in areasByName:
+                        writeAreaBlock(outFile, areasByName[name], spools)
+                        skipping = True
+                        continue
+                if line.startswith('Chan Stop Cuts'):
+                    for name in new:
+                        outFile.write('\n\n')
+                        writeAreaBlock(outFile, areasByName[name], spools)
+                    new = []
+                outFile.write(line)
+            for name in new:
+                outFile.write('\n\n')
+                writeAreaBlock(outFile, areasByName[name], spools)
+        os.replace(tmpFileName, geoFileName)
+    finally:
+        for spool in spools.values():
+            spool.close()
 
-    for area in rgis.rdb.run_query(qry, True):
-        qry = '''
-        SELECT
-            ST_AsText(geom) AS geom
-        FROM
-            "{0}"."FlowAreas2d"
-        WHERE
-            "AreaID" = {1};
-        '''
-        qry = qry.format(rgis.rdb.SCHEMA, area['AreaID'])
-        res = rgis.rdb.run_query(qry, True)[0]['geom']
-        ptsList = res[9:-2].split(',')
-        ptsTxt = ''
-        for pt in ptsList:
-            x, y = [float(c) for c in pt.split(' ')]
-            ptsTxt += '{:>16.4f}{:>16.4f}\n'.format(x, y)
-        t += '''
-
-Storage Area={0:<14},{1:14},{2:14}
+    rgis.addInfo('Saved to:\n{}'.format(geoFileName))
+
+
+def spoolMeshPoints(rgis, spools, chunksize=50000):
+    """
+    Fetching mesh points ordered by 2D area with a single streamed query and writing their coordinates
+    into spool files in HEC-RAS geometry file format (two points per line).
+    Coordinates are formatted in chunks, so memory use does not depend on the number of mesh points.
+    """
+    qry = '''
+    SELECT
+        "AreaID",
+        ST_X(geom) AS x,
+        ST_Y(geom) AS y
+    FROM
+        "{0}"."MeshPoints2d"
+    WHERE
+        "AreaID" IS NOT NULL
+    ORDER BY
+        "AreaID",
+        "MPID";
+    '''
+    qry = qry.format(rgis.rdb.SCHEMA)
+    # a point left from an odd chunk waits for its pair in the next chunk
+    pending = dict((aid, np.empty((0, 2))) for aid in spools)
+    for chunk in rgis.rdb.run_query(qry, fetch=True, arraysize=chunksize) or []:
+        pts = np.array([tuple(pt) for pt in chunk], dtype=np.float64)
+        aids = pts[:, 0].astype(np.int64)
+        bounds = np.flatnonzero(np.diff(aids)) + 1
+        for aid, xy in zip(aids[np.r_[0, bounds]], np.split(pts[:, 1:], bounds)):
+            aid = int(aid)
+            if aid not in spools:
+                continue
+            xy = np.vstack((pending[aid], xy))
+            n = xy.shape[0] // 2
+            if n > 0:
+                spools[aid].write(('%16.2f%16.2f%16.2f%16.2f\n' * n) % tuple(xy[:2*n].ravel()))
+            pending[aid] = xy[2*n:]
+    for aid, xy in pending.items():
+        if xy.shape[0] > 0:
+            spools[aid].write('%16.2f%16.2f' % tuple(xy[0]))
+
+
+def isAreaBlockLine(line):
+    """Checks if a geometry file line belongs to a 2D area block started by a 'Storage Area=' line"""
+    if not line.strip() or line[0] in ' -.0123456789':
+        return True
+    if line.startswith('Storage Area') and not line.startswith('Storage Area='):
+        return True
+    return line.startswith('2D ')
+
+
+def writeAreaBlock(outFile, area, spools):
+    """Writes a 2D area block of HEC-RAS geometry file"""
+    ring = wkb_rings(area['wkb'])[0]
+    ptsTxt = ('%16.4f%16.4f\n' * ring.shape[0]) % tuple(ring.ravel())
+    outFile.write('''Storage Area={0:<14},{1:14},{2:14}
 Storage Area Surface Line= {3:d}
 {4}
 Storage Area Type= 0
@@ -334,29 +493,12 @@ Storage Area Area=
 Storage Area Min Elev=
 Storage Area Is2D=-1
 Storage Area Point Generation Data=,,,
-'''.format(area['Name'], area['x'], area['y'], area['ptsnr'], ptsTxt)
-
-        qry = '''
-        SELECT
-            ST_X(geom) AS x,
-            ST_Y(geom) AS y
-        FROM
-            "{0}"."MeshPoints2d"
-        WHERE
-            "AreaID" = {1};
-        '''
-        qry = qry.format(rgis.schema, area['AreaID'])
-        pkty = rgis.rdb.run_query(qry, True)
-
-        coords = ''
-        for i, pt in enumerate(pkty):
-            if i % 2 == 0:
-                coords += '{:16.2f}{:16.2f}'.format(float(pt['x']), float(pt['y']))
-            else:
-                coords += '{:16.2f}{:16.2f}\n'.format(float(pt['x']), float(pt['y']))
-
-        t += '''Storage Area 2D Points= {0}
-{1}
+Storage Area 2D Points= {5}
+'''.format(area['Name'], area['x'], area['y'], area['ptsnr'], ptsTxt, area['meshnr']))
+    spool = spools[area['AreaID']]
+    spool.seek(0)
+    shutil.copyfileobj(spool, outFile)
+    outFile.write('''
 Storage Area 2D PointsPerimeterTime=25Jan2015 01:00:00
 Storage Area Mannings=0.06
 2D Cell Volume Filter Tolerance=0.003
@@ -364,27 +506,7 @@ Storage Area Mannings=0.06
 2D Face Area Elevation Profile Filter Tolerance=0.003
 2D Face Area Elevation Conveyance Ratio=0.02
 
-'''.format(len(pkty), coords)
-
-    if not os.path.isfile(geoFileName):
-        createNewGeometry(geoFileName, pExtStr)
-
-    geoFile = open(geoFileName, 'r')
-    geoLines = geoFile.readlines()
-    geoFile.close()
-
-    geoFile = open(geoFileName, 'w')
-    geo = ""
-    for line in geoLines:
-        if not line.startswith('Chan Stop Cuts'):
-            geo += line
-        else:
-            geo += t
-            geo += line
-    geoFile.write(geo)
-    geoFile.close()
-
-    rgis.addInfo('Saved to:\n{}'.format(geoFileName))
+''')
 
 
 def createNewGeometry(filename, extent):
@@ -20,9 +20,14 @@ email                : rpasiok@gmail.com, damnback333@gmail.com
 """
 from __future__ import absolute_import
 from builtins import str
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+import numpy as np
 
 from .hecobjects import DTMs
-from qgis.core import QgsPointXY, QgsRaster, QgsProject
+from .raster_sampler import RasterSampler
+from qgis.core import QgsProject
 
 
 def prepare_DTMs(rgis):
@@ -80,17 +85,49 @@ WHERE
     rgis.rdb.run_query(qry)
 
 
-def probe_DTMs(rgis, surface_obj, parent_obj, chunksize=0):
+def sample_DTM(provider, pt_ids, xs, ys, bilinear=False):
+    """
+    Sampling a DTM at points. Runs on a worker thread, so it gets its own copy of the raster data provider.
+
+    Returns:
+        tuple: Arrays of point ids and elevations (NaN where the DTM has no value).
+    """
+    sampler = RasterSampler(provider, bilinear=bilinear)
+    return pt_ids, np.round(sampler.sample(xs, ys), 2)
+
+
+def write_elevations(rgis, surface_obj, future):
+    pt_ids, elevs = future.result()
+    valid = ~np.isnan(elevs)
+    if not valid.all():
+        msg = 'Problem with getting raster value for {0} point(s) with PtID: {1}'
+        rgis.addInfo(msg.format((~valid).sum(), ', '.join(str(pt_id) for pt_id in pt_ids[~valid][:20])))
+    rows = zip(pt_ids[valid].tolist(), elevs[valid].tolist())
+    rgis.rdb.update_from_rows(surface_obj.name, ('"PtID"', 'bigint'), [('"Elevation"', 'double precision')], rows)
+
+
+def probe_DTMs(rgis, surface_obj, parent_obj, chunksize=0, workers=None):
     # probe a DTM at each point
     rgis.addInfo('<br><b>Probing DTM along {0}...</b>'.format(parent_obj.name))
+    try:
+        bilinear = rgis.dtm_bilinear
+    except:
+        bilinear = False
+    if workers is None:
+        workers = os.cpu_count() or 1
     qry = 'SELECT * FROM "{0}"."DTMs";'.format(rgis.rdb.SCHEMA)
     dtms = rgis.rdb.run_query(qry, fetch=True)
     parent_id = parent_obj.attrs[0][0]
-    for dtm in dtms:
-        dtm_id = dtm['DtmID']
-        lid = dtm['LayerID']
-        rlayer = QgsProject.instance().mapLayer(lid)
-        qry = '''
+    # sampling tasks for each DTM and spatial chunk run in a thread pool, each with its own raster reader
+    # points are fetched and elevations written back on the main connection
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for dtm in dtms:
+            dtm_id = dtm['DtmID']
+            lid = dtm['LayerID']
+            rlayer = QgsProject.instance().mapLayer(lid)
+            sampler = RasterSampler.from_layer(rlayer)
+            qry = '''
 SELECT
     surf."PtID" AS "PtID",
     ST_X(surf.geom) AS x,
@@ -102,27 +139,29 @@ WHERE
     surf.{3} = par.{3} AND
     par."DtmID" = {4};
 '''
-        qry = qry.format(rgis.rdb.SCHEMA, surface_obj.name, parent_obj.name, parent_id, dtm_id)
-        if chunksize <= 0:
-            chunk = [rgis.rdb.run_query(qry, fetch=True)]
-        else:
-            chunk = rgis.rdb.run_query(qry, fetch=True, arraysize=chunksize)
-        if not chunk:
-            continue
-        else:
-            pass
-        for pts in chunk:
-            if not pts:
+            qry = qry.format(rgis.rdb.SCHEMA, surface_obj.name, parent_obj.name, parent_id, dtm_id)
+            if chunksize <= 0:
+                chunk = [rgis.rdb.run_query(qry, fetch=True)]
+            else:
+                chunk = rgis.rdb.run_query(qry, fetch=True, arraysize=chunksize)
+            if not chunk:
                 continue
             else:
                 pass
-            qry = ''
-            for pt in pts:
-                ident = rlayer.dataProvider().identify(QgsPointXY(pt[1], pt[2]), QgsRaster.IdentifyFormatValue)
-                try:
-                    if ident.isValid():
-                        pt.append(round(ident.results()[1], 2))
-                        qry += 'UPDATE "{0}"."{1}" SET "Elevation" = {2} WHERE "PtID" = {3};\n'.format(rgis.rdb.SCHEMA, surface_obj.name, pt[3], pt[0])
-                except:
-                    rgis.addInfo('Problem with getting raster value for point with PtID {0}'.format(pt[0]))
-            rgis.rdb.run_query(qry)
+            for pts in chunk:
+                if not pts:
+                    continue
+                else:
+                    pass
+                pts = np.array([tuple(pt) for pt in pts], dtype=np.float64)
+                pt_ids = pts[:, 0].astype(np.int64)
+                for idx in sampler.split_by_tiles(pts[:, 1], pts[:, 2], workers):
+                    provider = rlayer.dataProvider().clone()
+                    pending.add(executor.submit(sample_DTM, provider, pt_ids[idx], pts[idx, 1], pts[idx, 2], bilinear))
+                # write back finished results to keep the number of points held in memory bounded
+                while len(pending) > 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write_elevations(rgis, surface_obj, future)
+        for future in as_completed(pending):
+            write_elevations(rgis, surface_obj, future)
@@ -27,6 +27,8 @@ class RasGisImport(object):
     """
     Exporting model to RAS GIS Import file.
     """
+    FETCH_SIZE = 2000
+
     def __init__(self, rgis):
         self.rgis = rgis
         self.header = HeaderBuilder(rgis)
@@ -89,19 +91,70 @@ class RasGisImport(object):
         pnts = (p.split() for p in wkt[sidx:eidx].split(','))
         return pnts
 
+    @staticmethod
+    def stream_rows(rgis, qry):
+        """
+        Generator of query rows fetched in chunks of FETCH_SIZE rows through a server-side cursor.
+        Nothing is yielded for failing queries, e.g. for nonexistent tables.
+        """
+        batches = rgis.rdb.run_query(qry, fetch=True, arraysize=RasGisImport.FETCH_SIZE, be_quiet=True)
+        if batches is None:
+            return
+        else:
+            # commit so the held cursor survives rollbacks of failing queries on other tables
+            rgis.rdb.commit()
+        for batch in batches:
+            for row in batch:
+                yield row
+
+    def sections(self):
+        """
+        Generator of successive parts of RAS GIS Import file.
+        """
+        yield self.header.build_header()
+        for builder in (self.network.build_network,
+                        self.xsections.build_cross_sections,
+                        self.bridges.build_bridges,
+                        self.inline_str.build_inline_str,
+                        self.lateral_str.build_lateral_str,
+                        self.levees.build_levees,
+                        self.ineff_areas.build_ineff_areas,
+                        self.blocked_obs.build_blocked_obs,
+                        self.storage_areas.build_storage_areas,
+                        self.sa_connections.build_sa_connections):
+            for part in builder():
+                yield part
+
+    def write_gis_import_file(self, import_file):
+        """
+        Writing RAS GIS Import file part by part, so the whole file is never held in memory.
+
+        Args:
+            import_file (file): File opened for writing.
+        """
+        for part in self.sections():
+            import_file.write(part)
+
     def gis_import_file(self):
-        imp = self.header.build_header()
-        imp += self.network.build_network()
-        imp += self.xsections.build_cross_sections()
-        imp += self.bridges.build_bridges()
-        imp += self.inline_str.build_inline_str()
-        imp += self.lateral_str.build_lateral_str()
-        imp += self.levees.build_levees()
-        imp += self.ineff_areas.build_ineff_areas()
-        imp += self.blocked_obs.build_blocked_obs()
-        imp += self.storage_areas.build_storage_areas()
-        imp += self.sa_connections.build_sa_connections()
-        return imp
+        return ''.join(self.sections())
+
+
+class ChildRows(object):
+    """
+    Rows of a child table sorted in the same order as rows of its parent table.
+    Rows are taken group by group while iterating over parents, so a child table is read with a single query.
+    """
+    def __init__(self, rows, key):
+        self.rows = iter(rows)
+        self.key = key
+        self.row = next(self.rows, None)
+
+    def take(self, parent_id):
+        group = []
+        while self.row is not None and self.row[self.key] == parent_id:
+            group.append(self.row)
+            self.row = next(self.rows, None)
+        return group
 
 
 class HeaderBuilder(object):
@@ -185,13 +238,9 @@ class NetworkBuilder(object):
         self.components = ['NodesTable', 'StreamCenterlines']
 
     def get_nodes(self):
-        qry = 'SELECT "NodeID", "X", "Y" FROM "{0}"."NodesTable";'
+        qry = 'SELECT "NodeID", "X", "Y" FROM "{0}"."NodesTable" ORDER BY "NodeID";'
         qry = qry.format(self.schema)
-        nodes = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if nodes is None:
-            return []
-        else:
-            return nodes
+        return RasGisImport.stream_rows(self.rgis, qry)
 
     def get_reaches(self):
         qry = '''
@@ -205,14 +254,12 @@ SELECT
 FROM
     "{0}"."StreamCenterlines"
 WHERE
-    "ReachCode" IS NOT NULL;
+    "ReachCode" IS NOT NULL
+ORDER BY
+    "ReachID";
 '''
         qry = qry.format(self.schema)
-        reaches = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if reaches is None:
-            return []
-        else:
-            return reaches
+        return RasGisImport.stream_rows(self.rgis, qry)
 
     def build_network(self):
         net_all = 'BEGIN STREAM NETWORK:\n'
@@ -228,19 +275,14 @@ WHERE
 '''
         net_centerline = '         {0}, {1}, None\n'
         net_end = '\nEND STREAM NETWORK:\n\n'
-        nodes = self.get_nodes()
-        reaches = self.get_reaches()
-        for node in nodes:
-            net_all += net_node.format(node['X'], node['Y'], node['NodeID'])
-        for reach in reaches:
-            centerlines = ''
+        yield net_all
+        for node in self.get_nodes():
+            yield net_node.format(node['X'], node['Y'], node['NodeID'])
+        for reach in self.get_reaches():
             pnts = RasGisImport.unpack_wkt(reach['wkt'])
-            for pt in pnts:
-                x, y = pt
-                centerlines += net_centerline.format(x, y)
-            net_all += net_reach.format(reach['RiverCode'], reach['ReachCode'], reach['FromNode'], reach['ToNode'], centerlines)
-        net_all += net_end
-        return net_all
+            centerlines = ''.join(net_centerline.format(x, y) for x, y in pnts)
+            yield net_reach.format(reach['RiverCode'], reach['ReachCode'], reach['FromNode'], reach['ToNode'], centerlines)
+        yield net_end
 
 
 class XSBuilder(object):
@@ -269,59 +311,54 @@ FROM
     "{0}"."XSCutLines"
 ORDER BY
     "RiverCode",
-    "Station";
+    "Station",
+    "XsecID";
 '''
         qry = qry.format(self.schema)
-        xsections = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if xsections is None:
-            return []
-        else:
-            return xsections
-
-    def get_nvalues(self, xs_id):
-        qry = 'SELECT "Fraction", "N_Value" FROM "{0}"."Manning" WHERE "XsecID" = {1};'
-        qry = qry.format(self.schema, xs_id)
-        nvalues = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if nvalues is None:
-            return []
-        else:
-            return nvalues
-
-    def get_levee_points(self, xs_id):
-        qry = 'SELECT "LeveeID", "Fraction", "Elevation" FROM "{0}"."LeveePoints" WHERE "XsecID" = {1};'
-        qry = qry.format(self.schema, xs_id)
-        levee_points = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if levee_points is None:
-            return []
-        else:
-            return levee_points
-
-    def get_ineffs(self, xs_id):
-        qry = 'SELECT "IneffID", "FromFract", "ToFract", "Elevation" FROM "{0}"."IneffLines" WHERE "XsecID" = {1};'
-        qry = qry.format(self.schema, xs_id)
-        ineffs = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if ineffs is None:
-            return []
-        else:
-            return ineffs
-
-    def get_blocks(self, xs_id):
-        qry = 'SELECT "BlockID", "FromFract", "ToFract", "Elevation" FROM "{0}"."BlockLines" WHERE "XsecID" = {1};'
-        qry = qry.format(self.schema, xs_id)
-        blocks = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if blocks is None:
-            return []
-        else:
-            return blocks
-
-    def get_surf(self, xs_id):
-        qry = 'SELECT ST_X(geom) AS x, ST_Y(geom) AS y, "Elevation" FROM "{0}"."XSSurface" WHERE "XsecID" = {1} ORDER BY "Station";'
-        qry = qry.format(self.schema, xs_id)
-        surfs = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if surfs is None:
-            return []
-        else:
-            return surfs
+        return RasGisImport.stream_rows(self.rgis, qry)
+
+    def get_children(self, table, columns, order):
+        """
+        Rows of a cross-sections child table sorted in the same order as cross-sections.
+
+        Args:
+            table (str): Name of the child table.
+            columns (str): Selected columns of the child table (aliased as 'c').
+            order (str): Ordering of rows belonging to the same cross-section.
+
+        Returns:
+            ChildRows: Child rows grouped by "XsecID".
+        """
+        qry = '''
+SELECT
+    c."XsecID",
+    {2}
+FROM
+    "{0}"."{1}" AS c
+    JOIN "{0}"."XSCutLines" AS xs ON xs."XsecID" = c."XsecID"
+ORDER BY
+    xs."RiverCode",
+    xs."Station",
+    xs."XsecID",
+    {3};
+'''
+        qry = qry.format(self.schema, table, columns, order)
+        return ChildRows(RasGisImport.stream_rows(self.rgis, qry), 'XsecID')
+
+    def get_nvalues(self):
+        return self.get_children('Manning', 'c."Fraction", c."N_Value"', 'c."Fraction"')
+
+    def get_levee_points(self):
+        return self.get_children('LeveePoints', 'c."LeveeID", c."Fraction", c."Elevation"', 'c."LeveeID"')
+
+    def get_ineffs(self):
+        return self.get_children('IneffLines', 'c."IneffID", c."FromFract", c."ToFract", c."Elevation"', 'c."IneffID"')
+
+    def get_blocks(self):
+        return self.get_children('BlockLines', 'c."BlockID", c."FromFract", c."ToFract", c."Elevation"', 'c."BlockID"')
+
+    def get_surf(self):
+        return self.get_children('XSSurface', 'ST_X(c.geom) AS x, ST_Y(c.geom) AS y, c."Elevation"', 'c."Station"')
 
     def build_cross_sections(self):
         xsec_all = 'BEGIN CROSS-SECTIONS:\n'
@@ -348,47 +385,43 @@ ORDER BY
 {5}   END:
 '''
         xsec_end = '\nEND CROSS-SECTIONS:\n\n'
+        all_nvalues = self.get_nvalues()
+        all_levee_points = self.get_levee_points()
+        all_ineffs = self.get_ineffs()
+        all_blocks = self.get_blocks()
+        all_surfs = self.get_surf()
+        yield xsec_all
         for cs in self.get_xsections():
             xs_id = cs['XsecID']
             attrs = cs[1:-1]
-            nvalues = ''
-            levee_points = ''
-            ineffs = ''
-            blocks = ''
-            cuts = ''
-            surfs = ''
-            for n in self.get_nvalues(xs_id):
-                nvalues += xsec_nval.format(n['Fraction'], n['N_Value'])
-            for l in self.get_levee_points(xs_id):
-                levee_points += xsec_levee_points.format(l['LeveeID'], l['Fraction'], l['Elevation'])
-            for i in self.get_ineffs(xs_id):
-                ineffs += xsec_ineff.format(i['IneffID'], i['FromFract'], i['ToFract'], i['Elevation'])
-            for b in self.get_blocks(xs_id):
-                blocks += xsec_block.format(b['BlockID'], b['FromFract'], b['ToFract'], b['Elevation'])
+            nvalues = ''.join(xsec_nval.format(n['Fraction'], n['N_Value']) for n in all_nvalues.take(xs_id))
+            levee_points = ''.join(xsec_levee_points.format(l['LeveeID'], l['Fraction'], l['Elevation']) for l in all_levee_points.take(xs_id))
+            ineffs = ''.join(xsec_ineff.format(i['IneffID'], i['FromFract'], i['ToFract'], i['Elevation']) for i in all_ineffs.take(xs_id))
+            blocks = ''.join(xsec_block.format(b['BlockID'], b['FromFract'], b['ToFract'], b['Elevation']) for b in all_blocks.take(xs_id))
             pnts = RasGisImport.unpack_wkt(cs['wkt'])
-            for pt in pnts:
-                x, y = pt
-                cuts += xsec_cut.format(x, y)
-            for s in self.get_surf(xs_id):
-                surfs += xsec_surf.format(s['x'], s['y'], s['Elevation'])
-            xsec_all += xsec_cross.format(nvalues, levee_points, ineffs, blocks, cuts, surfs, *attrs)
-        xsec_all += xsec_end
-        return xsec_all
+            cuts = ''.join(xsec_cut.format(x, y) for x, y in pnts)
+            surfs = ''.join(xsec_surf.format(s['x'], s['y'], s['Elevation']) for s in all_surfs.take(xs_id))
+            yield xsec_cross.format(nvalues, levee_points, ineffs, blocks, cuts, surfs, *attrs)
+        yield xsec_end
 
 
-class BridgesBuilder(object):
+class StructureBuilder(object):
     """
-    Return BRIDGES part of RAS GIS Import file.
+    Base class for builders of structures with a cut line and a surface line.
     """
+    table = None
+    surface_table = None
+    key = None
+
     def __init__(self, rgis):
         self.rgis = rgis
         self.schema = rgis.rdb.SCHEMA
-        self.components = ['Bridges', 'BRSurface']
+        self.components = [self.table, self.surface_table]
 
-    def get_bridges(self):
+    def get_structures(self):
         qry = '''
 SELECT
-    "BridgeID",
+    "{2}",
     "RiverCode",
     "ReachCode",
     "Station",
@@ -397,30 +430,35 @@ SELECT
     "NodeName",
     ST_AsText(geom) AS wkt
 FROM
-    "{0}"."Bridges";
+    "{0}"."{1}"
+ORDER BY
+    "{2}";
 '''
-        qry = qry.format(self.schema)
-        bridges = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if bridges is None:
-            return []
-        else:
-            return bridges
-
-    def get_surf(self, br_id):
-        qry = 'SELECT ST_X(geom) AS x, ST_Y(geom) AS y, "Elevation" FROM "{0}"."BRSurface" WHERE "BridgeID" = {1} ORDER BY "Station";'
-        qry = qry.format(self.schema, br_id)
-        surfs = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if surfs is None:
-            return []
-        else:
-            return surfs
+        qry = qry.format(self.schema, self.table, self.key)
+        return RasGisImport.stream_rows(self.rgis, qry)
 
-    def build_bridges(self):
-        bridges_all = 'BEGIN BRIDGES/CULVERTS:\n'
-        bridge_cut = '         {0}, {1}\n'
-        bridge_surf = '         {0}, {1}, {2}\n'
-        bridge_object = '''
-   BRIDGE/CULVERT:
+    def get_surf(self):
+        qry = '''
+SELECT
+    c."{3}",
+    ST_X(c.geom) AS x,
+    ST_Y(c.geom) AS y,
+    c."Elevation"
+FROM
+    "{0}"."{2}" AS c
+    JOIN "{0}"."{1}" AS p ON p."{3}" = c."{3}"
+ORDER BY
+    p."{3}",
+    c."Station";
+'''
+        qry = qry.format(self.schema, self.table, self.surface_table, self.key)
+        return ChildRows(RasGisImport.stream_rows(self.rgis, qry), self.key)
+
+    def build_structures(self, begin, name, end):
+        str_cut = '         {0}, {1}\n'
+        str_surf = '         {0}, {1}, {2}\n'
+        str_object = '''
+   {8}:
       STREAM ID: {0}
       REACH ID: {1}
       STATION: {2}
@@ -431,162 +469,50 @@ FROM
 {6}   SURFACE LINE:
 {7}   END:
 '''
-        bridges_end = '\nEND BRIDGES/CULVERTS:\n\n'
-        for br in self.get_bridges():
-            br_id = br['BridgeID']
-            cuts = ''
-            surfs = ''
-            pnts = RasGisImport.unpack_wkt(br['wkt'])
-            for pt in pnts:
-                x, y = pt
-                cuts += bridge_cut.format(x, y)
-            for s in self.get_surf(br_id):
-                surfs += bridge_surf.format(s['x'], s['y'], s['Elevation'])
-            bridges_all += bridge_object.format(br['RiverCode'], br['ReachCode'], br['Station'], br['NodeName'], br['USDistance'], br['TopWidth'], cuts, surfs)
-        bridges_all += bridges_end
-        return bridges_all
-
-
-class InlineStrBuilder(object):
+        all_surfs = self.get_surf()
+        yield begin
+        for st in self.get_structures():
+            pnts = RasGisImport.unpack_wkt(st['wkt'])
+            cuts = ''.join(str_cut.format(x, y) for x, y in pnts)
+            surfs = ''.join(str_surf.format(s['x'], s['y'], s['Elevation']) for s in all_surfs.take(st[self.key]))
+            yield str_object.format(st['RiverCode'], st['ReachCode'], st['Station'], st['NodeName'], st['USDistance'], st['TopWidth'], cuts, surfs, name)
+        yield end
+
+
+class BridgesBuilder(StructureBuilder):
     """
-    Return INLINE STRUCTURES part of RAS GIS Import file.
+    Return BRIDGES part of RAS GIS Import file.
     """
-    def __init__(self, rgis):
-        self.rgis = rgis
-        self.schema = rgis.rdb.SCHEMA
-        self.components = ['InlineStructures', 'ISSurface']
+    table = 'Bridges'
+    surface_table = 'BRSurface'
+    key = 'BridgeID'
 
-    def get_inline_str(self):
-        qry = '''
-SELECT
-    "InlineSID",
-    "RiverCode",
-    "ReachCode",
-    "Station",
-    "USDistance",
-    "TopWidth",
-    "NodeName",
-    ST_AsText(geom) AS wkt
-FROM
-    "{0}"."InlineStructures";
-'''
-        qry = qry.format(self.schema)
-        inline_str = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if inline_str is None:
-            return []
-        else:
-            return inline_str
-
-    def get_surf(self, ins_id):
-        qry = 'SELECT ST_X(geom) AS x, ST_Y(geom) AS y, "Elevation" FROM "{0}"."ISSurface" WHERE "InlineSID" = {1} ORDER BY "Station";'
-        qry = qry.format(self.schema, ins_id)
-        surfs = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if surfs is None:
-            return []
-        else:
-            return surfs
+    def build_bridges(self):
+        return self.build_structures('BEGIN BRIDGES/CULVERTS:\n', 'BRIDGE/CULVERT', '\nEND BRIDGES/CULVERTS:\n\n')
+
+
+class InlineStrBuilder(StructureBuilder):
+    """
+    Return INLINE STRUCTURES part of RAS GIS Import file.
+    """
+    table = 'InlineStructures'
+    surface_table = 'ISSurface'
+    key = 'InlineSID'
 
     def build_inline_str(self):
-        inline_str_all = 'BEGIN INLINE STRUCTURES:\n'
-        inline_str_cut = '         {0}, {1}\n'
-        inline_str_surf = '         {0}, {1}, {2}\n'
-        inline_str_object = '''
-   INLINE STRUCTURE:
-      STREAM ID: {0}
-      REACH ID: {1}
-      STATION: {2}
-      NODE NAME: {3}
-      US DISTANCE: {4}
-      TOP WIDTH: {5}
-      CUT LINE:
-{6}   SURFACE LINE:
-{7}   END:
-'''
-        inline_str_end = '\nEND INLINE STRUCTURES:\n\n'
-        for ins in self.get_inline_str():
-            ins_id = ins['InlineSID']
-            cuts = ''
-            surfs = ''
-            pnts = RasGisImport.unpack_wkt(ins['wkt'])
-            for pt in pnts:
-                x, y = pt
-                cuts += inline_str_cut.format(x, y)
-            for s in self.get_surf(ins_id):
-                surfs += inline_str_surf.format(s['x'], s['y'], s['Elevation'])
-            inline_str_all += inline_str_object.format(ins['RiverCode'], ins['ReachCode'], ins['Station'], ins['NodeName'], ins['USDistance'], ins['TopWidth'], cuts, surfs)
-        inline_str_all += inline_str_end
-        return inline_str_all
-
-
-class LateralStrBuilder(object):
+        return self.build_structures('BEGIN INLINE STRUCTURES:\n', 'INLINE STRUCTURE', '\nEND INLINE STRUCTURES:\n\n')
+
+
+class LateralStrBuilder(StructureBuilder):
     """
     Return LATERAL STRUCTURES part of RAS GIS Import file.
     """
-    def __init__(self, rgis):
-        self.rgis = rgis
-        self.schema = rgis.rdb.SCHEMA
-        self.components = ['LateralStructures', 'LSSurface']
-
-    def get_lateral_str(self):
-        qry = '''
-SELECT
-    "LateralSID",
-    "RiverCode",
-    "ReachCode",
-    "Station",
-    "USDistance",
-    "TopWidth",
-    "NodeName",
-    ST_AsText(geom) AS wkt
-FROM
-    "{0}"."LateralStructures";
-'''
-        qry = qry.format(self.schema)
-        lateral_str = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if lateral_str is None:
-            return []
-        else:
-            return lateral_str
-
-    def get_surf(self, ls_id):
-        qry = 'SELECT ST_X(geom) AS x, ST_Y(geom) AS y, "Elevation" FROM "{0}"."LSSurface" WHERE "LateralSID" = {1} ORDER BY "Station";'
-        qry = qry.format(self.schema, ls_id)
-        surfs = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if surfs is None:
-            return []
-        else:
-            return surfs
+    table = 'LateralStructures'
+    surface_table = 'LSSurface'
+    key = 'LateralSID'
 
     def build_lateral_str(self):
-        lateral_str_all = 'BEGIN LATERAL STRUCTURES:\n'
-        lateral_str_cut = '         {0}, {1}\n'
-        lateral_str_surf = '         {0}, {1}, {2}\n'
-        lateral_str_object = '''
-   LATERAL STRUCTURE:
-      STREAM ID: {0}
-      REACH ID: {1}
-      STATION: {2}
-      NODE NAME: {3}
-      US DISTANCE: {4}
-      TOP WIDTH: {5}
-      CUT LINE:
-{6}   SURFACE LINE:
-{7}   END:
-'''
-        lateral_str_end = '\nEND LATERAL STRUCTURES:\n\n'
-        for ls in self.get_lateral_str():
-            ls_id = ls['LateralSID']
-            cuts = ''
-            surfs = ''
-            pnts = RasGisImport.unpack_wkt(ls['wkt'])
-            for pt in pnts:
-                x, y = pt
-                cuts += lateral_str_cut.format(x, y)
-            for s in self.get_surf(ls_id):
-                surfs += lateral_str_surf.format(s['x'], s['y'], s['Elevation'])
-            lateral_str_all += lateral_str_object.format(ls['RiverCode'], ls['ReachCode'], ls['Station'], ls['NodeName'], ls['USDistance'], ls['TopWidth'], cuts, surfs)
-        lateral_str_all += lateral_str_end
-        return lateral_str_all
+        return self.build_structures('BEGIN LATERAL STRUCTURES:\n', 'LATERAL STRUCTURE', '\nEND LATERAL STRUCTURES:\n\n')
 
 
 class LeveesBuilder(object):
@@ -599,13 +525,9 @@ class LeveesBuilder(object):
         self.components = ['LeveeAlignment']
 
     def get_levees(self):
-        qry = 'SELECT "LeveeID", ST_AsText(geom) AS wkt FROM "{0}"."LeveeAlignment";'
+        qry = 'SELECT "LeveeID", ST_AsText(geom) AS wkt FROM "{0}"."LeveeAlignment" ORDER BY "LeveeID";'
         qry = qry.format(self.schema)
-        levees = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if levees is None:
-            return []
-        else:
-            return levees
+        return RasGisImport.stream_rows(self.rgis, qry)
 
     def build_levees(self):
         levees_all = 'BEGIN LEVEES:\n'
@@ -616,16 +538,12 @@ class LeveesBuilder(object):
 '''
         levees_surf = '         {0}, {1}, None\n'
         levees_end = '\nEND LEVEES:\n\n'
+        yield levees_all
         for l in self.get_levees():
-            surfs = ''
-            levee_id = l['LeveeID']
             pnts = RasGisImport.unpack_wkt(l['wkt'])
-            for pt in pnts:
-                x, y = pt
-                surfs += levees_surf.format(x, y)
-            levees_all += levee_object.format(levee_id, surfs)
-        levees_all += levees_end
-        return levees_all
+            surfs = ''.join(levees_surf.format(x, y) for x, y in pnts)
+            yield levee_object.format(l['LeveeID'], surfs)
+        yield levees_end
 
 
 class IneffAreasBuilder(object):
@@ -638,13 +556,9 @@ class IneffAreasBuilder(object):
         self.components = ['IneffAreas']
 
     def get_ineffective_areas(self):
-        qry = 'SELECT "IneffID", ST_AsText(geom) AS wkt FROM "{0}"."IneffAreas";'
+        qry = 'SELECT "IneffID", ST_AsText(geom) AS wkt FROM "{0}"."IneffAreas" ORDER BY "IneffID";'
         qry = qry.format(self.schema)
-        ineff_areas = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if ineff_areas is None:
-            return []
-        else:
-            return ineff_areas
+        return RasGisImport.stream_rows(self.rgis, qry)
 
     def build_ineff_areas(self):
         ineff_all = 'BEGIN INEFFECTIVE AREAS:\n'
@@ -655,16 +569,12 @@ class IneffAreasBuilder(object):
 '''
         ineff_vertex = '         {0}, {1}\n'
         ineff_end = '\nEND INEFFECTIVE AREAS:\n\n'
+        yield ineff_all
         for i in self.get_ineffective_areas():
-            vertices = ''
-            ineff_id = i['IneffID']
             pnts = RasGisImport.unpack_wkt(i['wkt'])
-            for pt in pnts:
-                x, y = pt
-                vertices += ineff_vertex.format(x, y)
-            ineff_all += ineff_poly.format(ineff_id, vertices)
-        ineff_all += ineff_end
-        return ineff_all
+            vertices = ''.join(ineff_vertex.format(x, y) for x, y in pnts)
+            yield ineff_poly.format(i['IneffID'], vertices)
+        yield ineff_end
 
 
 class BlockedObsBuilder(object):
@@ -677,13 +587,9 @@ class BlockedObsBuilder(object):
         self.components = ['BlockedObs']
 
     def get_blocked_obstructions(self):
-        qry = 'SELECT "BlockID", ST_AsText(geom) AS wkt FROM "{0}"."BlockedObs";'
+        qry = 'SELECT "BlockID", ST_AsText(geom) AS wkt FROM "{0}"."BlockedObs" ORDER BY "BlockID";'
         qry = qry.format(self.schema)
-        block_obs = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if block_obs is None:
-            return []
-        else:
-            return block_obs
+        return RasGisImport.stream_rows(self.rgis, qry)
 
     def build_blocked_obs(self):
         block_all = 'BEGIN BLOCKED OBSTRUCTIONS:\n'
@@ -694,16 +600,12 @@ class BlockedObsBuilder(object):
 '''
         block_vertex = '         {0}, {1}\n'
         block_end = '\nEND BLOCKED OBSTRUCTIONS:\n\n'
+        yield block_all
         for b in self.get_blocked_obstructions():
-            vertices = ''
-            block_id = b['BlockID']
             pnts = RasGisImport.unpack_wkt(b['wkt'])
-            for pt in pnts:
-                x, y = pt
-                vertices += block_vertex.format(x, y)
-            block_all += block_poly.format(block_id, vertices)
-        block_all += block_end
-        return block_all
+            vertices = ''.join(block_vertex.format(x, y) for x, y in pnts)
+            yield block_poly.format(b['BlockID'], vertices)
+        yield block_end
 
 
 class StorageAreasBuilder(object):
@@ -716,22 +618,25 @@ class StorageAreasBuilder(object):
         self.components = ['StorageAreas', 'SAVolume']
 
     def get_storage_areas(self):
-        qry = 'SELECT "StorageID", ST_AsText(geom) AS wkt FROM "{0}"."StorageAreas";'
+        qry = 'SELECT "StorageID", ST_AsText(geom) AS wkt FROM "{0}"."StorageAreas" ORDER BY "StorageID";'
         qry = qry.format(self.schema)
-        storage_areas = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if storage_areas is None:
-            return []
-        else:
-            return storage_areas
-
-    def get_storage_volume(self, sa_id):
-        qry = 'SELECT "level", "volume" FROM "{0}"."SAVolume" WHERE "StorageID" = {1} ORDER BY "level";'
-        qry = qry.format(self.schema, sa_id)
-        storage_volume = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if storage_volume is None:
-            return []
-        else:
-            return storage_volume
+        return RasGisImport.stream_rows(self.rgis, qry)
+
+    def get_storage_volume(self):
+        qry = '''
+SELECT
+    v."StorageID",
+    v."level",
+    v."volume"
+FROM
+    "{0}"."SAVolume" AS v
+    JOIN "{0}"."StorageAreas" AS sa ON sa."StorageID" = v."StorageID"
+ORDER BY
+    sa."StorageID",
+    v."level";
+'''
+        qry = qry.format(self.schema)
+        return ChildRows(RasGisImport.stream_rows(self.rgis, qry), 'StorageID')
 
     def build_storage_areas(self):
         sa_all = 'BEGIN STORAGE AREAS:\n'
@@ -747,19 +652,15 @@ class StorageAreasBuilder(object):
         sa_vertex = '         {0}, {1}\n'
         sa_elev = '         {0}, {1}\n'
         sa_end = '\nEND STORAGE AREAS:\n\n'
+        all_volumes = self.get_storage_volume()
+        yield sa_all
         for s in self.get_storage_areas():
-            vertices = ''
-            elev = ''
             sa_id = s['StorageID']
             pnts = RasGisImport.unpack_wkt(s['wkt'])
-            for pt in pnts:
-                x, y = pt
-                vertices += sa_vertex.format(x, y)
-            for v in self.get_storage_volume(sa_id):
-                elev += sa_elev.format(v['level'], v['volume'])
-            sa_all += sa_poly.format(sa_id, vertices, elev)
-        sa_all += sa_end
-        return sa_all
+            vertices = ''.join(sa_vertex.format(x, y) for x, y in pnts)
+            elev = ''.join(sa_elev.format(v['level'], v['volume']) for v in all_volumes.take(sa_id))
+            yield sa_poly.format(sa_id, vertices, elev)
+        yield sa_end
 
 
 class SAConnectionsBuilder(object):
@@ -772,22 +673,26 @@ class SAConnectionsBuilder(object):
         self.components = ['SAConnections', 'SACSurface']
 
     def get_sa_conn(self):
-        qry = 'SELECT "SAConnID", "USSA", "DSSA", "TopWidth", "NodeName", ST_AsText(geom) AS wkt FROM "{0}"."SAConnections";'
+        qry = 'SELECT "SAConnID", "USSA", "DSSA", "TopWidth", "NodeName", ST_AsText(geom) AS wkt FROM "{0}"."SAConnections" ORDER BY "SAConnID";'
         qry = qry.format(self.schema)
-        sa_connections = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if sa_connections is None:
-            return []
-        else:
-            return sa_connections
-
-    def get_surf(self, sac_id):
-        qry = 'SELECT ST_X(geom) AS x, ST_Y(geom) AS y, "Elevation" FROM "{0}"."SACSurface" WHERE "SAConnID" = {1} ORDER BY "Station";'
-        qry = qry.format(self.schema, sac_id)
-        surfs = self.rgis.rdb.run_query(qry, fetch=True, be_quiet=True)
-        if surfs is None:
-            return []
-        else:
-            return surfs
+        return RasGisImport.stream_rows(self.rgis, qry)
+
+    def get_surf(self):
+        qry = '''
+SELECT
+    c."SAConnID",
+    ST_X(c.geom) AS x,
+    ST_Y(c.geom) AS y,
+    c."Elevation"
+FROM
+    "{0}"."SACSurface" AS c
+    JOIN "{0}"."SAConnections" AS sac ON sac."SAConnID" = c."SAConnID"
+ORDER BY
+    sac."SAConnID",
+    c."Station";
+'''
+        qry = qry.format(self.schema)
+        return ChildRows(RasGisImport.stream_rows(self.rgis, qry), 'SAConnID')
 
     def build_sa_connections(self):
         sa_conn_all = 'BEGIN SA CONNECTIONS:\n'
@@ -805,16 +710,11 @@ class SAConnectionsBuilder(object):
 {6}   END:
 '''
         sa_conn_end = '\nEND SA CONNECTIONS:\n\n'
+        all_surfs = self.get_surf()
+        yield sa_conn_all
         for sac in self.get_sa_conn():
-            sac_id = sac['SAConnID']
-            cuts = ''
-            surfs = ''
             pnts = RasGisImport.unpack_wkt(sac['wkt'])
-            for pt in pnts:
-                x, y = pt
-                cuts += sa_conn_cut.format(x, y)
-            for s in self.get_surf(sac_id):
-                surfs += sa_conn_surf.format(s['x'], s['y'], s['Elevation'])
-            sa_conn_all += sa_conn_object.format(sac['SAConnID'], sac['NodeName'], sac['USSA'], sac['DSSA'], sac['TopWidth'], cuts, surfs)
-        sa_conn_all += sa_conn_end
-        return sa_conn_all
+            cuts = ''.join(sa_conn_cut.format(x, y) for x, y in pnts)
+            surfs = ''.join(sa_conn_surf.format(s['x'], s['y'], s['Elevation']) for s in all_surfs.take(sac['SAConnID']))
+            yield sa_conn_object.format(sac['SAConnID'], sac['NodeName'], sac['USSA'], sac['DSSA'], sac['TopWidth'], cuts, surfs)
+        yield sa_conn_end
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                 : RiverGIS
+Description          : HEC-RAS tools for QGIS
+Date                 : December, 2015
+copyright            : (C) 2015 by RiverGIS Group
+email                : rpasiok@gmail.com, damnback333@gmail.com
+***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from builtins import object
+
+import numpy as np
+
+from qgis.core import Qgis, QgsRectangle
+
+
+class RasterSampler(object):
+    """
+    Block-wise raster reader. Raster values are read in windows covering the requested points
+    and looked up with NumPy instead of identifying every point through the data provider.
+    """
+    TILE = 512
+
+    DTYPES = {
+        Qgis.Byte: np.uint8,
+        Qgis.UInt16: np.uint16,
+        Qgis.Int16: np.int16,
+        Qgis.UInt32: np.uint32,
+        Qgis.Int32: np.int32,
+        Qgis.Float32: np.float32,
+        Qgis.Float64: np.float64}
+
+    def __init__(self, provider, band=1, bilinear=False):
+        """
+        Constructor for raster sampler object
+
+        Args:
+            provider (QgsRasterDataProvider): Data provider of the sampled raster.
+            band (int): Number of the sampled band.
+            bilinear (bool): Flag for bilinear interpolation between cell centers, nearest cell otherwise.
+        """
+        self.provider = provider
+        self.band = band
+        self.bilinear = bilinear
+        extent = provider.extent()
+        self.xmin = extent.xMinimum()
+        self.ymax = extent.yMaximum()
+        self.ncols = provider.xSize()
+        self.nrows = provider.ySize()
+        self.dx = extent.width() / self.ncols
+        self.dy = extent.height() / self.nrows
+        if provider.sourceHasNoDataValue(band):
+            self.nodata = provider.sourceNoDataValue(band)
+        else:
+            self.nodata = None
+
+    @classmethod
+    def from_layer(cls, rlayer, band=1, bilinear=False):
+        return cls(rlayer.dataProvider(), band, bilinear)
+
+    @property
+    def cell_area(self):
+        return self.dx * self.dy
+
+    def to_pixel(self, xs, ys):
+        """
+        Converting map coordinates into fractional column and row numbers.
+
+        Args:
+            xs (numpy.ndarray): X coordinates.
+            ys (numpy.ndarray): Y coordinates.
+
+        Returns:
+            tuple: Arrays of fractional column and row numbers.
+        """
+        px = (np.asarray(xs, dtype=np.float64) - self.xmin) / self.dx
+        py = (self.ymax - np.asarray(ys, dtype=np.float64)) / self.dy
+        return px, py
+
+    def cell_centers(self, col0, row0, ncols, nrows):
+        """
+        Map coordinates of the cell centers of a raster window.
+
+        Returns:
+            tuple: 1D arrays of X coordinates (columns) and Y coordinates (rows).
+        """
+        xs = self.xmin + (np.arange(col0, col0 + ncols) + 0.5) * self.dx
+        ys = self.ymax - (np.arange(row0, row0 + nrows) + 0.5) * self.dy
+        return xs, ys
+
+    def window_for_bbox(self, xmin, ymin, xmax, ymax, pad=0):
+        """
+        Raster window (col0, row0, ncols, nrows) covering a bounding box, clipped to the raster extent.
+        """
+        col0 = max(int(np.floor((xmin - self.xmin) / self.dx)) - pad, 0)
+        row0 = max(int(np.floor((self.ymax - ymax) / self.dy)) - pad, 0)
+        col1 = min(int(np.ceil((xmax - self.xmin) / self.dx)) + pad, self.ncols)
+        row1 = min(int(np.ceil((self.ymax - ymin) / self.dy)) + pad, self.nrows)
+        return col0, row0, max(col1 - col0, 0), max(row1 - row0, 0)
+
+    def read_window(self, col0, row0, ncols, nrows):
+        """
+        Reading a raster window into a NumPy array. No data cells are set to NaN.
+
+        Args:
+            col0 (int): First column of the window.
+            row0 (int): First row of the window.
+            ncols (int): Number of columns.
+            nrows (int): Number of rows.
+
+        Returns:
+            numpy.ndarray: Array of shape (nrows, ncols) with the cell values.
+        """
+        extent = QgsRectangle(
+            self.xmin + col0 * self.dx,
+            self.ymax - (row0 + nrows) * self.dy,
+            self.xmin + (col0 + ncols) * self.dx,
+            self.ymax - row0 * self.dy)
+        block = self.provider.block(self.band, extent, ncols, nrows)
+        dtype = self.DTYPES.get(block.dataType(), np.float64)
+        raw = np.frombuffer(bytes(block.data()), dtype=dtype)
+        values = raw[:ncols * nrows].reshape(nrows, ncols).astype(np.float64)
+        nodata = block.noDataValue() if block.hasNoDataValue() else self.nodata
+        if nodata is not None:
+            values[np.isclose(values, nodata)] = np.nan
+        return values
+
+    def tile_keys(self, cols, rows):
+        """
+        Numbers of raster tiles containing cells given by column and row numbers.
+        """
+        ntiles_x = self.ncols // self.TILE + 1
+        return (rows // self.TILE) * ntiles_x + cols // self.TILE
+
+    def split_by_tiles(self, xs, ys, parts):
+        """
+        Splitting points into spatial chunks of similar size. Points sharing a raster tile are kept in one chunk,
+        so every tile is read by a single chunk only.
+
+        Args:
+            xs (numpy.ndarray): X coordinates of points.
+            ys (numpy.ndarray): Y coordinates of points.
+            parts (int): Requested number of chunks.
+
+        Returns:
+            list: List of arrays with indices of points in each chunk.
+        """
+        px, py = self.to_pixel(xs, ys)
+        keys = self.tile_keys(np.floor(px).astype(np.int64), np.floor(py).astype(np.int64))
+        order = np.argsort(keys, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        if parts <= 1 or bounds.size == 0:
+            return [order]
+        targets = np.linspace(0, order.size, parts + 1)[1:-1]
+        cuts = np.unique(bounds[np.minimum(np.searchsorted(bounds, targets), bounds.size - 1)])
+        return np.split(order, cuts)
+
+    def sample(self, xs, ys):
+        """
+        Sampling raster values at points. Points are grouped by raster tiles and each tile is read once.
+
+        Args:
+            xs (numpy.ndarray): X coordinates of points.
+            ys (numpy.ndarray): Y coordinates of points.
+
+        Returns:
+            numpy.ndarray: Raster values at points. NaN for points outside the raster or at no data cells.
+        """
+        px, py = self.to_pixel(xs, ys)
+        values = np.full(px.shape, np.nan)
+        inside = np.flatnonzero((px >= 0) & (px < self.ncols) & (py >= 0) & (py < self.nrows))
+        if inside.size == 0:
+            return values
+        cols = np.floor(px[inside]).astype(np.int64)
+        rows = np.floor(py[inside]).astype(np.int64)
+        ntiles_x = self.ncols // self.TILE + 1
+        keys = self.tile_keys(cols, rows)
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        for key, idx in zip(keys[np.r_[0, bounds]], np.split(order, bounds)):
+            tile_row, tile_col = divmod(int(key), ntiles_x)
+            col0 = max(tile_col * self.TILE - 1, 0)
+            row0 = max(tile_row * self.TILE - 1, 0)
+            ncols = min(tile_col * self.TILE + self.TILE + 1, self.ncols) - col0
+            nrows = min(tile_row * self.TILE + self.TILE + 1, self.nrows) - row0
+            window = self.read_window(col0, row0, ncols, nrows)
+            pts = inside[idx]
+            if self.bilinear is True:
+                values[pts] = self.interpolate(window, px[pts] - col0, py[pts] - row0)
+            else:
+                values[pts] = window[rows[idx] - row0, cols[idx] - col0]
+        return values
+
+    @staticmethod
+    def interpolate(window, px, py):
+        """
+        Bilinear interpolation between cell centers of a window. Where any of the four neighbouring cells
+        has no data, the value of the nearest cell is used.
+
+        Args:
+            window (numpy.ndarray): Raster window values.
+            px (numpy.ndarray): Fractional column numbers inside the window.
+            py (numpy.ndarray): Fractional row numbers inside the window.
+
+        Returns:
+            numpy.ndarray: Interpolated values.
+        """
+        nrows, ncols = window.shape
+        nearest = window[np.clip(np.floor(py).astype(np.int64), 0, nrows - 1), np.clip(np.floor(px).astype(np.int64), 0, ncols - 1)]
+        if nrows < 2 or ncols < 2:
+            return nearest
+        fx = np.clip(px - 0.5, 0, ncols - 1)
+        fy = np.clip(py - 0.5, 0, nrows - 1)
+        c0 = np.minimum(np.floor(fx).astype(np.int64), ncols - 2)
+        r0 = np.minimum(np.floor(fy).astype(np.int64), nrows - 2)
+        wx = fx - c0
+        wy = fy - r0
+        top = window[r0, c0] * (1 - wx) + window[r0, c0 + 1] * wx
+        bottom = window[r0 + 1, c0] * (1 - wx) + window[r0 + 1, c0 + 1] * wx
+        result = top * (1 - wy) + bottom * wy
+        return np.where(np.isnan(result), nearest, result)
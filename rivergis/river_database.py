@@ -22,10 +22,57 @@ from builtins import object
 
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 
 from qgis.core import QgsVectorLayer, QgsProject, QgsDataSourceUri, NULL
 from qgis.gui import QgsMessageBar
 import os
+from contextlib import contextmanager
+
+
+class CopyStream(object):
+    """
+    File-like object streaming rows in PostgreSQL COPY text format.
+    """
+    ESCAPES = {ord('\\'): '\\\\', ord('\t'): '\\t', ord('\n'): '\\n', ord('\r'): '\\r'}
+
+    def __init__(self, rows):
+        """
+        Constructor for COPY stream object
+
+        Args:
+            rows (iterable): Rows (sequences of values) to be streamed. None values are written as NULL.
+        """
+        self.rows = iter(rows)
+        self.buf = ''
+        self.count = 0
+
+    @classmethod
+    def format_row(cls, row):
+        vals = ['\\N' if v is None else '{0}'.format(v).translate(cls.ESCAPES) for v in row]
+        return '\t'.join(vals) + '\n'
+
+    def read(self, size=-1):
+        parts = [self.buf]
+        length = len(self.buf)
+        while size < 0 or length < size:
+            try:
+                line = self.format_row(next(self.rows))
+            except StopIteration:
+                break
+            self.count += 1
+            parts.append(line)
+            length += len(line)
+        data = ''.join(parts)
+        if size < 0:
+            self.buf = ''
+            return data
+        else:
+            self.buf = data[size:]
+            return data[:size]
+
+    def readline(self, size=-1):
+        return self.read(size)
 
 
 class RiverDatabase(object):
@@ -37,6 +84,8 @@ class RiverDatabase(object):
     OVERWRITE = True
     LOAD_ALL = True
     CHECK_URI = True
+    POOL_SIZE = 16
+    COPY_BATCH = 10000
 
     def __init__(self, rgis, dbname, host, port, user, password):
         """
@@ -57,6 +106,12 @@ class RiverDatabase(object):
         self.user = user
         self.password = password
         self.con = None
+        self.pool = None
+        self.cursor_counter = 0
+        self.tx_depth = 0
+        self.tx_failed = False
+        self.tx_register = None
+        self.tx_views = []
         self.register = {}
         self.queries = {}
         self.uris = []
@@ -73,7 +128,8 @@ class RiverDatabase(object):
         msg = None
         try:
             conn_params = 'dbname={0} host={1} port={2} user={3} password={4}'.format(self.dbname, self.host, self.port, self.user, self.password)
-            self.con = psycopg2.connect(conn_params)
+            self.pool = psycopg2.pool.ThreadedConnectionPool(1, self.POOL_SIZE, conn_params)
+            self.con = self.pool.getconn()
             msg = 'Connection established.'
         except Exception as e:
             self.rgis.iface.messageBar().pushMessage("Error", 'Can\'t connect to PostGIS database. Check connection details!', level=QgsMessageBar.CRITICAL, duration=10)
@@ -87,13 +143,95 @@ class RiverDatabase(object):
         Closing connection to database.
         """
         if self.con:
-            self.con.close()
+            self.pool.closeall()
+            self.pool = None
             self.con = None
+            self.tx_depth = 0
+            self.tx_failed = False
             self.register.clear()
             self.queries.clear()
         else:
             self.rgis.addInfo('Can not disconnect. There is no opened connection!')
 
+    @contextmanager
+    def connection(self):
+        """
+        Context manager lending a pooled database connection, e.g. for work done in a worker thread.
+        The connection is committed on success, rolled back on error and returned to the pool.
+
+        Yields:
+            psycopg2 connection object: Connection from the pool.
+        """
+        con = self.pool.getconn()
+        try:
+            yield con
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            self.pool.putconn(con)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager running all queries inside the block in a single transaction on the main connection.
+        If any query fails, the following queries are skipped and the whole block is rolled back.
+        Layers added to view inside the block are loaded after commit. Blocks can be nested.
+        """
+        if self.tx_depth == 0:
+            self.tx_failed = False
+            self.tx_register = dict(self.register)
+            self.tx_views = []
+        self.tx_depth += 1
+        try:
+            yield self
+        except Exception:
+            self.tx_failed = True
+            raise
+        finally:
+            self.tx_depth -= 1
+            if self.tx_depth == 0:
+                self.end_transaction()
+
+    def end_transaction(self):
+        """
+        Committing or rolling back the outermost transaction block.
+        """
+        views, self.tx_views = self.tx_views, []
+        if not self.con:
+            return
+        if self.tx_failed is True:
+            self.con.rollback()
+            self.register.clear()
+            self.register.update(self.tx_register)
+            self.rgis.addInfo('Transaction rolled back. No changes were saved in the database.')
+        else:
+            self.con.commit()
+            for obj in views:
+                self.add_to_view(obj)
+        self.tx_failed = False
+        self.tx_register = None
+
+    def commit(self):
+        """
+        Committing the main connection unless a transaction block is open.
+        """
+        if self.tx_depth == 0:
+            self.con.commit()
+        else:
+            pass
+
+    def rollback(self):
+        """
+        Rolling back the main connection. Inside a transaction block the whole block is marked as failed.
+        """
+        self.con.rollback()
+        if self.tx_depth > 0:
+            self.tx_failed = True
+        else:
+            pass
+
     def run_query(self, qry, fetch=False, arraysize=0, be_quiet=False):
         """
         Running PostgreSQL queries.
@@ -102,29 +240,38 @@ class RiverDatabase(object):
             qry (str): Query for database.
             fetch (bool): Flag for returning result from query.
             arraysize (int): Number of items returned from query - default 0 mean using fetchall method.
+                If greater than 0, a single SELECT query is streamed through a server-side cursor.
             be_quiet (bool): Flag for printing exception message.
 
         Returns:
             list/generator/None: Returned value depends on the 'fetch' and 'arraysize' parameters.
         """
         result = None
+        if self.tx_failed is True:
+            if be_quiet is False:
+                self.rgis.addInfo('Query skipped - the current transaction has been aborted.')
+            return result
         try:
             if self.con:
-                cur = self.con.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                cur.execute(qry)
-                if fetch is True and arraysize <= 0:
-                    result = cur.fetchall()
-                elif fetch is True and arraysize > 0:
+                if fetch is True and arraysize > 0:
+                    cur = self.con.cursor(self.cursor_name(), cursor_factory=psycopg2.extras.DictCursor, withhold=True)
+                    cur.itersize = arraysize
+                    cur.execute(qry)
                     result = self.result_iter(cur, arraysize)
                 else:
-                    result = []
-                self.con.commit()
+                    cur = self.con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+                    cur.execute(qry)
+                    if fetch is True:
+                        result = cur.fetchall()
+                    else:
+                        result = []
+                    self.commit()
             else:
                 msg = 'There is no opened connection!'
                 msg += 'Please check your database connection authentication settings.'
                 self.rgis.addInfo(msg)
         except Exception as e:
-            self.con.rollback()
+            self.rollback()
             if be_quiet is False:
                 self.rgis.addInfo(repr(e))
             else:
@@ -132,10 +279,123 @@ class RiverDatabase(object):
         finally:
             return result
 
-    @staticmethod
-    def result_iter(cursor, arraysize):
+    def cursor_name(self):
+        """
+        Unique name for a server-side cursor.
+
+        Returns:
+            str: Cursor name.
+        """
+        self.cursor_counter += 1
+        return 'rgis_cursor_{0}'.format(self.cursor_counter)
+
+    def update_from_rows(self, table, key, columns, rows, schema=None, be_quiet=False):
+        """
+        Updating table columns in bulk. Rows are streamed with COPY into a temporary table
+        and applied with a single set-based UPDATE ... FROM.
+
+        Args:
+            table (str): Name of the updated table.
+            key (tuple): Key column definition ('"column_name"', 'column_type') used to match rows.
+            columns (list): List of tuples ('"column_name"', 'column_type') of updated columns.
+            rows (iterable): Rows of values ordered as key + columns.
+            schema (str): Schema of the updated table.
+            be_quiet (bool): Flag for printing exception message.
+
+        Returns:
+            int/None: Number of updated rows or None if update failed.
+        """
+        if schema is None:
+            SCHEMA = self.SCHEMA
+        else:
+            SCHEMA = schema
+        if not self.con:
+            self.rgis.addInfo('There is no opened connection!')
+            return None
+        if self.tx_failed is True:
+            return None
+        tmp = 'rgis_{0}_update'.format(table.lower())
+        attrs = [key] + list(columns)
+        create = 'CREATE TEMP TABLE "{0}" ({1}) ON COMMIT DROP;'
+        create = create.format(tmp, ', '.join(' '.join(attr) for attr in attrs))
+        copy = 'COPY "{0}" ({1}) FROM STDIN;'.format(tmp, ', '.join(attr[0] for attr in attrs))
+        update = '''
+UPDATE "{0}"."{1}" AS t
+SET
+    {2}
+FROM
+    "{3}" AS u
+WHERE
+    t.{4} = u.{4};
+'''
+        sets = ',\n    '.join('{0} = u.{0}'.format(col[0]) for col in columns)
+        update = update.format(SCHEMA, table, sets, tmp, key[0])
+        result = None
+        try:
+            cur = self.con.cursor()
+            cur.execute(create)
+            cur.copy_expert(copy, CopyStream(rows))
+            cur.execute('ANALYZE "{0}";'.format(tmp))
+            cur.execute(update)
+            result = cur.rowcount
+            cur.execute('DROP TABLE "{0}";'.format(tmp))
+            self.commit()
+        except Exception as e:
+            self.rollback()
+            if be_quiet is False:
+                self.rgis.addInfo(repr(e))
+            else:
+                pass
+        finally:
+            return result
+
+    def copy_rows(self, table, columns, rows, schema=None, be_quiet=False):
+        """
+        Inserting rows in bulk with COPY ... FROM STDIN.
+        Geometry values can be passed as EWKT strings, e.g. 'SRID=2180;POINT(1 2)'.
+
+        Args:
+            table (str): Name of the target table.
+            columns (list): List of target column names ('"column_name"').
+            rows (iterable): Rows of values ordered as columns.
+            schema (str): Schema of the target table.
+            be_quiet (bool): Flag for printing exception message.
+
+        Returns:
+            int/None: Number of inserted rows or None if insert failed.
+        """
+        if schema is None:
+            SCHEMA = self.SCHEMA
+        else:
+            SCHEMA = schema
+        if not self.con:
+            self.rgis.addInfo('There is no opened connection!')
+            return None
+        if self.tx_failed is True:
+            return None
+        copy = 'COPY "{0}"."{1}" ({2}) FROM STDIN;'.format(SCHEMA, table, ', '.join(columns))
+        result = None
+        try:
+            cur = self.con.cursor()
+            stream = CopyStream(rows)
+            cur.copy_expert(copy, stream)
+            result = stream.count
+            self.commit()
+        except Exception as e:
+            self.rollback()
+            if be_quiet is False:
+                self.rgis.addInfo(repr(e))
+            else:
+                pass
+        finally:
+            return result
+
+    def result_iter(self, cursor, arraysize):
         """
         Generator for getting partial results from query.
+        Rows are fetched from a server-side cursor, so only 'arraysize' rows are held in memory at once.
+        The cursor is closed and its transaction committed (unless a transaction block is open)
+        when the generator is exhausted or closed.
 
         Args:
             cursor (psycopg2 cursor object): Cursor with query.
@@ -144,13 +404,18 @@ class RiverDatabase(object):
         Yields:
             list: Items returned from query which length <= arraysize.
         """
-        while True:
-            results = cursor.fetchmany(arraysize)
-            if not results:
-                break
-            else:
-                pass
-            yield results
+        try:
+            while True:
+                results = cursor.fetchmany(arraysize)
+                if not results:
+                    break
+                else:
+                    pass
+                yield results
+        finally:
+            if not cursor.connection.closed:
+                cursor.close()
+                self.commit()
 
     def setup_hydro_object(self, hydro_object, schema=None, srid=None, overwrite=None):
         """
@@ -312,10 +577,14 @@ class RiverDatabase(object):
     def add_to_view(self, obj):
         """
         Handling adding layer process to QGIS view.
+        Inside a transaction block the layer is added after the transaction is committed.
 
         Args:
             obj: Instance of a hydrodynamic model object class.
         """
+        if self.tx_depth > 0:
+            self.tx_views.append(obj)
+            return
         vlayer = self.make_vlayer(obj)
         src = vlayer.source()
         if self.CHECK_URI is True:
@@ -359,63 +628,87 @@ class RiverDatabase(object):
                     pass
         return features, imp_attrs
 
-    def layer_to_pgsql(self, features, fields, hecobject, schema, srid):
+    def copy_layer(self, features, fields, hecobject, schema, srid):
         """
-        Create SQL for inserting the layer into PG database.
+        Streaming features into a PostGIS table. Geometries are sent as WKB with COPY ... FROM STDIN
+        in batches of COPY_BATCH features through a temporary staging table.
 
         Args:
-            features (list): List of WKT geometry objects.
+            features (iterable): Features to be imported.
             fields (list): List of fields imported from layer.
             hecobject (HecRasObject): Target HEC-RAS object.
             schema (str): Target schema.
             srid (int): Spatial Reference System Identifier.
 
         Returns:
-            str: Query for inserting features into a PostGIS table.
+            int/None: Number of imported features or None if import failed.
         """
+        if self.tx_failed is True:
+            return None
         schema_name = '"{0}"."{1}"'.format(schema, hecobject.name)
+        tmp = 'rgis_{0}_import'.format(hecobject.name.lower())
+        target_multi = hecobject.geom_type.startswith('MULTI')
         attrs_names = ['{0}'.format(attr[0]) for attr in fields]
-        qry = 'INSERT INTO {0} \n\t({1}'.format(schema_name, ', '.join(attrs_names))
-        qry += ', ' if attrs_names else ''
-        qry += 'geom) \nVALUES\n\t'
-
-        feats_def = []
-        single2multi = False
-        for feat in features:
-            vals = []
-            geom_wkt = feat.geometry().asWkt()
-            target_multi = hecobject.geom_type.startswith('MULTI')
-            src_multi = feat.geometry().isMultipart()
-            if not target_multi and src_multi:
-
-                # try to convert a copy of the feature geometry to singlepart
-                geom_copy = feat.geometry()
-                is_single = geom_copy.convertToSingleType()
-                if is_single:
-                    geometry = 'ST_GeomFromText(\'{0}\', {1})'.format(geom_copy.asWkt(), srid)
-                else:
-                    self.rgis.addInfo('WARNING:<br>Source geometry is reported as MULTIPART but target \
-                        is SINGLEPART! skipping...')
+        attrs_defs = ['{0} {1}'.format(attr[0], attr[2]) for attr in fields]
+        create = 'CREATE TEMP TABLE "{0}" ({1}) ON COMMIT DROP;'.format(tmp, ', '.join(attrs_defs + ['wkb bytea']))
+        copy = 'COPY "{0}" ({1}) FROM STDIN;'.format(tmp, ', '.join(attrs_names + ['wkb']))
+        geometry = 'ST_SetSRID(ST_GeomFromWKB(wkb), {0})'.format(srid)
+        if target_multi:
+            geometry = 'ST_Multi({0})'.format(geometry)
+        insert = 'INSERT INTO {0} ({1}) SELECT {2} FROM "{3}";\nTRUNCATE "{3}";'
+        insert = insert.format(schema_name, ', '.join(attrs_names + ['geom']), ', '.join(attrs_names + [geometry]), tmp)
+        single2multi = []
+
+        def rows(batch):
+            for feat in batch:
+                geom = feat.geometry()
+                if target_multi and not single2multi and not geom.isMultipart():
+                    single2multi.append(True)
+                elif not target_multi and geom.isMultipart():
+                    # try to convert a copy of the feature geometry to singlepart
+                    if not geom.convertToSingleType():
+                        self.rgis.addInfo('WARNING:<br>Source geometry is reported as MULTIPART but target is SINGLEPART! skipping...')
+                        continue
+                vals = []
+                for attr in fields:
+                    val = feat.attribute(attr[1].strip('"'))
+                    vals.append(None if val == NULL else val)
+                vals.append('\\x{0}'.format(bytes(geom.asWkb()).hex()))
+                yield vals
+
+        count = None
+        try:
+            cur = self.con.cursor()
+            cur.execute(create)
+            count = 0
+            batch = []
+            for feat in features:
+                batch.append(feat)
+                if len(batch) < self.COPY_BATCH:
                     continue
-            elif target_multi and not src_multi:
-                single2multi = True
-                geometry = 'ST_Multi(ST_GeomFromText(\'{0}\', {1}))'.format(geom_wkt, srid)
+                stream = CopyStream(rows(batch))
+                cur.copy_expert(copy, stream)
+                cur.execute(insert)
+                count += stream.count
+                batch = []
+                self.rgis.addInfo('  {0} features imported...'.format(count))
+            if batch:
+                stream = CopyStream(rows(batch))
+                cur.copy_expert(copy, stream)
+                cur.execute(insert)
+                count += stream.count
+            cur.execute('DROP TABLE "{0}";'.format(tmp))
+            self.commit()
+            if single2multi:
+                self.rgis.addInfo('Source geometry is SINGLEPART but the target is MULTIPART!')
             else:
-                geometry = 'ST_GeomFromText(\'{0}\', {1})'.format(geom_wkt, srid)
-            for attr in fields:
-                val = feat.attribute(attr[1].strip('"'))
-                if not val == NULL:
-                    vals.append('\'{0}\'::{1}'.format(val, attr[2]))
-                else:
-                    vals.append('NULL')
-            vals.append(geometry)
-            feats_def.append('({0})'.format(', '.join(vals)))
-        qry += '{0};'.format(',\n\t'.join(feats_def))
-        if single2multi is True:
-            self.rgis.addInfo('Source geometry is SINGLEPART but the target is MULTIPART!')
-        else:
-            pass
-        return qry
+                pass
+        except Exception as e:
+            self.rollback()
+            self.rgis.addInfo(repr(e))
+            count = None
+        finally:
+            return count
 
     def insert_layer(self, layer, hecobject, attr_map=None, schema=None, srid=None, selected=False):
         """
@@ -456,11 +749,10 @@ class RiverDatabase(object):
             pass
 
         features, imp_attrs = self.import_layer(layer, hecobject.attrs, attr_map, selected)
-        qry = self.layer_to_pgsql(features, imp_attrs, hecobject, SCHEMA, SRID)
-        if qry is not None:
-            self.run_query(qry)
+        count = self.copy_layer(features, imp_attrs, hecobject, SCHEMA, SRID)
+        if count is not None:
             self.add_to_view(hecobject)
-            self.rgis.addInfo('OK')
+            self.rgis.addInfo('{0} features imported. OK'.format(count))
         else:
             pass
 
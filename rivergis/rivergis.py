@@ -87,6 +87,7 @@ class RiverGIS(QMainWindow):
         self.ui.actionRASXSAll.triggered.connect(lambda: r1d.ras1dXSAll(self))
         self.ui.actionRASHealLanduseGeometries.triggered.connect(lambda: r1d.ras1dHealLanduseGeoms(self))
         self.ui.actionRASManningsNValues.triggered.connect(lambda: r1d.ras1dXSExtractMannings(self))
+        self.ui.actionRASManningsNValuesRaster.triggered.connect(lambda: r1d.ras1dXSExtractManningsRaster(self))
         self.ui.actionRASLevees.triggered.connect(lambda: r1d.ras1dLevees(self))
         self.ui.actionRASIneffectiveFlowAreas.triggered.connect(lambda: r1d.ras1dIneffective(self))
         self.ui.actionRASBlockedObstructions.triggered.connect(lambda: r1d.ras1dObstructions(self))
@@ -111,8 +112,11 @@ class RiverGIS(QMainWindow):
         self.ui.actionRASSacAll.triggered.connect(lambda: r1d.ras1dSACAll(self))
         self.ui.actionRASCreateRASGISImport.triggered.connect(lambda: r1d.ras1dCreateRasGisImportFile(self))
         # 2D
+        self.ui.actionRASEstimate2dAreaPoints.triggered.connect(lambda: r2d.ras2dEstimateMeshPoints(self))
         self.ui.actionRASCreate2dAreaPoints.triggered.connect(lambda: r2d.ras2dCreate2dPoints(self))
+        self.ui.actionRASRecreate2dAreaPoints.triggered.connect(lambda: r2d.ras2dCreate2dPoints(self, full=True))
         self.ui.actionRASPreview2DMesh.triggered.connect(lambda: r2d.ras2dPreviewMesh(self))
+        self.ui.actionRAS2DCellProperties.triggered.connect(lambda: r2d.ras2dCellProperties(self))
         self.ui.actionRASSave2DPointsToHECRASGeometry.triggered.connect(lambda: r2d.ras2dSaveMeshPtsToGeometry(self))
         # HELP
         self.ui.actionHelpContents.triggered.connect(self.showRGisHelp)
@@ -403,11 +407,17 @@ class RiverGIS(QMainWindow):
         self.showHelp('index.html')
 
     def readSettings(self, defaults=False):
-        sFile = os.path.join(self.rivergisPath, 'settings.json')
-        if not os.path.isfile(sFile) or defaults:
-            sFile = os.path.join(self.rivergisPath, 'default_settings.json')
-        with open(sFile, 'r') as f:
+        with open(os.path.join(self.rivergisPath, 'default_settings.json'), 'r') as f:
             self.opts = json.load(f)
+        sFile = os.path.join(self.rivergisPath, 'settings.json')
+        if os.path.isfile(sFile) and not defaults:
+            # user settings override the defaults, options added in newer versions keep their default values
+            with open(sFile, 'r') as f:
+                user_opts = json.load(f)
+            for group, options in user_opts.items():
+                self.opts.setdefault(group, {}).update(options)
+        else:
+            pass
         for group, options in self.opts.items():
             for name, defaultValue in options.items():
                 if group == 'rgis' and name in list(self.opts['rgis'].keys()):
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+/***************************************************************************
+Name                 : RiverGIS
+Description          : HEC-RAS tools for QGIS
+Date                 : December, 2015
+copyright            : (C) 2015 by RiverGIS Group
+email                : rpasiok@gmail.com, damnback333@gmail.com
+***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .cell_properties import cell_pixels
+from .mesh2d import wkb_rings
+from .raster_sampler import RasterSampler
+from qgis.core import QgsProject
+
+
+def polygon_histogram(provider, rings, resolution=0.01):
+    """
+    Histogram of DTM elevations inside a polygon. The DTM window under the polygon is read tile by tile,
+    masked with the polygon and elevations are binned with the given resolution, so no points are created.
+    Runs on a worker thread, so it gets its own copy of the raster data provider.
+
+    Args:
+        provider (QgsRasterDataProvider): Data provider of the DTM.
+        rings (list): Polygon rings as arrays of vertex coordinates.
+        resolution (float): Elevation bins width.
+
+    Returns:
+        dict/None: Bins numbers ('keys'), cells counts ('counts') and sums of elevations ('sums') of bins,
+            minimum and maximum elevation and DTM cell area, or None if there is no DTM value inside the polygon.
+    """
+    sampler = RasterSampler(provider)
+    coords = np.vstack(rings)
+    xmin, ymin = coords.min(axis=0)
+    xmax, ymax = coords.max(axis=0)
+    col0, row0, ncols, nrows = sampler.window_for_bbox(xmin, ymin, xmax, ymax)
+    keys = []
+    counts = []
+    sums = []
+    zmin = []
+    zmax = []
+    tile = sampler.TILE
+    for r0 in range(row0, row0 + nrows, tile):
+        for c0 in range(col0, col0 + ncols, tile):
+            nc = min(tile, col0 + ncols - c0)
+            nr = min(tile, row0 + nrows - r0)
+            idx, cols, rows = cell_pixels(sampler, [rings], c0, r0, nc, nr)
+            if idx.size == 0:
+                continue
+            else:
+                pass
+            z = sampler.read_window(c0, r0, nc, nr)[rows, cols]
+            z = z[~np.isnan(z)]
+            if z.size == 0:
+                continue
+            else:
+                pass
+            zmin.append(z.min())
+            zmax.append(z.max())
+            bins, inv = np.unique(np.floor(z / resolution).astype(np.int64), return_inverse=True)
+            keys.append(bins)
+            counts.append(np.bincount(inv))
+            sums.append(np.bincount(inv, weights=z))
+    if not keys:
+        return None
+    bins, inv = np.unique(np.concatenate(keys), return_inverse=True)
+    counts = np.bincount(inv, weights=np.concatenate(counts))
+    sums = np.bincount(inv, weights=np.concatenate(sums))
+    return {
+        'keys': bins,
+        'counts': counts,
+        'sums': sums,
+        'min': float(min(zmin)),
+        'max': float(max(zmax)),
+        'cell_area': sampler.cell_area,
+        'resolution': resolution}
+
+
+def histogram_volumes(hist, levels):
+    """
+    Volumes and wetted areas below water levels computed from an elevation histogram.
+    Volume below a level is the sum of (level - elevation) * cell_area over DTM cells lower than the level.
+
+    Args:
+        hist (dict): Histogram returned by polygon_histogram.
+        levels (numpy.ndarray): Water levels.
+
+    Returns:
+        tuple: Arrays of volumes and wetted areas.
+    """
+    levels = np.asarray(levels, dtype=np.float64)
+    upper = (hist['keys'] + 1) * hist['resolution']
+    ccount = np.r_[0, np.cumsum(hist['counts'])]
+    csum = np.r_[0, np.cumsum(hist['sums'])]
+    # bins located entirely below a level
+    j = np.searchsorted(upper, levels, 'right')
+    volumes = hist['cell_area'] * np.maximum(ccount[j] * levels - csum[j], 0)
+    return volumes, hist['cell_area'] * ccount[j]
+
+
+def storage_histograms(rgis, resolution=0.01, workers=None):
+    """
+    Elevation histograms of storage areas. Each storage area is read from its DTM (DtmID) by a worker thread.
+
+    Args:
+        resolution (float): Elevation bins width.
+        workers (int): Number of worker threads.
+
+    Returns:
+        list: List of tuples (storage area row, histogram). Histogram is None if there are no DTM values.
+            Storage areas with DTM layers missing in the project are skipped.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    qry = '''
+SELECT
+    sa."StorageID",
+    sa."UserElev",
+    dtm."LayerID",
+    ST_AsBinary(ST_Force2D(ST_Multi(sa.geom)), 'NDR') AS wkb
+FROM
+    "{0}"."StorageAreas" AS sa,
+    "{0}"."DTMs" AS dtm
+WHERE
+    sa."DtmID" = dtm."DtmID"
+ORDER BY
+    sa."StorageID";
+'''
+    qry = qry.format(rgis.rdb.SCHEMA)
+    areas = []
+    tasks = []
+    for area in rgis.rdb.run_query(qry, fetch=True) or []:
+        rlayer = QgsProject.instance().mapLayer(area['LayerID'])
+        if rlayer is None:
+            rgis.addInfo('  DTM of storage area StorageID={0} is not loaded in the project. Skipping...'.format(area['StorageID']))
+            continue
+        else:
+            pass
+        areas.append(area)
+        tasks.append((rlayer.dataProvider().clone(), wkb_rings(area['wkb']), resolution))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hists = list(executor.map(lambda task: polygon_histogram(*task), tasks))
+    return list(zip(areas, hists))
+
+
+def level_schedule(text):
+    """
+    Parsing a levels schedule given either as a number of evenly spaced slices (e.g. '10')
+    or as comma separated fractions of the depth between the minimum and the maximum elevation
+    (e.g. '0, 0.5, 0.8, 0.9, 0.95, 1' for levels denser near the top).
+
+    Returns:
+        numpy.ndarray: Sorted unique fractions from 0 to 1.
+
+    Raises:
+        ValueError: If the schedule is not valid.
+    """
+    parts = [p for p in text.replace(';', ',').split(',') if p.strip()]
+    if len(parts) == 1 and parts[0].strip().isdigit():
+        slices = int(parts[0])
+        if not 1 <= slices <= 1000:
+            raise ValueError('Number of slices must be between 1 and 1000')
+        return np.linspace(0, 1, slices + 1)
+    fractions = np.unique([float(p) for p in parts])
+    if fractions.size < 2 or fractions[0] < 0 or fractions[-1] > 1:
+        raise ValueError('Levels schedule needs at least 2 fractions between 0 and 1')
+    return fractions
+
+
+def storage_levels(hist, user_elev=None, fractions=None):
+    """
+    Water levels of a storage area located at fractions of the depth between its minimum elevation and
+    its maximum elevation or the user defined elevation (UserElev). Levels are evenly spaced in 10 slices
+    if no fractions are given.
+    """
+    if fractions is None:
+        fractions = np.linspace(0, 1, 11)
+    else:
+        pass
+    emax = hist['max'] if user_elev is None else float(user_elev)
+    return hist['min'] + np.asarray(fractions, dtype=np.float64) * (emax - hist['min'])